@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Check that the 'fast' and 'bs4' parser backends return the same results
+on the recorded pages in benchmarks/fixtures, and time them. The same
+check runs with the tests, see tests/test_parser.py.
+
+    python benchmarks/parsers.py [-n ROUNDS]
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from superbfdl import parser  # noqa: E402
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def fixtures(prefix):
+    for file_name in sorted(glob.glob(os.path.join(FIXTURES, prefix + '*'))):
+        with open(file_name) as hfile:
+            yield os.path.basename(file_name), hfile.read()
+
+
+def timed(fn, page, backend, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn(page, backend=backend)
+    return (time.perf_counter() - start) / rounds
+
+
+def compare(prefix, fn, rounds):
+    failures = 0
+    for name, page in fixtures(prefix):
+        fast = fn(page, backend='fast')
+        slow = fn(page, backend='bs4')
+        status = 'ok' if fast == slow else 'MISMATCH'
+        if fast != slow:
+            failures += 1
+            print(f"    fast: {fast!r}\n    bs4:  {slow!r}")
+        fast_t = timed(fn, page, 'fast', rounds)
+        slow_t = timed(fn, page, 'bs4', rounds)
+        print(f"{status:<9} {name:<32} fast {fast_t * 1e3:8.3f}ms  "
+              f"bs4 {slow_t * 1e3:8.3f}ms  x{slow_t / fast_t:6.1f}")
+    return failures
+
+
+def main():
+    args = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    args.add_argument("-n", "--rounds", type=int, default=20)
+    args = args.parse_args()
+    failures = compare('motherboard_', parser.find_product_id, args.rounds)
+    failures += compare('results_', parser.find_rows, args.rounds)
+    failures += compare('firmware_', parser.find_rows, args.rounds)
+    if failures:
+        print(f"[!] {failures} fixtures differ between backends")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Offline benchmarks for superbfdl, run against the local stand-in server
+(benchmarks/server.py) instead of the vendor site.
+
+For every stage it reports the throughput and the p50/p99 latency:
+
+    lookup     core.query_product_id (cache bypassed)
+    metadata   core.fetch_results + parse_results (cache bypassed)
+    parse      core.parse_results_page on a recorded page (CPU only)
+    download   util.download_file
+    extract    util.extract_matching
+    fleet-N    cli.dispatch_fleet end to end, cold caches, N boards
+               (latency: first to last stage of each board)
+
+    python benchmarks/run.py --latency 0.02 --sizes 1,10,100,1000
+"""
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import server  # noqa: E402
+import superbfdl.cache as cache  # noqa: E402
+import superbfdl.cli as cli  # noqa: E402
+import superbfdl.core as core  # noqa: E402
+import superbfdl.metrics as metrics  # noqa: E402
+import superbfdl.ratelimit as ratelimit  # noqa: E402
+import superbfdl.session as session  # noqa: E402
+import superbfdl.util as util  # noqa: E402
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def report(name, count, elapsed, latencies):
+    print(f"{name:<12} {count:>6} {count / elapsed:>10.1f}/s "
+          f"{percentile(latencies, 50) * 1e3:>9.2f}ms "
+          f"{percentile(latencies, 99) * 1e3:>9.2f}ms")
+
+
+def board_latencies(events):
+    """
+    Per-board latency of a fleet run, from the stage events recorded in
+    metrics: from the start of the first stage of the board to the end
+    of its last one.
+    """
+    spans = {}
+    for event in events:
+        if not event['board']:
+            continue
+        start, end = event['start'], event['start'] + event['duration']
+        first, last = spans.get(event['board'], (start, end))
+        spans[event['board']] = (min(first, start), max(last, end))
+    return [end - start for start, end in spans.values()]
+
+
+def measure(name, fn, items, jobs):
+    """
+    Run fn over items on `jobs` threads, print throughput and latency.
+    """
+    latencies = []
+
+    def timed(item):
+        start = time.perf_counter()
+        fn(item)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            list(executor.map(timed, items))
+    report(name, len(items), time.perf_counter() - start, latencies)
+
+
+def boards(count, variants=3):
+    """
+    Board names, grouped in families of `variants` boards sharing one
+    bundle (see server.StandIn.software_id).
+    """
+    return [f"X{11 + i // variants % 3}B{i // variants:04d}-{i % variants}"
+            for i in range(count)]
+
+
+def run(args, url, standin):
+    work_dir = tempfile.mkdtemp(prefix='superbfdl-bench-')
+    try:
+        core.SUPERMICRO_URL = url
+        cache.configure(cache_dir=os.path.join(work_dir, 'cache'))
+        session.configure(pool_size=args.jobs)
+        # measure the code, not the limiter, unless --rate is given
+        ratelimit.configure(rate=args.rate)
+        sample = boards(args.samples, variants=1)
+        ids = sorted({standin.software_id(b) for b in sample})
+        # build the bundles before timing, their size is on the results page
+        for sid in ids:
+            standin.bundle(sid)
+
+        print(f"{'stage':<12} {'count':>6} {'throughput':>12} "
+              f"{'p50':>11} {'p99':>11}")
+
+        measure('lookup',
+                lambda b: core.query_product_id(b, refresh=True),
+                sample, args.jobs)
+        measure('metadata',
+                lambda b: core.get_board_info(b, server.product_id(b),
+                                              'bios', refresh=True),
+                sample, args.jobs)
+
+        page = standin.results_page('X11DPU')
+        measure('parse', lambda _i: core.parse_results_page(page),
+                list(range(args.samples)), 1)
+
+        urls = [f"{url}/Bios/softfiles/{sid}/bundle_{sid}.zip" for sid in ids]
+        dl_path = os.path.join(work_dir, 'downloads')
+        util.mkdir(dl_path)
+        measure('download', lambda u: util.download_file(u, dl_path), urls,
+                args.jobs)
+
+        archives = [os.path.join(dl_path, u.split('/')[-1]) for u in urls]
+        out_path = os.path.join(work_dir, 'extract')
+
+        def extract(archive):
+            dest = os.path.join(out_path, os.path.basename(archive))
+            util.mkdir(dest)
+            util.extract_matching(archive, dest, 'bios')
+
+        measure('extract', extract, archives, args.jobs)
+
+        for size in args.sizes:
+            fleet_dir = os.path.join(work_dir, f'fleet-{size}')
+            cache.configure(cache_dir=os.path.join(fleet_dir, 'cache'))
+            fleet = boards(size, variants=args.variants)
+            for board in fleet:
+                standin.bundle(standin.software_id(board))
+            metrics.registry().reset()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                results = cli.dispatch_fleet(fleet, fleet_dir,
+                                             max_workers=args.jobs,
+                                             per_host=args.jobs)
+            elapsed = time.perf_counter() - start
+            failed = sum(1 for r in results.values()
+                         if not r or not all(r.values()))
+            report(f'fleet-{size}', size, elapsed,
+                   board_latencies(metrics.registry().snapshot()['events']))
+            if failed:
+                print(f"    [!] {failed} boards failed")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def main():
+    args = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    args.add_argument("--latency", type=float, default=0.0,
+                      help="Seconds added to every response")
+    args.add_argument("--bandwidth", type=int,
+                      help="Bytes per second per response")
+    args.add_argument("--payload", type=int, default=1024 * 1024,
+                      help="Size of the firmware images in the bundles")
+    args.add_argument("--variants", type=int, default=3,
+                      help="Boards sharing each bundle in the fleet runs")
+    args.add_argument("--rate", type=float, default=0,
+                      help="Requests per second per host of the limiter "
+                      "(default: 0, unlimited)")
+    args.add_argument("-j", "--jobs", type=int, default=16)
+    args.add_argument("-n", "--samples", type=int, default=100,
+                      help="Requests per stage benchmark")
+    args.add_argument("--sizes", default="1,10,100,1000",
+                      help="Board counts of the end-to-end fleet runs")
+    args = args.parse_args()
+    args.sizes = [int(size) for size in args.sizes.split(',') if size]
+
+    _server, standin, url = server.start(latency=args.latency,
+                                         bandwidth=args.bandwidth,
+                                         payload_size=args.payload)
+    print(f"[*] Stand-in server at {url} (latency={args.latency}s, "
+          f"bandwidth={args.bandwidth or 'unlimited'})")
+    run(args, url, standin)
+    print(f"[*] Requests served: {standin.requests}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the parts of www.supermicro.com used by superbfdl.
+
+It serves the recorded pages of benchmarks/fixtures, rewritten for any
+board model, and synthetic nested firmware zips:
+
+    GET  /en/products/motherboard/<board>     motherboard page
+    POST /support/resources/results.aspx      BIOS results table
+    POST /support/bios/firmware.aspx          IPMI results table
+    GET  /Bios/softfiles/<id>/<name>.zip      firmware bundle (Range, HEAD)
+
+Board variants share bundles like on the real site (X11DPU and
+X11DPU-Z+ point to the same SoftwareItemID): the SoftwareItemID only
+depends on the part of the board name before the first '-'. Every
+response can be delayed by `latency` seconds and throttled to
+`bandwidth` bytes per second.
+
+    python benchmarks/server.py --port 8080 --latency 0.05
+"""
+import argparse
+import hashlib
+import io
+import os
+import random
+import re
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def _fixture(name):
+    with open(os.path.join(FIXTURES, name)) as hfile:
+        return hfile.read()
+
+
+def product_id(board):
+    return str(10000 + int(hashlib.md5(board.encode()).hexdigest(), 16)
+               % 90000)
+
+
+def build_bundle(software_id, payload_size):
+    """
+    A bundle laid out like the vendor ones: a BIOS zip nested in the
+    bundle, the BMC image, release notes and the sum utility.
+    """
+    # random data does not compress, like real firmware images
+    payload = random.Random(int(software_id)).randbytes(payload_size)
+
+    bios = io.BytesIO()
+    with zipfile.ZipFile(bios, 'w', zipfile.ZIP_STORED) as zfile:
+        zfile.writestr(f'BIOS_{software_id}/UEFI/X11DPU9.{software_id[-3:]}',
+                       payload)
+        zfile.writestr(f'BIOS_{software_id}/UEFI/flash.nsh', b'echo flash')
+        zfile.writestr(f'BIOS_{software_id}/Readme.pdf', os.urandom(4096))
+
+    bundle = io.BytesIO()
+    with zipfile.ZipFile(bundle, 'w', zipfile.ZIP_STORED) as zfile:
+        zfile.writestr(f'BIOS_{software_id}.zip', bios.getvalue())
+        zfile.writestr(f'BMC_{software_id}/SMT_X11AST2500_{software_id}.bin',
+                       payload[::-1])
+        zfile.writestr(f'BMC_{software_id}/release_notes.pdf',
+                       os.urandom(4096))
+        zfile.writestr('sum_2.5.0_Linux_x86_64.zip', os.urandom(8192))
+    return bundle.getvalue()
+
+
+class StandIn(object):
+    """
+    State of the stand-in site: fixtures, generated bundles and the
+    request counters.
+    """
+    def __init__(self, latency=0.0, bandwidth=None,
+                 payload_size=1024 * 1024):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.payload_size = payload_size
+        self.motherboard = _fixture('motherboard_X11DPU.html')
+        self.results = _fixture('results_X11DPU_bios.html')
+        self.requests = {}
+        self._bundles = {}
+        self._lock = threading.Lock()
+
+    def count(self, name):
+        with self._lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+
+    def software_id(self, board):
+        base = board.split('-')[0]
+        return str(20000 + int(hashlib.md5(base.encode()).hexdigest(), 16)
+                   % 70000)
+
+    def bundle(self, software_id):
+        data = self._bundles.get(software_id)
+        if data is None:
+            data = build_bundle(software_id, self.payload_size)
+            with self._lock:
+                data = self._bundles.setdefault(software_id, data)
+        return data
+
+    def motherboard_page(self, board):
+        return (self.motherboard.replace('X11DPU', board)
+                .replace('85553', product_id(board)))
+
+    def results_page(self, board):
+        sid = self.software_id(board)
+        # announce the size of the generated bundle, superbfdl checks it
+        size_kb = f"{len(self.bundle(sid)) // 1024:,}"
+        return (self.results.replace('12612', sid)
+                .replace('75,401', size_kb)
+                .replace('X11DPU3_4_AST173_06',
+                         f"{board.split('-')[0]}_{sid}")
+                .replace('X11DPU', board))
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    standin = None
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, body, status=200, content_type='text/html',
+              headers=None):
+        if isinstance(body, str):
+            body = body.encode()
+        if self.standin.latency:
+            time.sleep(self.standin.latency)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        bandwidth = self.standin.bandwidth
+        if not bandwidth:
+            self.wfile.write(body)
+            return
+        chunk = max(1024, bandwidth // 20)
+        for start in range(0, len(body), chunk):
+            self.wfile.write(body[start:start + chunk])
+            time.sleep(len(body[start:start + chunk]) / bandwidth)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        match = re.match(r'^/en/products/motherboard/([^/?]+)$', self.path)
+        if match:
+            self.standin.count('motherboard')
+            return self._send(
+                self.standin.motherboard_page(unquote(match[1])))
+
+        match = re.match(r'^/Bios/softfiles/(\d+)/([^/?]+)$', self.path)
+        if match:
+            self.standin.count('download')
+            return self._send_file(self.standin.bundle(match[1]))
+
+        self._send('Not Found', status=404)
+
+    def _send_file(self, data):
+        headers = {'Accept-Ranges': 'bytes'}
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if not match:
+            return self._send(data, content_type='application/zip',
+                              headers=headers)
+        start = int(match[1])
+        end = int(match[2]) if match[2] else len(data) - 1
+        if start >= len(data):
+            headers['Content-Range'] = f'bytes */{len(data)}'
+            return self._send(b'', status=416, headers=headers)
+        end = min(end, len(data) - 1)
+        headers['Content-Range'] = f'bytes {start}-{end}/{len(data)}'
+        self._send(data[start:end + 1], status=206,
+                   content_type='application/zip', headers=headers)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        form = parse_qs(self.rfile.read(length).decode())
+        if self.path not in ('/support/resources/results.aspx',
+                             '/support/bios/firmware.aspx'):
+            return self._send('Not Found', status=404)
+        self.standin.count('results')
+        board = form.get('ProductName', [''])[0]
+        etag = '"{}"'.format(self.standin.software_id(board))
+        if self.headers.get('If-None-Match') == etag:
+            self.standin.count('not_modified')
+            return self._send(b'', status=304, headers={'ETag': etag})
+        self._send(self.standin.results_page(board), headers={'ETag': etag})
+
+
+def start(port=0, **kwargs):
+    """
+    Start the stand-in in a background thread.
+    Returns (server, standin, base url).
+    """
+    standin = StandIn(**kwargs)
+    handler = type('BoundHandler', (Handler, ), {'standin': standin})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, standin, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def main():
+    args = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    args.add_argument("--port", type=int, default=8080)
+    args.add_argument("--latency", type=float, default=0.0,
+                      help="Seconds added to every response")
+    args.add_argument("--bandwidth", type=int,
+                      help="Bytes per second per response")
+    args = args.parse_args()
+    server, _standin, url = start(args.port, latency=args.latency,
+                                  bandwidth=args.bandwidth)
+    print(f"[*] Serving on {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Measure the startup cost of the superbfdl CLI, and fail when it regresses.
+
+Each command runs in a fresh interpreter, the best of --rounds runs is
+kept (the others only add scheduler noise):
+
+    import       python -c "import superbfdl.cli"
+    --version    python -m superbfdl --version
+    --help       python -m superbfdl --help
+
+The heaviest imports of superbfdl.cli are listed from `python -X
+importtime`, and the modules that must only be imported on first use
+(requests, urllib3, bs4, aiohttp, cProfile, multiprocessing, sqlite3)
+are checked to be absent after the import. --version does not import
+superbfdl.cli at all.
+
+    python benchmarks/startup.py [-n ROUNDS] [--max-ms 100]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+COMMANDS = {
+    'import': ['-c', 'import superbfdl.cli'],
+    '--version': ['-m', 'superbfdl', '--version'],
+    '--help': ['-m', 'superbfdl', '--help'],
+}
+
+LAZY_MODULES = ('requests', 'urllib3', 'bs4', 'aiohttp', 'cProfile',
+                'multiprocessing', 'sqlite3')
+
+
+def run(args, **kwargs):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    return subprocess.run([sys.executable] + args, env=env, cwd=ROOT,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True, check=True, **kwargs)
+
+
+def best_time(args, rounds):
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        run(args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def import_times(top=10):
+    """
+    Returns the (cumulative us, module) of the heaviest imports.
+    """
+    stderr = run(['-X', 'importtime', '-c', 'import superbfdl.cli']).stderr
+    times = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _self, cumulative, module = line[len('import time:'):].split('|')
+        times.append((int(cumulative), module.rstrip()))
+    return sorted(times, reverse=True)[:top]
+
+
+def eager_modules():
+    code = ("import sys, superbfdl.cli; "
+            f"print(' '.join(m for m in {LAZY_MODULES!r} "
+            "if m in sys.modules))")
+    return run(['-c', code]).stdout.split()
+
+
+def main():
+    args = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    args.add_argument("-n", "--rounds", type=int, default=10)
+    args.add_argument(
+        "--max-ms",
+        type=float,
+        default=100,
+        help="Fail when --version takes this long (ms) more than a bare "
+        "interpreter")
+    args = args.parse_args()
+
+    baseline = best_time(['-c', 'pass'], args.rounds)
+    print(f"{'interpreter':>12} {baseline * 1000:8.1f} ms")
+    results = {}
+    for name, command in COMMANDS.items():
+        results[name] = best_time(command, args.rounds)
+        print(f"{name:>12} {results[name] * 1000:8.1f} ms "
+              f"(+{(results[name] - baseline) * 1000:.1f} ms)")
+
+    print("\nheaviest imports (cumulative):")
+    for cumulative, module in import_times():
+        print(f"{cumulative / 1000:8.1f} ms {module}")
+
+    failures = 0
+    eager = eager_modules()
+    if eager:
+        print(f"[!] imported by superbfdl.cli: {', '.join(eager)}")
+        failures += 1
+    overhead = (results['--version'] - baseline) * 1000
+    if overhead > args.max_ms:
+        print(f"[!] --version took {overhead:.1f} ms more than a bare "
+              f"interpreter, the limit is {args.max_ms} ms")
+        failures += 1
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
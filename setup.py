@@ -50,6 +50,9 @@ setup(
     ],
     package=['superbfdl'],
     install_requires=install_requires,
+    extras_require={
+        'async': ['aiohttp>=3.7'],
+    },
     entry_points={
         'console_scripts': ['superbfdl=superbfdl:main'],
     },
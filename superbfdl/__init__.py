@@ -1,3 +1,18 @@
+import sys
+
 __version__ = '1.0.0.dev1'
 
-__all__ = ('__version__')
+__all__ = ('__version__', 'main')
+
+
+def main(*argv):
+    """
+    Entry point of the superbfdl console script. The CLI (and requests)
+    is only imported here, so importing the package stays cheap, and
+    not at all for -V/--version.
+    """
+    if sys.argv[1:] in (['-V'], ['--version']):
+        print(f"superbfdl {__version__}")
+        return 0
+    from superbfdl.cli import main as cli_main
+    return cli_main(*argv)
@@ -1,7 +1,9 @@
 """
 superbfdl.__main__ module (call python3 -m superbfdl)
 """
-from .cli import main
+import sys
+
+from superbfdl import main
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main(*sys.argv))
@@ -0,0 +1,502 @@
+"""
+asyncio engine for the lookup -> metadata -> download -> extract pipeline.
+
+All the requests of a board list run as coroutines on one event loop, so
+thousands of requests can be in flight from a single process instead of
+forking two processes per board. Parsing, caching and the firmware
+matching are shared with core, cache and util; only the network I/O is
+asynchronous. Extraction runs in a thread pool, and the cache and file
+I/O in the default executor, off the event loop. The ProductIDs found
+are stored at the end of the run, with a single write of the cache.
+
+This engine needs the optional aiohttp dependency:
+
+    pip install superbfdl[async]
+
+Usage:
+
+    from superbfdl.aio import run_boards
+    results = asyncio.run(run_boards(['X11DPU', 'H11DSi'], '/tmp/fw'))
+"""
+import asyncio
+import fcntl
+import functools
+import os
+import time
+from contextlib import asynccontextmanager, AsyncExitStack
+
+import superbfdl.cache as cache
+import superbfdl.catalog as catalog
+import superbfdl.core as core
+import superbfdl.integrity as integrity
+import superbfdl.manifest as manifest
+import superbfdl.metrics as metrics
+import superbfdl.ratelimit as ratelimit
+import superbfdl.session as session
+import superbfdl.util as util
+from superbfdl.scheduler import Scheduler
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+FW_TYPES = ['bios', 'ipmi']
+
+# total number of requests in flight
+CONCURRENCY = 100
+# maximum requests in flight per host, the adaptive limiters of
+# ratelimit grow up to it
+PER_HOST = ratelimit.MAX_CONCURRENCY
+# seconds between two tries to get a slot of a host limiter
+SLOT_POLL = 0.02
+# bytes of a download buffered before they are written to disk
+WRITE_SIZE = 1024 * 1024
+
+
+def _part_size(part_path):
+    return os.path.getsize(part_path) if os.path.exists(part_path) else 0
+
+
+def _write_chunks(bfile, digest, chunks):
+    data = b"".join(chunks)
+    bfile.write(data)
+    digest.update(data)
+
+
+@asynccontextmanager
+async def limiter_slot(limiter):
+    """
+    Same as HostLimiter.slot, but waits without blocking the event loop.
+    """
+    wait = limiter.reserve()
+    if wait:
+        await asyncio.sleep(wait)
+    while not limiter.try_enter():
+        await asyncio.sleep(SLOT_POLL)
+    try:
+        yield
+    finally:
+        limiter.leave()
+
+
+@asynccontextmanager
+async def file_lock(path):
+    """
+    Same as util.file_lock, but waits without blocking the event loop.
+    """
+    with open(path, "a") as lfile:
+        while True:
+            try:
+                fcntl.flock(lfile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                await asyncio.sleep(0.1)
+        try:
+            yield
+        finally:
+            fcntl.flock(lfile.fileno(), fcntl.LOCK_UN)
+
+
+class AsyncEngine(object):
+    """
+    Runs the firmware pipeline for many boards on one event loop.
+
+    The engine must be used as an async context manager, which opens
+    and closes the aiohttp client session.
+    """
+    def __init__(self, concurrency=CONCURRENCY, per_host=PER_HOST,
+                 timeout=None, retries=session.RETRIES,
+                 backoff=session.BACKOFF, chunk_size=util.CHUNK_SIZE):
+        if aiohttp is None:
+            raise RuntimeError("The asyncio engine needs aiohttp, "
+                               "install it with: pip install aiohttp")
+        self.concurrency = concurrency
+        self.per_host = per_host
+        ratelimit.configure(max_concurrency=per_host)
+        self.timeout = timeout or session.TIMEOUT
+        self.retries = retries
+        self.backoff = backoff
+        self.chunk_size = chunk_size
+        self.scheduler = Scheduler(max_workers=os.cpu_count() or 4,
+                                   per_host=per_host)
+        self.client = None
+        self._downloads = {}
+        # board: ProductID found during the run, stored by run()
+        self._product_ids = {}
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.concurrency,
+                                         limit_per_host=self.per_host)
+        timeout = aiohttp.ClientTimeout(total=None,
+                                        sock_connect=self.timeout[0],
+                                        sock_read=self.timeout[1])
+        self.client = aiohttp.ClientSession(connector=connector,
+                                            timeout=timeout)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.client.close()
+        self.scheduler.shutdown()
+
+    async def _run_sync(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.scheduler.executor, fn, *args)
+
+    async def _run_io(self, fn, *args):
+        """
+        Run the blocking file I/O fn in the default executor, so it
+        does not wait behind the extractions.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, fn, *args)
+
+    @asynccontextmanager
+    async def request(self, method, url, **kwargs):
+        """
+        Same limiter and retry policy as the blocking session: retry
+        connection errors and the session.RETRY_STATUS codes with an
+        exponential backoff, or after the Retry-After delay. The host slot
+        is held until the body of the response is read.
+        """
+        limiter = ratelimit.limiter(url)
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            delay = None
+            async with AsyncExitStack() as held:
+                await held.enter_async_context(limiter_slot(limiter))
+                start = time.monotonic()
+                try:
+                    resp = await self.client.request(method, url, **kwargs)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    resp, error = None, e
+                    limiter.feedback(None)
+                else:
+                    limiter.feedback(resp.status, time.monotonic() - start)
+                if resp is not None:
+                    metrics.incr('http_responses', method=method,
+                                 status=resp.status)
+                    if resp.status not in session.RETRY_STATUS or last:
+                        # the slot is held while the body is read
+                        try:
+                            yield resp
+                        finally:
+                            resp.release()
+                        return
+                    delay = ratelimit.retry_after(resp.headers)
+                    resp.release()
+                    metrics.incr('http_retries', status=resp.status)
+            if resp is None:
+                metrics.incr('http_responses', method=method, status='error')
+                if last:
+                    raise error
+                metrics.incr('http_retries', status='error')
+            if delay is None:
+                delay = self.backoff * (2 ** attempt)
+            await asyncio.sleep(delay)
+
+    async def query_product_id(self, board_model, refresh=False):
+        if not refresh:
+            product_id = await self._run_io(cache.product_id_cache().get,
+                                            board_model)
+            if product_id:
+                return product_id
+
+        url = (f"{core.SUPERMICRO_URL}/en/products/motherboard/"
+               f"{board_model}")
+        try:
+            async with self.request('GET', url) as resp:
+                # throttled or failing site: the board is not unknown
+                if resp.status in session.RETRY_STATUS:
+                    raise session.HTTPStatusError(
+                        f"Got HTTP {resp.status} from {url}")
+                if resp.status != 200:
+                    raise ValueError(f"Get wrong response from {url}")
+                html = await resp.text()
+            product_id = core.parse_product_id(html)
+        except (session.HTTPStatusError, aiohttp.ClientError,
+                asyncio.TimeoutError):
+            raise
+        except Exception as e:  # noqa
+            core.log.debug(e)
+            core.log.error(f"Could not find Product ID for {board_model} ")
+            return None
+        self._product_ids[board_model] = product_id
+        return product_id
+
+    async def save_product_ids(self):
+        """
+        Store the ProductIDs found so far in the cache, in one write.
+        """
+        product_ids, self._product_ids = self._product_ids, {}
+        await self._run_io(cache.product_id_cache().put_many, product_ids)
+
+    async def fetch_results(self, board_model, product_id, fw_type,
+                            refresh=False):
+        """
+        Async version of core.fetch_results, sharing its cache.
+        """
+        metadata = cache.metadata_cache()
+        key = cache.metadata_key(product_id, fw_type)
+        entry = None
+        if not refresh:
+            results = await self._run_io(metadata.get, key)
+            if results is not None:
+                return results
+            entry = await self._run_io(metadata.entry, key)
+
+        url = f"{core.SUPERMICRO_URL}/{core.FW_ENDPOINT[fw_type]}"
+        payload = {
+            "ProductID": product_id,
+            "ProductName": board_model,
+            "Resource": "BIOS"
+        }
+        async with self.request('POST', url, data=payload,
+                                headers=cache.conditional_headers(entry)) \
+                as resp:
+            if resp.status == 304 and entry:
+                await self._run_io(functools.partial(
+                    metadata.put, key, entry['value'],
+                    etag=entry.get('etag'),
+                    last_modified=entry.get('last_modified')))
+                return entry['value']
+            if resp.status != 200:
+                raise session.HTTPStatusError(
+                    f"Got HTTP {resp.status} from {url}")
+            html = await resp.text()
+            validators = cache.validators(resp)
+        results = core.parse_results_page(html)
+        await self._run_io(functools.partial(metadata.put, key, results,
+                                             **validators))
+        return results
+
+    async def get_board_info(self, board_model, product_id, fw_type,
+                             refresh=False):
+        results = await self.fetch_results(board_model, product_id, fw_type,
+                                           refresh=refresh)
+        return core.parse_results(board_model, product_id, fw_type, results)
+
+    async def download_file(self, url, dl_path, size_kb=None):
+        """
+        Stream url into dl_path, with the same '.part' + rename, resume
+        and integrity checks as util.download_verified. Returns
+        (file name, sha256) or (None, None).
+        """
+        file_name = url.split("/")[-1].strip()
+        file_path = os.path.join(dl_path, file_name)
+        part_path = file_path + ".part"
+        offset = await self._run_io(_part_size, part_path)
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        restart = False
+        async with self.request('GET', url, headers=headers) as resp:
+            if resp.status == 206:
+                mode = "ab"
+            elif resp.status == 200:
+                mode = "wb"
+            elif resp.status == 416:
+                # the .part is stale, start over once the host slot of
+                # this response is released
+                restart = True
+            else:
+                print(f"[!] Got HTTP {resp.status} from {url}")
+                return None, None
+            if not restart:
+                total, digest = await self._write_stream(
+                    resp, file_name, part_path, mode, size_kb)
+        if restart:
+            await self._run_io(os.unlink, part_path)
+            return await self.download_file(url, dl_path, size_kb)
+        size = await self._run_io(os.path.getsize, part_path)
+        if total and size != total:
+            print(f"[!] Download of {file_name} stopped at {size} of "
+                  f"{total} bytes")
+            return None, None
+        await self._run_io(os.replace, part_path, file_path)
+        return file_name, digest.hexdigest()
+
+    async def _write_stream(self, resp, file_name, part_path, mode, size_kb):
+        """
+        Check resp and write its body to part_path, after the part
+        already there in mode "ab". Returns (expected total size,
+        digest of the whole file).
+        """
+        total = integrity.check_response(file_name, resp.headers,
+                                         resp.status, size_kb)
+        digest = integrity.new_digest()
+        if mode == "ab":
+            await self._run_io(integrity.hash_prefix, part_path, digest)
+        received = 0
+        # the chunks are written (and hashed) in batches of
+        # WRITE_SIZE bytes, in the default executor
+        bfile = await self._run_io(open, part_path, mode)
+        try:
+            chunks, buffered = [], 0
+            async for chunk in resp.content.iter_chunked(
+                    self.chunk_size):
+                chunks.append(chunk)
+                buffered += len(chunk)
+                received += len(chunk)
+                if buffered >= WRITE_SIZE:
+                    await self._run_io(_write_chunks, bfile, digest,
+                                       chunks)
+                    chunks, buffered = [], 0
+            await self._run_io(_write_chunks, bfile, digest, chunks)
+        finally:
+            await self._run_io(bfile.close)
+            metrics.incr('bytes_downloaded', received)
+        return total, digest
+
+    async def fetch_archive(self, url, size_kb=None):
+        """
+        Async version of DownloadCache.fetch. Concurrent calls for the
+        same archive share one download.
+        """
+        downloads = cache.download_cache()
+        key = downloads.key(url)
+        if key not in self._downloads:
+            self._downloads[key] = asyncio.ensure_future(
+                self._fetch_archive(downloads, key, url, size_kb))
+        return await asyncio.shield(self._downloads[key])
+
+    async def _download_verified(self, downloads, key, url, size_kb):
+        """
+        Download and check the archive of key, started over once more
+        when the integrity checks fail. Returns its sha256 or None.
+        """
+        for attempt in range(integrity.RETRIES + 1):
+            try:
+                file_name, sha256 = await self.download_file(
+                    url, downloads.entry_dir(key), size_kb)
+                if not file_name:
+                    return None
+                await self._run_sync(downloads.verify, key)
+                return sha256
+            except integrity.IntegrityError as e:
+                print(f"[!] {e}")
+                metrics.incr('integrity_errors')
+                downloads.discard(key)
+                if attempt == integrity.RETRIES:
+                    return None
+
+    async def _fetch_archive(self, downloads, key, url, size_kb=None):
+        file_path = await self._run_sync(downloads.lookup, key)
+        if file_path:
+            return file_path
+        async with file_lock(downloads.lock_path(key)):
+            file_path = await self._run_sync(downloads.lookup, key)
+            if file_path:
+                return file_path
+            print(f"[*] Downloading {os.path.basename(key)}")
+            sha256 = await self._download_verified(downloads, key, url,
+                                                   size_kb)
+            if not sha256:
+                return None
+            file_path = await self._run_sync(downloads.store, key, url,
+                                             sha256)
+        await self._run_sync(downloads.evict, key)
+        return file_path
+
+    async def fw_download(self, board_model, product_id, output_dir,
+                          fw_type, sync=False):
+        scheduler = self.scheduler
+        with scheduler.stage('metadata', board_model, fw_type):
+            board_info = await self.get_board_info(board_model, product_id,
+                                                   fw_type)
+        await self._run_sync(catalog.record, board_info, fw_type)
+        fw_url = board_info['download_url']
+        if not fw_url:
+            print(f"[!] No {fw_type} download found for {board_model}")
+            return False
+
+        board_path = os.path.join(output_dir, board_model)
+        if sync and await self._run_io(manifest.is_current, board_path,
+                                       fw_type, board_info):
+            print(f"[*] {board_model} {fw_type} "
+                  f"{board_info[fw_type].get('release', '')} is up to date")
+            metrics.incr('up_to_date', fw_type=fw_type)
+            return True
+
+        # pinned from the download until the extraction
+        downloads = cache.download_cache()
+        pin = await self._run_sync(downloads.pin, fw_url)
+        try:
+            with scheduler.stage('download', board_model, fw_type):
+                fw_zip = await self.fetch_archive(fw_url,
+                                                  board_info.get('size_kb'))
+            if not fw_zip:
+                return False
+
+            with scheduler.stage('extract', board_model, fw_type):
+                fw_path = os.path.join(board_path, fw_type)
+                await self._run_io(util.mkdir, fw_path)
+                fw_file = await self._run_sync(downloads.extract, fw_url,
+                                               fw_type, fw_path, board_model)
+        finally:
+            downloads.unpin(pin)
+        if fw_file:
+            entry = await self._run_sync(manifest.record, board_path,
+                                         fw_type, board_info, fw_file)
+            await self._run_sync(catalog.record, board_info, fw_type,
+                                 fw_file, entry['sha256'])
+            print(f"[*] The new {fw_type} is located at {fw_file}")
+            return True
+        return False
+
+    async def board_job(self, board_model, output_dir, refresh_ids=False,
+                        sync=False):
+        with self.scheduler.stage('lookup', board_model):
+            product_id = await self.query_product_id(board_model,
+                                                     refresh=refresh_ids)
+        if not product_id:
+            return None
+        jobs = [self.fw_download(board_model, product_id, output_dir, fw,
+                                 sync=sync)
+                for fw in FW_TYPES]
+        done = await asyncio.gather(*jobs, return_exceptions=True)
+        result = {}
+        for fw, ok in zip(FW_TYPES, done):
+            if isinstance(ok, Exception):
+                print(f"[!] {fw} failed for {board_model}: {ok}")
+                ok = False
+            result[fw] = ok
+        return result
+
+    async def run(self, boards, output_dir, refresh_ids=False, sync=False):
+        """
+        Run all the boards, returns a dict mapping each board to a dict
+        of fw_type: success (None when the board could not be resolved).
+        """
+        jobs = [self.board_job(board, output_dir, refresh_ids=refresh_ids,
+                               sync=sync)
+                for board in boards]
+        try:
+            done = await asyncio.gather(*jobs, return_exceptions=True)
+        finally:
+            await self.save_product_ids()
+        results = {}
+        for board, result in zip(boards, done):
+            if isinstance(result, Exception):
+                print(f"[!] Lookup failed for {board}: {result}")
+                result = None
+            results[board] = result
+        return results
+
+
+async def run_boards(boards, output_dir, refresh_ids=False, sync=False,
+                     **kwargs):
+    """
+    Run the pipeline for all boards and print the report. kwargs are
+    passed to AsyncEngine.
+    """
+    async with AsyncEngine(**kwargs) as engine:
+        results = await engine.run(boards, output_dir,
+                                   refresh_ids=refresh_ids, sync=sync)
+    engine.scheduler.report(results)
+    return results
+
+
+def dispatch_async(boards, output_dir, refresh_ids=False, sync=False,
+                   **kwargs):
+    return asyncio.run(run_boards(boards, output_dir,
+                                  refresh_ids=refresh_ids, sync=sync,
+                                  **kwargs))
@@ -0,0 +1,696 @@
+"""
+On-disk caches kept under ~/.cache/superbfdl (or $XDG_CACHE_HOME).
+
+A board model maps to the same ProductID essentially forever, so the
+ProductID is only looked up on the vendor site when it is not cached,
+when the cached entry is older than the TTL or when a refresh is forced
+(--refresh-ids). Entries of every cache can also be dropped with:
+
+    superbfdl cache invalidate ids [BOARD ...]
+    superbfdl cache invalidate metadata [PRODUCT_ID ...]
+    superbfdl cache invalidate downloads [SOFTWARE_ITEM_ID ...]
+
+The parsed results.aspx/firmware.aspx pages are cached per
+(ProductID, fw_type) for a shorter freshness window, together with the
+ETag/Last-Modified validators sent by the server so that stale entries
+can be revalidated with a conditional request.
+
+Downloaded archives are kept in a content-addressed store keyed by
+SoftwareItemID/filename, so a bundle shared by the bios and ipmi jobs,
+by sibling boards or by consecutive runs is only fetched once. Their
+sha256 is recorded when they are stored; a cached archive is hashed
+again only when its size or mtime changed, or when asked to. The store
+is trimmed in LRU order above a size limit.
+
+The firmware files extracted from an archive are kept next to it, so a
+bundle shared by several boards (X11DPU and X11DPU-Z+ point to the same
+SoftwareItemID) is also only extracted once, and hardlinked into every
+board directory. The firmware files found in an archive are listed
+there too, so the archive is scanned once per fw_type, not per board.
+An archive is pinned from its fetch until its extraction, the eviction
+of another job leaves it alone meanwhile.
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+import superbfdl.integrity as integrity
+import superbfdl.matcher as matcher
+import superbfdl.metrics as metrics
+import superbfdl.util as util
+
+CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'superbfdl')
+
+# 90 days
+PRODUCT_ID_TTL = 90 * 24 * 3600
+# 6 hours
+METADATA_TTL = 6 * 3600
+# 5 GiB
+DOWNLOAD_CACHE_SIZE = 5 * 1024 ** 3
+# 1 hour, an older pin is left by a job that died and no longer counts
+PIN_TTL = 3600
+
+# https://www.supermicro.com/Bios/softfiles/12612/X11DPU3_4_AST173_06.zip
+SOFTFILES_REGEX = re.compile(r"/softfiles/(?P<sid>\d+)/(?P<name>[^/?#]+)")
+
+_settings = {
+    'cache_dir': CACHE_DIR,
+    'product_id_ttl': PRODUCT_ID_TTL,
+    'metadata_ttl': METADATA_TTL,
+    'download_cache_size': DOWNLOAD_CACHE_SIZE,
+    'verify_downloads': False,
+}
+
+_lock = threading.Lock()
+_caches = {}
+
+
+class JSONCache(object):
+    """
+    Key/value store persisted as a single JSON file.
+
+    Every entry records the time it was stored and is considered
+    expired once it is older than `ttl` seconds (None never expires).
+    Writes are serialized with a lock file and the file is re-read before
+    every write, so entries stored by other processes are not lost. The
+    file is replaced atomically. An entry changed from its current value
+    goes through update(), which reads it under the lock too.
+    """
+    def __init__(self, path, ttl=None, name=None):
+        self.path = path
+        self.ttl = ttl
+        self.name = name or os.path.splitext(os.path.basename(path))[0]
+        self._lock = threading.Lock()
+        self._entries = None
+
+    def _read(self):
+        try:
+            with open(self.path) as cfile:
+                return json.load(cfile)
+        except (OSError, ValueError):
+            return {}
+
+    def _write(self, entries):
+        cache_dir = os.path.dirname(self.path)
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as cfile:
+                json.dump(entries, cfile, indent=1, sort_keys=True)
+            os.replace(tmp_name, self.path)
+        except OSError:
+            if os.path.exists(tmp_name):
+                os.unlink(tmp_name)
+            raise
+
+    def _file_lock(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        return util.file_lock(self.path + '.lock')
+
+    def _expired(self, entry):
+        if self.ttl is None:
+            return False
+        return time.time() - entry.get('fetched', 0) > self.ttl
+
+    def entry(self, key):
+        """
+        Returns the raw entry ({'value': ..., 'fetched': ...}) for key,
+        expired or not, or None.
+        """
+        with self._lock:
+            # re-read on a miss, another process may have stored it
+            if self._entries is None or key not in self._entries:
+                self._entries = self._read()
+            return self._entries.get(key)
+
+    def items(self):
+        """
+        Returns all the (key, entry) pairs, as currently stored on disk.
+        """
+        with self._lock:
+            self._entries = self._read()
+            return list(self._entries.items())
+
+    def get(self, key):
+        entry = self.entry(key)
+        if entry is None or self._expired(entry):
+            metrics.incr('cache_misses', cache=self.name)
+            return None
+        metrics.incr('cache_hits', cache=self.name)
+        return entry['value']
+
+    def put(self, key, value, **extra):
+        self.put_many({key: value}, **extra)
+
+    def put_many(self, values, **extra):
+        """
+        Store all the key: value pairs of values with a single write.
+        """
+        if not values:
+            return
+        fetched = time.time()
+        with self._lock, self._file_lock():
+            entries = self._read()
+            for key, value in values.items():
+                entries[key] = dict(extra, value=value, fetched=fetched)
+            try:
+                self._write(entries)
+            except OSError as e:
+                print(f"[!] Could not write cache {self.path}: {e}")
+            self._entries = entries
+
+    def update(self, key, fn, **extra):
+        """
+        Store fn(current value of key) for key, reading the value under
+        the file lock so that an update made by another process in
+        between is not lost. fn gets None when key is missing, and
+        nothing is stored when it returns None. Returns the new value.
+        """
+        with self._lock, self._file_lock():
+            entries = self._read()
+            entry = entries.get(key)
+            value = fn(entry['value'] if entry else None)
+            if value is not None:
+                entries[key] = dict(extra, value=value, fetched=time.time())
+                try:
+                    self._write(entries)
+                except OSError as e:
+                    print(f"[!] Could not write cache {self.path}: {e}")
+            self._entries = entries
+            return value
+
+    def invalidate(self, key=None):
+        """
+        Drop one entry, or the whole cache when key is None.
+        """
+        with self._lock, self._file_lock():
+            entries = self._read()
+            if key is None:
+                entries = {}
+            else:
+                entries.pop(key, None)
+            self._write(entries)
+            self._entries = entries
+
+
+class JSONDirCache(JSONCache):
+    """
+    Same interface as JSONCache, but every key is stored in its own
+    file inside a directory. Used for larger entries, where rewriting
+    one big file on every put would not scale.
+    """
+    def _key_path(self, key):
+        return os.path.join(self.path, f"{key}.json")
+
+    def _read_key(self, key):
+        try:
+            with open(self._key_path(key)) as cfile:
+                return json.load(cfile)
+        except (OSError, ValueError):
+            return None
+
+    def _write_key(self, key, entry):
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as cfile:
+                json.dump(entry, cfile, indent=1, sort_keys=True)
+            os.replace(tmp_name, self._key_path(key))
+        except OSError:
+            if os.path.exists(tmp_name):
+                os.unlink(tmp_name)
+            raise
+
+    def entry(self, key):
+        return self._read_key(key)
+
+    def put(self, key, value, **extra):
+        entry = dict(extra, value=value, fetched=time.time())
+        try:
+            self._write_key(key, entry)
+        except OSError as e:
+            print(f"[!] Could not write cache {self._key_path(key)}: {e}")
+
+    def invalidate(self, key=None):
+        if key is not None:
+            keys = [key]
+        elif os.path.isdir(self.path):
+            keys = [name[:-5] for name in os.listdir(self.path)
+                    if name.endswith('.json')]
+        else:
+            keys = []
+        for k in keys:
+            try:
+                os.unlink(self._key_path(k))
+            except FileNotFoundError:
+                pass
+
+
+def file_sha256(file_name):
+    digest = hashlib.sha256()
+    with open(file_name, 'rb') as bfile:
+        for chunk in iter(lambda: bfile.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DownloadCache(object):
+    """
+    Content-addressed store for downloaded firmware archives.
+
+    Files live in {path}/{SoftwareItemID}/{filename}, the files extracted
+    from them in {path}/{SoftwareItemID}/.{filename}.extracted. The index
+    keeps the sha256, size and mtime of every archive, the size of its
+    extracted files, and the time it was last used, which drives the
+    LRU eviction once the store grows above `max_size` bytes.
+    """
+    def __init__(self, path, max_size=DOWNLOAD_CACHE_SIZE,
+                 verify_hits=False):
+        self.path = path
+        self.max_size = max_size
+        # hash every cached file before it is used
+        self.verify_hits = verify_hits
+        self.index = JSONCache(os.path.join(path, 'index.json'))
+        self._lock = threading.Lock()
+        self._downloads = {}
+
+    @staticmethod
+    def key(url):
+        """
+        Returns the 'SoftwareItemID/filename' key of a download url.
+        """
+        match = SOFTFILES_REGEX.search(url)
+        if match:
+            return f"{match['sid']}/{match['name']}"
+        file_name = url.split("/")[-1].strip()
+        url_hash = hashlib.sha1(url.encode()).hexdigest()[:16]
+        return f"url-{url_hash}/{file_name}"
+
+    def lookup(self, key, verify=False):
+        """
+        Returns the path of a cached file. The file is trusted when its
+        size and mtime are the ones it was stored with, otherwise (or
+        with verify) it is hashed, and discarded with its index entry
+        when the hash no longer matches.
+        """
+        entry = self.index.entry(key)
+        info = entry['value'] if entry else None
+        file_path = os.path.join(self.path, key)
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            stat = None
+        if not info or stat is None:
+            metrics.incr('cache_misses', cache='download')
+            return None
+        if verify or self.verify_hits or (stat.st_size, stat.st_mtime_ns) != \
+                (info.get('file_size'), info.get('mtime_ns')):
+            metrics.incr('cache_verifications')
+            if file_sha256(file_path) != info['sha256']:
+                print(f"[!] Cached file {file_path} is corrupted, "
+                      f"discarding it")
+                self.remove(key)
+                metrics.incr('cache_misses', cache='download')
+                return None
+            verified = {'file_size': stat.st_size,
+                        'mtime_ns': stat.st_mtime_ns}
+        else:
+            verified = {}
+        metrics.incr('cache_hits', cache='download')
+        # refresh the last-used time, keeping the sizes added meanwhile
+        self.index.update(key, lambda current: current and dict(current,
+                                                                **verified))
+        return file_path
+
+    def fetch(self, url, size_kb=None):
+        """
+        Returns the local path of the file behind url, downloading it
+        only when it is not in the store yet. size_kb is the size shown
+        by the download page, see integrity.
+        """
+        key = self.key(url)
+        file_path = self.lookup(key)
+        if file_path:
+            print(f"[*] Using cached {key}")
+            return file_path
+
+        entry_dir = self.entry_dir(key)
+
+        # Only one download per key: threads of this process wait on the
+        # in-flight lock, other processes (dispatch_job) on the file lock.
+        with self._inflight(key), util.file_lock(self.lock_path(key)):
+            file_path = self.lookup(key)
+            if file_path:
+                print(f"[*] {key} was downloaded by another job")
+                return file_path
+
+            # download_file writes to a .part file and renames it once
+            # complete, so a reader never sees a partial archive and an
+            # interrupted download is resumed on the next fetch
+            for attempt in range(integrity.RETRIES + 1):
+                try:
+                    file_name, sha256 = util.download_verified(
+                        url, entry_dir, size_kb=size_kb)
+                    if not file_name:
+                        return None
+                    self.verify(key)
+                    break
+                except integrity.IntegrityError as e:
+                    print(f"[!] {e}")
+                    metrics.incr('integrity_errors')
+                    self.discard(key)
+                    if attempt == integrity.RETRIES:
+                        return None
+            file_path = self.store(key, url, sha256=sha256)
+        self.evict(keep=key)
+        return file_path
+
+    def verify(self, key):
+        """
+        Check the archive just downloaded for key before it is stored.
+        """
+        file_path = os.path.join(self.path, key)
+        if file_path.lower().endswith('.zip'):
+            integrity.verify_zip(file_path)
+
+    def discard(self, key):
+        """
+        Remove the file of key and its partial download.
+        """
+        file_path = os.path.join(self.path, key)
+        for path in (file_path, file_path + ".part"):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def extracted_dir(self, key):
+        return os.path.join(self.path, os.path.dirname(key),
+                            f".{os.path.basename(key)}.extracted")
+
+    def candidates(self, key, fw_type):
+        """
+        Returns the fw_type files of the archive of key (see
+        util.candidates). The list is kept next to the extracted files,
+        so the archive is only scanned once per fw_type.
+        """
+        list_path = os.path.join(self.extracted_dir(key), fw_type,
+                                 'candidates.json')
+        try:
+            with open(list_path) as cfile:
+                return [matcher.Candidate(*c) for c in json.load(cfile)]
+        except (OSError, ValueError, TypeError):
+            pass
+        candidates = util.candidates(os.path.join(self.path, key), fw_type)
+        os.makedirs(os.path.dirname(list_path), exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(list_path),
+                                        suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as cfile:
+                json.dump(candidates, cfile)
+            os.replace(tmp_name, list_path)
+        except OSError as e:
+            print(f"[!] Could not write {list_path}: {e}")
+            if os.path.exists(tmp_name):
+                os.unlink(tmp_name)
+        return candidates
+
+    def extract(self, url, fw_type, dest, board_model=None):
+        """
+        Place the best fw_type file of the archive of url (already
+        fetched) in dest. The file is extracted once per archive, next
+        to it, and then hardlinked (see matcher.place) into every board
+        directory that needs it.
+        Returns the path of the file in dest, or None.
+        """
+        key = self.key(url)
+        zip_path = os.path.join(self.path, key)
+        candidates = self.candidates(key, fw_type)
+        if not candidates:
+            return None
+        member = matcher.rank(candidates, board_model)[0]
+        member_hash = hashlib.sha1(member.path.encode()).hexdigest()[:16]
+        member_dir = os.path.join(self.extracted_dir(key), fw_type,
+                                  member_hash)
+        extracted = os.path.join(member_dir, member.name)
+
+        if os.path.isfile(extracted):
+            metrics.incr('extract_reuse', fw_type=fw_type)
+        else:
+            os.makedirs(member_dir, exist_ok=True)
+            lock_path = member_dir + ".lock"
+            with self._inflight(lock_path), util.file_lock(lock_path):
+                if os.path.isfile(extracted):
+                    metrics.incr('extract_reuse', fw_type=fw_type)
+                else:
+                    util.extract_member(zip_path, member, member_dir)
+                    self._add_size(key, os.path.getsize(extracted))
+
+        target, _method = matcher.place(extracted, dest)
+        return target
+
+    def pin(self, url):
+        """
+        Keep the archive of url out of the eviction until unpin() (or
+        PIN_TTL). Returns the pin, a file next to the archive, so the
+        archive can be unpinned from another process.
+        """
+        key = self.key(url)
+        fd, pin = tempfile.mkstemp(dir=self.entry_dir(key),
+                                   prefix=f".{os.path.basename(key)}.pin-")
+        os.close(fd)
+        return pin
+
+    @staticmethod
+    def unpin(pin):
+        if not pin:
+            return
+        try:
+            os.unlink(pin)
+        except FileNotFoundError:
+            pass
+
+    def _pinned(self, key):
+        """
+        True when a job holds a pin on key, stale pins are removed.
+        """
+        entry_dir = os.path.join(self.path, os.path.dirname(key))
+        prefix = f".{os.path.basename(key)}.pin-"
+        try:
+            names = [n for n in os.listdir(entry_dir) if n.startswith(prefix)]
+        except FileNotFoundError:
+            return False
+        for name in names:
+            try:
+                if time.time() - os.path.getmtime(
+                        os.path.join(entry_dir, name)) < PIN_TTL:
+                    return True
+            except FileNotFoundError:
+                continue
+            self.unpin(os.path.join(entry_dir, name))
+        return False
+
+    def _add_size(self, key, size):
+        self.index.update(key, lambda info: info and dict(
+            info, size=info.get('size', 0) + size))
+
+    def entry_dir(self, key):
+        """
+        Directory where the file of key is stored (created if needed).
+        """
+        entry_dir = os.path.join(self.path, os.path.dirname(key))
+        os.makedirs(entry_dir, exist_ok=True)
+        return entry_dir
+
+    def lock_path(self, key):
+        return os.path.join(self.entry_dir(key),
+                            f".{os.path.basename(key)}.lock")
+
+    def store(self, key, url, sha256=None):
+        """
+        Index the file just downloaded for key, returns its path. The
+        file is hashed unless sha256 is given.
+        """
+        file_path = os.path.join(self.path, key)
+        stat = os.stat(file_path)
+        info = {
+            'sha256': sha256 or file_sha256(file_path),
+            # size counts the extracted files too, see _add_size
+            'size': stat.st_size,
+            'file_size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'url': url,
+        }
+        self.index.put(key, info)
+        return file_path
+
+    def remove(self, key):
+        """
+        Remove the file of key, its extracted files and its index entry.
+        The hardlinks in the board directories are not affected.
+        """
+        try:
+            os.unlink(os.path.join(self.path, key))
+        except FileNotFoundError:
+            pass
+        shutil.rmtree(self.extracted_dir(key), ignore_errors=True)
+        self.index.invalidate(key)
+
+    def _inflight(self, key):
+        with self._lock:
+            if key not in self._downloads:
+                self._downloads[key] = threading.Lock()
+            return self._downloads[key]
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used files until the store fits in
+        max_size. The entry `keep` and the pinned ones are never
+        removed.
+        """
+        entries = self.index.items()
+        total = sum(e['value'].get('size', 0) for _key, e in entries)
+        lru = sorted(entries, key=lambda item: item[1]['fetched'])
+        for key, entry in lru:
+            if total <= self.max_size:
+                break
+            if key == keep or self._pinned(key):
+                continue
+            self.remove(key)
+            total -= entry['value'].get('size', 0)
+            print(f"[*] Evicted {key} from the download cache")
+
+
+def conditional_headers(entry):
+    """
+    Build the If-None-Match/If-Modified-Since headers used to
+    revalidate a cached entry.
+    """
+    headers = {}
+    if entry:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+
+def validators(response):
+    """
+    Returns the ETag/Last-Modified of a response, to be stored with
+    the cached entry.
+    """
+    return {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+    }
+
+
+def metadata_key(product_id, fw_type):
+    return f"{product_id}-{fw_type}"
+
+
+def configure(cache_dir=None, product_id_ttl=None, metadata_ttl=None,
+              download_cache_size=None, verify_downloads=None):
+    with _lock:
+        if cache_dir is not None:
+            _settings['cache_dir'] = cache_dir
+        if product_id_ttl is not None:
+            _settings['product_id_ttl'] = product_id_ttl
+        if metadata_ttl is not None:
+            _settings['metadata_ttl'] = metadata_ttl
+        if download_cache_size is not None:
+            _settings['download_cache_size'] = download_cache_size
+        if verify_downloads is not None:
+            _settings['verify_downloads'] = verify_downloads
+        _caches.clear()
+
+
+def cache_dir():
+    return _settings['cache_dir']
+
+
+def product_id_cache():
+    """
+    Returns the shared board -> ProductID cache.
+    """
+    with _lock:
+        if 'product_id' not in _caches:
+            path = os.path.join(_settings['cache_dir'], 'product_ids.json')
+            _caches['product_id'] = JSONCache(path,
+                                              ttl=_settings['product_id_ttl'])
+        return _caches['product_id']
+
+
+def metadata_cache():
+    """
+    Returns the shared (ProductID, fw_type) -> results page cache.
+    """
+    with _lock:
+        if 'metadata' not in _caches:
+            path = os.path.join(_settings['cache_dir'], 'metadata')
+            _caches['metadata'] = JSONDirCache(path,
+                                               ttl=_settings['metadata_ttl'])
+        return _caches['metadata']
+
+
+def download_cache():
+    """
+    Returns the shared download store.
+    """
+    with _lock:
+        if 'download' not in _caches:
+            path = os.path.join(_settings['cache_dir'], 'downloads')
+            _caches['download'] = DownloadCache(
+                path, max_size=_settings['download_cache_size'],
+                verify_hits=_settings['verify_downloads'])
+        return _caches['download']
+
+
+def invalidate(name, keys=None):
+    """
+    Drop entries of a cache: 'ids' (keys are board models), 'metadata'
+    (ProductIDs) or 'downloads' (SoftwareItemIDs), every entry when keys
+    is empty. Returns the number of entries dropped.
+    """
+    keys = set(keys or ())
+    if name == 'ids':
+        store = product_id_cache()
+        dropped = [key for key, _entry in store.items()
+                   if not keys or key in keys]
+    elif name == 'metadata':
+        store = metadata_cache()
+        # the keys are {ProductID}-{fw_type}, see metadata_key
+        stored = [file_name[:-len('.json')]
+                  for file_name in _listdir(store.path)
+                  if file_name.endswith('.json')]
+        dropped = [key for key in stored
+                   if not keys or key.rsplit('-', 1)[0] in keys]
+    elif name == 'downloads':
+        store = download_cache()
+        # the keys are {SoftwareItemID}/{filename}, see DownloadCache.key
+        dropped = [key for key, _entry in store.index.items()
+                   if not keys or key.split('/')[0] in keys]
+    else:
+        raise ValueError(f'name should be ids, metadata or downloads, '
+                         f'{name} given')
+    for key in dropped:
+        if name == 'downloads':
+            store.remove(key)
+        else:
+            store.invalidate(key)
+    return len(dropped)
+
+
+def _listdir(path):
+    try:
+        return os.listdir(path)
+    except FileNotFoundError:
+        return []
@@ -0,0 +1,177 @@
+"""
+Local firmware catalog.
+
+Every run records what it resolved, and what it extracted, in a SQLite
+database ({cache_dir}/catalog.sqlite by default), one row per
+(board, fw_type), indexed by board model, ProductID, fw_type, revision
+and SoftwareItemID. The usual questions are then answered locally,
+without scraping the site:
+
+    superbfdl query newer bios 3.4      boards with a BIOS newer than 3.4
+    superbfdl query where X11DPU        where are the files of X11DPU
+    superbfdl query shared              bundles shared by several boards
+    superbfdl query boards 12612        boards using a SoftwareItemID
+
+The database is in WAL mode, so the fleet threads, the dispatch_job
+processes and the queries can use it at the same time.
+"""
+import os
+import re
+import threading
+import time
+
+import superbfdl.cache as cache
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS firmware (
+    board_model TEXT NOT NULL,
+    fw_type TEXT NOT NULL,
+    product_id TEXT,
+    revision TEXT,
+    software_id TEXT,
+    url TEXT,
+    size_kb INTEGER,
+    file TEXT,
+    sha256 TEXT,
+    resolved REAL,
+    PRIMARY KEY (board_model, fw_type)
+);
+CREATE INDEX IF NOT EXISTS firmware_product_id ON firmware (product_id);
+CREATE INDEX IF NOT EXISTS firmware_revision ON firmware (fw_type, revision);
+CREATE INDEX IF NOT EXISTS firmware_software_id ON firmware (software_id);
+"""
+
+# the file of a board is kept as long as the revision does not change
+UPSERT = """
+INSERT INTO firmware (board_model, fw_type, product_id, revision,
+                      software_id, url, size_kb, file, sha256, resolved)
+VALUES (:board_model, :fw_type, :product_id, :revision, :software_id,
+        :url, :size_kb, :file, :sha256, :resolved)
+ON CONFLICT (board_model, fw_type) DO UPDATE SET
+    product_id = excluded.product_id,
+    software_id = excluded.software_id,
+    url = excluded.url,
+    size_kb = excluded.size_kb,
+    resolved = excluded.resolved,
+    file = CASE WHEN excluded.file IS NOT NULL
+                  OR excluded.revision IS NOT firmware.revision
+                THEN excluded.file ELSE firmware.file END,
+    sha256 = CASE WHEN excluded.file IS NOT NULL
+                    OR excluded.revision IS NOT firmware.revision
+                  THEN excluded.sha256 ELSE firmware.sha256 END,
+    revision = excluded.revision
+"""
+
+_settings = {
+    'path': None,
+}
+
+_local = threading.local()
+
+
+def configure(path=None):
+    """
+    Use the catalog at path, None for the default location.
+    """
+    _settings['path'] = path
+
+
+def catalog_path():
+    return _settings['path'] or os.path.join(cache.cache_dir(),
+                                             'catalog.sqlite')
+
+
+def connect():
+    """
+    Returns the connection of the current thread, connections are not
+    shared between threads or with forked processes.
+    """
+    path = catalog_path()
+    key = (os.getpid(), path)
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.key != key:
+        # imported on first use, like requests, see benchmarks/startup.py
+        import sqlite3
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        conn = sqlite3.connect(path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        _local.conn, _local.key = conn, key
+    return conn
+
+
+def version_key(revision):
+    """
+    Sort key of a revision: 3.4 -> (3, 4), 1.73.06 -> (1, 73, 6)
+    """
+    return tuple(int(part) for part in re.findall(r"\d+", revision or ''))
+
+
+def record(board_info, fw_type, file=None, sha256=None):
+    """
+    Add or update the row of a board, from the board_info returned by
+    core.get_board_info. file and sha256 are those of the extracted
+    firmware, when known.
+    """
+    row = {
+        'board_model': board_info['board_model'],
+        'fw_type': fw_type,
+        'product_id': board_info.get('product_id'),
+        'revision': board_info.get(fw_type, {}).get('release'),
+        'software_id': board_info.get('software_id') or None,
+        'url': board_info.get('download_url') or None,
+        'size_kb': board_info.get('size_kb'),
+        'file': os.path.abspath(file) if file else None,
+        'sha256': sha256,
+        'resolved': time.time(),
+    }
+    conn = connect()
+    with conn:
+        conn.execute(UPSERT, row)
+
+
+def newer(fw_type, revision):
+    """
+    Rows of fw_type whose revision is newer than revision.
+    """
+    rows = connect().execute(
+        "SELECT * FROM firmware WHERE fw_type = ? AND revision IS NOT NULL "
+        "ORDER BY board_model", (fw_type, )).fetchall()
+    minimum = version_key(revision)
+    return [row for row in rows if version_key(row['revision']) > minimum]
+
+
+def where(board_model, fw_type=None):
+    """
+    Rows of a board (all fw types unless fw_type is given).
+    """
+    query = "SELECT * FROM firmware WHERE board_model = ?"
+    params = [board_model]
+    if fw_type:
+        query += " AND fw_type = ?"
+        params.append(fw_type)
+    return connect().execute(query + " ORDER BY fw_type", params).fetchall()
+
+
+def boards_of(software_id):
+    """
+    Rows of the boards using the bundle software_id (reverse index).
+    """
+    return connect().execute(
+        "SELECT * FROM firmware WHERE software_id = ? "
+        "ORDER BY board_model, fw_type", (software_id, )).fetchall()
+
+
+def shared():
+    """
+    Returns (software_id, url, boards) for the bundles used by more
+    than one board.
+    """
+    rows = connect().execute(
+        "SELECT software_id, url, group_concat(DISTINCT board_model) "
+        "AS boards FROM firmware WHERE software_id IS NOT NULL "
+        "GROUP BY software_id HAVING count(DISTINCT board_model) > 1 "
+        "ORDER BY software_id").fetchall()
+    return [(row['software_id'], row['url'], sorted(row['boards'].split(',')))
+            for row in rows]
@@ -1,72 +1,632 @@
 import sys
 from pathlib import Path
 import os
-import multiprocessing
+from concurrent.futures import as_completed
 
+import superbfdl.cache as cache
+import superbfdl.catalog as catalog
 import superbfdl.core as core
+import superbfdl.journal as journal
+import superbfdl.manifest as manifest
+import superbfdl.metrics as metrics
+import superbfdl.parser as html_parser
+import superbfdl.ratelimit as ratelimit
+import superbfdl.session as session
 import superbfdl.util as util
+from superbfdl import __version__
+from superbfdl.scheduler import Scheduler, MAX_WORKERS, MAX_PER_HOST
 
+FW_TYPES = ['bios', 'ipmi']
 
-def fw_download(board_model, product_id, output_dir, fw_type):
-    # This path can be a dir we can use to cache all downloaded files
-    dl_path = f"/tmp/downloads/{board_model}/"
 
-    board_path = Path(f"{output_dir}/{board_model}")
+def _stage(scheduler, name, board=None, fw_type=None):
+    if scheduler is None:
+        return metrics.stage(name, board=board, fw_type=fw_type)
+    return scheduler.stage(name, board=board, fw_type=fw_type)
+
 
-    util.mkdir(dl_path)
+def fw_fetch(board_model, product_id, output_dir, fw_type, scheduler=None,
+             sync=False):
+    """
+    Resolve the latest fw_type of a board and fetch its archive.
+    Returns (board_info, pin) when the firmware is still to be extracted
+    (see fw_extract, which releases the pin of the archive), True when
+    it is up to date and None on failure.
+    """
+    board_path = Path(f"{output_dir}/{board_model}")
 
     # 2. Search for the latest bios/firmware information
-    board_info = core.get_board_info(board_model,
-                                     product_id=product_id,
-                                     fw_type=fw_type)
+    with _stage(scheduler, 'metadata', board_model, fw_type):
+        board_info = core.get_board_info(board_model,
+                                         product_id=product_id,
+                                         fw_type=fw_type)
 
     # board_info = core.parse_results(board_info)
+    catalog.record(board_info, fw_type)
     fw_url = board_info['download_url']
+    if not fw_url:
+        print(f"[!] No {fw_type} download found for {board_model}")
+        journal.failed(board_model, fw_type, 'no download found')
+        return None
+    journal.record(board_model, fw_type, 'resolved', url=fw_url,
+                   revision=board_info[fw_type].get('release', ''))
+
+    # in sync mode, skip the firmwares the manifest shows as current
+    if sync and manifest.is_current(board_path, fw_type, board_info):
+        print(f"[*] {board_model} {fw_type} "
+              f"{board_info[fw_type].get('release', '')} is up to date")
+        metrics.incr('up_to_date', fw_type=fw_type)
+        journal.record(board_model, fw_type, 'current')
+        return True
+
+    # download, or reuse the archive from the download cache, pinned
+    # until it is extracted
+    downloads = cache.download_cache()
+    pin = downloads.pin(fw_url)
+    with _stage(scheduler, 'download', board_model, fw_type):
+        fw_zip = downloads.fetch(fw_url, board_info.get('size_kb'))
+    if not fw_zip:
+        downloads.unpin(pin)
+        journal.failed(board_model, fw_type, 'download failed')
+        return None
+    journal.record(board_model, fw_type, 'downloaded')
+    return board_info, pin
 
-    # download
-    fw_zip = util.download_file(fw_url, dl_path)
 
-    # Extract
-    # print(f"[*] Extracting {fw_zip}")
-    util.extract_zip(fw_zip, dl_path)
+def fw_extract(board_model, output_dir, fw_type, board_info, scheduler=None,
+               pin=None):
+    """
+    Extract only the fw_type file from the archive fetched for
+    board_info, straight to the board directory, and add it to the
+    board manifest, then release the pin of the archive. This is the
+    CPU bound part, it runs in the extraction pool in fleet mode.
+    Returns (file path, manifest entry), or None.
+    """
+    board_path = Path(f"{output_dir}/{board_model}")
+    downloads = cache.download_cache()
+    try:
+        with _stage(scheduler, 'extract', board_model, fw_type):
+            fw_path = os.path.join(board_path, fw_type)
+            util.mkdir(fw_path)
+            fw_file = downloads.extract(board_info['download_url'],
+                                        fw_type, fw_path, board_model)
+    finally:
+        downloads.unpin(pin)
+    if not fw_file:
+        journal.failed(board_model, fw_type, 'no matching file')
+        return None
+    journal.record(board_model, fw_type, 'extracted', file=fw_file)
+    return fw_file, manifest.record(board_path, fw_type, board_info, fw_file)
 
-    fw_path = os.path.join(board_path, fw_type)
 
-    util.mkdir(fw_path)
-    fw_file = util.locate_and_move(dl_path, fw_path, fw_type)
+def fw_placed(board_info, fw_type, extracted):
+    """
+    Record the result of fw_extract in the catalog.
+    Returns True when the firmware was extracted, None otherwise.
+    """
+    if not extracted:
+        return None
+    fw_file, entry = extracted
+    catalog.record(board_info, fw_type, file=fw_file, sha256=entry['sha256'])
+    journal.record(board_info['board_model'], fw_type, 'placed')
+    print(f"[*] The new {fw_type} is located at {fw_file}")
+    return True
 
-    if fw_file:
-        print(f"[*] The new {fw_type} is located at {fw_file}")
-        return True
-    return None
 
+def fw_download(board_model, product_id, output_dir, fw_type, scheduler=None,
+                sync=False):
+    fetched = fw_fetch(board_model, product_id, output_dir, fw_type,
+                       scheduler=scheduler, sync=sync)
+    if not isinstance(fetched, tuple):
+        return fetched
+    board_info, pin = fetched
+    return fw_placed(board_info, fw_type,
+                     fw_extract(board_model, output_dir, fw_type, board_info,
+                                scheduler=scheduler, pin=pin))
+
+
+def fw_fetch_job(extractor, board_model, product_id, output_dir, fw_type,
+                 scheduler=None, sync=False):
+    """
+    Network half of fw_download: the archive is handed to the
+    extraction pool, and the worker moves on to the next download.
+    Returns (board_info, future of fw_extract) or the result of
+    fw_fetch when there is nothing to extract.
+    """
+    fetched = fw_fetch(board_model, product_id, output_dir, fw_type,
+                       scheduler=scheduler, sync=sync)
+    if not isinstance(fetched, tuple):
+        return fetched
+    board_info, pin = fetched
+    return board_info, extractor.submit(fw_extract, board_model, output_dir,
+                                        fw_type, board_info, None, pin)
+
+
+def _fw_download_process(*args):
+    """
+    Runs fw_download in a child process, and returns its metrics with
+    the result so the parent can merge them.
+    """
+    metrics.registry().reset()
+    try:
+        result = fw_download(*args)
+    except Exception as e:  # noqa
+        print(f"[!] {args[3]} failed for {args[0]}: {e}")
+        journal.failed(args[0], args[3], e)
+        result = None
+    return result, metrics.registry().snapshot()
+
+
+def dispatch_job(board_model, output_dir, refresh_ids=False, sync=False,
+                 skip=()):
+    fw_types = [fw for fw in FW_TYPES if (board_model, fw) not in skip]
+    if not fw_types:
+        print(f"[*] {board_model} is already done")
+        return
 
-def dispatch_job(board_model, output_dir):
     # 1. Take the board, and search for the ProductID
-    product_id = core.query_product_id(board_model)
+    try:
+        with metrics.stage('lookup', board_model):
+            product_id = core.query_product_id(board_model,
+                                               refresh=refresh_ids)
+    except Exception as e:  # noqa
+        print(f"[!] Lookup failed for {board_model}: {e}")
+        journal.failed(board_model, None, e)
+        return
 
     if not product_id:
+        journal.failed(board_model, None, 'no ProductID')
         return
 
     print(f"[*] Product ID: {product_id}")
-    fw_type = ['bios', 'ipmi']
     jobs = []
 
-    for fw in fw_type:
+    # one process per fw type, forked like the multiprocessing.Process
+    # it replaces (the default on linux): the children inherit the cache,
+    # journal and rate limit settings, which spawn would reset, and the
+    # parent runs no threads here
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    context = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(max_workers=len(fw_types),
+                             mp_context=context) as executor:
+        for fw in fw_types:
+            jobs.append(executor.submit(_fw_download_process, board_model,
+                                        product_id, output_dir, fw, None,
+                                        sync))
+
+        for job in jobs:
+            _result, snapshot = job.result()
+            metrics.registry().merge(snapshot)
+
+
+def read_board_list(file_name):
+    """
+    Read a list of boards, one per line. Empty lines, comments (#) and
+    duplicated boards are skipped.
+    """
+    boards = []
+    with open(file_name) as bfile:
+        for line in bfile:
+            board = line.split('#', 1)[0].strip()
+            if board and board not in boards:
+                boards.append(board)
+    return boards
+
+
+def lookup_job(scheduler, board_model, refresh_ids=False):
+    with scheduler.stage('lookup', board_model):
+        return core.query_product_id(board_model, refresh=refresh_ids)
+
+
+def dispatch_fleet(boards, output_dir, max_workers=MAX_WORKERS,
+                   per_host=MAX_PER_HOST, refresh_ids=False, sync=False,
+                   extract_workers=None, skip=()):
+    """
+    Run the lookup, metadata, download and extraction stages for all
+    boards through one shared scheduler. With sync, the firmwares
+    already current in output_dir are not downloaded again. The
+    (board, fw_type) jobs in skip are done already (see
+    journal.completed), they are counted as successful.
+
+    The extraction runs in a pool of extract_workers processes (one per
+    core by default, see pipeline.ExtractPool), with 0 it runs in the
+    network workers.
+
+    The requests per host are limited by the adaptive limiters of
+    ratelimit, per_host is their maximum concurrency.
+
+    Returns a dict mapping each board to a dict of fw_type: success.
+    """
+    from concurrent.futures import wait, FIRST_COMPLETED
+
+    ratelimit.configure(max_concurrency=per_host)
+    scheduler = Scheduler(max_workers=max_workers, per_host=per_host)
+    extractor = None
+    if extract_workers != 0:
+        from superbfdl.pipeline import ExtractPool, EXTRACT_WORKERS
+        extractor = ExtractPool(max_workers=extract_workers or EXTRACT_WORKERS,
+                                scheduler=scheduler)
+    results = {board: {fw: True for fw in FW_TYPES if (board, fw) in skip}
+               for board in boards}
+    try:
+        lookups = {
+            scheduler.submit(lookup_job, scheduler, board, refresh_ids): board
+            for board in boards if len(results[board]) < len(FW_TYPES)
+        }
+        downloads = {}
+        for future in as_completed(lookups):
+            board = lookups[future]
+            try:
+                product_id = future.result()
+            except Exception as e:  # noqa
+                print(f"[!] Lookup failed for {board}: {e}")
+                journal.failed(board, None, e)
+                results[board] = None
+                continue
+            if not product_id:
+                journal.failed(board, None, 'no ProductID')
+                results[board] = None
+                continue
+            print(f"[*] Product ID for {board}: {product_id}")
+            for fw in FW_TYPES:
+                if fw in results[board]:
+                    continue
+                if extractor is None:
+                    job = scheduler.submit(fw_download, board, product_id,
+                                           output_dir, fw, scheduler, sync)
+                else:
+                    job = scheduler.submit(fw_fetch_job, extractor, board,
+                                           product_id, output_dir, fw,
+                                           scheduler, sync)
+                downloads[job] = (board, fw)
+
+        # the extractions are collected as they complete, along with the
+        # downloads still running
+        extractions = {}
+        pending = set(downloads)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in extractions:
+                    board, fw, board_info = extractions[future]
+                    try:
+                        results[board][fw] = bool(fw_placed(
+                            board_info, fw, extractor.result(future)))
+                    except Exception as e:  # noqa
+                        print(f"[!] Extraction of {fw} failed for "
+                              f"{board}: {e}")
+                        journal.failed(board, fw, e)
+                        results[board][fw] = False
+                    continue
+                board, fw = downloads[future]
+                try:
+                    result = future.result()
+                except Exception as e:  # noqa
+                    print(f"[!] {fw} failed for {board}: {e}")
+                    journal.failed(board, fw, e)
+                    results[board][fw] = False
+                    continue
+                if isinstance(result, tuple):
+                    board_info, extraction = result
+                    extractions[extraction] = (board, fw, board_info)
+                    pending.add(extraction)
+                else:
+                    results[board][fw] = bool(result)
+    finally:
+        scheduler.shutdown()
+        if extractor is not None:
+            extractor.shutdown()
+
+    scheduler.report(results)
+    return results
+
+
+def _print_rows(rows, columns, as_json=False):
+    if as_json:
+        import json
+        for row in rows:
+            print(json.dumps({c: row[c] for c in columns}))
+        return
+    for row in rows:
+        print("  ".join(str(row[c]) if row[c] is not None else "-"
+                        for c in columns))
+
+
+def query_main(argv):
+    """
+    superbfdl query: answer from the local catalog, without any request.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog="superbfdl query")
+    parser.add_argument(
+        "--cache-dir",
+        default=cache.CACHE_DIR,
+        help="Directory where the caches are stored")
+    parser.add_argument(
+        "--catalog",
+        help="Catalog database (default: catalog.sqlite in --cache-dir)")
+    parser.add_argument(
+        "--json",
+        action="store_true",
+        help="Print one JSON object per line")
+    commands = parser.add_subparsers(dest="command", required=True)
+    newer = commands.add_parser(
+        "newer", help="Boards with a firmware newer than a revision")
+    newer.add_argument("fw_type", choices=FW_TYPES)
+    newer.add_argument("revision")
+    where = commands.add_parser(
+        "where", help="Where the firmware files of a board are")
+    where.add_argument("board")
+    where.add_argument("fw_type", nargs="?", choices=FW_TYPES)
+    commands.add_parser(
+        "shared", help="Bundles (SoftwareItemID) shared by several boards")
+    boards = commands.add_parser(
+        "boards", help="Boards using a bundle (SoftwareItemID)")
+    boards.add_argument("software_id")
+    args = parser.parse_args(argv)
+
+    cache.configure(cache_dir=args.cache_dir)
+    catalog.configure(args.catalog)
+    if args.command == "newer":
+        _print_rows(catalog.newer(args.fw_type, args.revision),
+                    ('board_model', 'revision', 'software_id', 'url'),
+                    args.json)
+    elif args.command == "where":
+        rows = catalog.where(args.board, args.fw_type)
+        if not rows:
+            print(f"[!] {args.board} is not in the catalog")
+            return 1
+        _print_rows(rows, ('board_model', 'fw_type', 'revision', 'file'),
+                    args.json)
+    elif args.command == "shared":
+        rows = [dict(zip(('software_id', 'url', 'boards'), row))
+                for row in catalog.shared()]
+        for row in rows:
+            row['boards'] = ",".join(row['boards'])
+        _print_rows(rows, ('software_id', 'url', 'boards'), args.json)
+    elif args.command == "boards":
+        _print_rows(catalog.boards_of(args.software_id),
+                    ('board_model', 'fw_type', 'revision', 'file'),
+                    args.json)
+    return 0
+
+
+def cache_main(argv):
+    """
+    superbfdl cache: drop entries of the caches, see superbfdl.cache.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog="superbfdl cache")
+    parser.add_argument(
+        "--cache-dir",
+        default=cache.CACHE_DIR,
+        help="Directory where the caches are stored")
+    commands = parser.add_subparsers(dest="command", required=True)
+    invalidate = commands.add_parser(
+        "invalidate",
+        help="Drop cached ProductIDs (by board), results pages (by "
+        "ProductID) or downloads (by SoftwareItemID), all of them when "
+        "no key is given")
+    invalidate.add_argument("name", choices=("ids", "metadata", "downloads"))
+    invalidate.add_argument("keys", nargs="*")
+    args = parser.parse_args(argv)
+
+    cache.configure(cache_dir=args.cache_dir)
+    dropped = cache.invalidate(args.name, args.keys)
+    print(f"[*] Dropped {dropped} {args.name} entries from {args.cache_dir}")
+    return 0
+
+
+def daemon_main(argv):
+    """
+    superbfdl daemon: keep a local mirror of a board list up to date and
+    serve it, see superbfdl.daemon.
+    """
+    import argparse
+    from superbfdl import daemon
+    parser = argparse.ArgumentParser(prog="superbfdl daemon")
+    parser.add_argument(
+        "-f", "--file", help="File containing the list of watched boards")
+    parser.add_argument(
+        "-p", "--path", required=True, help="Directory of the mirror")
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=daemon.INTERVAL,
+        help="Seconds between two polls of the board list")
+    parser.add_argument(
+        "--window",
+        help="Only poll the vendor site in this off-peak window "
+        "(HH:MM-HH:MM, local time)")
+    parser.add_argument(
+        "--listen",
+        default=daemon.LISTEN,
+        help="Address the mirror is served on (host:port)")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=MAX_WORKERS)
+    parser.add_argument(
+        "--per-host", type=int, default=MAX_PER_HOST)
+    parser.add_argument(
+        "--rate", type=float, default=ratelimit.RATE)
+    parser.add_argument(
+        "--max-rate", type=float, default=ratelimit.MAX_RATE)
+    parser.add_argument(
+        "--cache-dir", default=cache.CACHE_DIR)
+    parser.add_argument(
+        "--catalog")
+    args = parser.parse_args(argv)
+
+    interval = args.interval
+    session.configure(pool_size=max(args.jobs, session.POOL_SIZE))
+    ratelimit.configure(rate=args.rate, max_rate=args.max_rate,
+                        max_concurrency=args.per_host)
+    # revalidate the metadata on every poll, it is cheap (ETag)
+    cache.configure(cache_dir=args.cache_dir,
+                    metadata_ttl=min(cache.METADATA_TTL, interval))
+    catalog.configure(args.catalog)
+    util.mkdir(args.path)
+    mirror = daemon.Mirror(args.file, args.path, interval=interval,
+                           window=daemon.parse_window(args.window),
+                           max_workers=args.jobs, per_host=args.per_host)
+    daemon.serve(mirror, args.listen)
+    return 0
+
 
-        mp = multiprocessing.Process(target=fw_download,
-                                     args=(board_model, product_id, output_dir,
-                                           fw))
-        jobs.append(mp)
-        mp.start()
+def worker_job(task, output_dir, refresh_ids=False, sync=False):
+    """
+    Run a task of the work queue (see workqueue.Worker): the lookup of
+    its board, then fw_download for each of its fw_types.
+    Returns a dict of fw_type: success. A failed lookup raises, so the
+    task is tried again.
+    """
+    board = task['board']
+    with metrics.stage('lookup', board):
+        product_id = core.query_product_id(board, refresh=refresh_ids)
+    if not product_id:
+        raise LookupError(f"No ProductID found for {board}")
+    results = {}
+    for fw in task['fw_types']:
+        results[fw] = bool(fw_download(board, product_id, output_dir, fw,
+                                       sync=sync))
+    return results
+
+
+def coordinate_main(argv):
+    """
+    superbfdl coordinate: split a board list into tasks of a work queue
+    shared by the workers of several hosts, see superbfdl.workqueue.
+    """
+    import argparse
+    from superbfdl import workqueue
+    parser = argparse.ArgumentParser(prog="superbfdl coordinate")
+    parser.add_argument(
+        "-f", "--file", required=True, help="File containing a list of Boards")
+    parser.add_argument(
+        "--queue", required=True, help="Queue directory, shared by the hosts")
+    parser.add_argument(
+        "--split",
+        choices=("board", "artifact"),
+        default="board",
+        help="One task per board, or per board and fw type")
+    parser.add_argument(
+        "--max-attempts",
+        type=int,
+        default=workqueue.MAX_ATTEMPTS,
+        help="Runs of a task whose lease expired before it is given up")
+    parser.add_argument(
+        "--wait",
+        action="store_true",
+        help="Wait for the workers, requeue the expired leases and print "
+        "the results")
+    args = parser.parse_args(argv)
+
+    queue = workqueue.WorkQueue(args.queue, max_attempts=args.max_attempts)
+    if not queue.empty():
+        counts = queue.counts()
+        print(f"[!] {args.queue} still has {counts['pending']} pending and "
+              f"{counts['claimed']} running tasks")
+        return 1
+    queue.reset()
+    ids = queue.submit_boards(read_board_list(args.file), FW_TYPES,
+                              split=args.split)
+    print(f"[*] Queued {len(ids)} tasks in {args.queue}")
+    if not args.wait:
+        return 0
+
+    failed = 0
+    for task_id, done in sorted(workqueue.wait(queue).items()):
+        result = done['result']
+        if 'error' in result or not all(result.values()):
+            failed += 1
+            print(f"    {task_id}: {result} ({done['attempts']} attempts, "
+                  f"last on {done['worker']})")
+    print(f"[*] Processed {len(ids)} tasks, {failed} with failures")
+    return 1 if failed else 0
+
+
+def worker_main(argv):
+    """
+    superbfdl worker: run the tasks of a work queue, see
+    superbfdl.workqueue.
+    """
+    import argparse
+    from superbfdl import workqueue
+    parser = argparse.ArgumentParser(prog="superbfdl worker")
+    parser.add_argument(
+        "--queue", required=True, help="Queue directory, shared by the hosts")
+    parser.add_argument(
+        "-p", "--path", required=True,
+        help="Directory where to save the downloaded bios/ipmi")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="Number of tasks run at the same time")
+    parser.add_argument(
+        "--lease",
+        type=float,
+        default=workqueue.LEASE,
+        help="Seconds before the task of a silent worker is given to "
+        "another one")
+    parser.add_argument(
+        "--max-attempts", type=int, default=workqueue.MAX_ATTEMPTS)
+    parser.add_argument(
+        "--forever",
+        action="store_true",
+        help="Keep waiting for new tasks when the queue is empty")
+    parser.add_argument(
+        "--per-host", type=int, default=MAX_PER_HOST)
+    parser.add_argument(
+        "--rate", type=float, default=ratelimit.RATE)
+    parser.add_argument(
+        "--max-rate", type=float, default=ratelimit.MAX_RATE)
+    parser.add_argument(
+        "--cache-dir", default=cache.CACHE_DIR)
+    parser.add_argument(
+        "--catalog")
+    parser.add_argument(
+        "--refresh-ids", action="store_true")
+    parser.add_argument(
+        "--sync", action="store_true")
+    args = parser.parse_args(argv)
+
+    session.configure(pool_size=max(args.jobs, session.POOL_SIZE))
+    ratelimit.configure(rate=args.rate, max_rate=args.max_rate,
+                        max_concurrency=args.per_host)
+    cache.configure(cache_dir=args.cache_dir)
+    catalog.configure(args.catalog)
+    util.mkdir(args.path)
+    queue = workqueue.WorkQueue(args.queue, lease=args.lease,
+                                max_attempts=args.max_attempts)
+
+    def run(task):
+        return worker_job(task, args.path, refresh_ids=args.refresh_ids,
+                          sync=args.sync)
 
-    for j in jobs:
-        j.join()
+    workqueue.Worker(queue, run, jobs=args.jobs).run(forever=args.forever)
+    return 0
 
 
 def main(*argv):
+    import logging
+    logging.basicConfig(level=logging.INFO)
+    if sys.argv[1:2] == ['query']:
+        return query_main(sys.argv[2:])
+    if sys.argv[1:2] == ['cache']:
+        return cache_main(sys.argv[2:])
+    if sys.argv[1:2] == ['daemon']:
+        return daemon_main(sys.argv[2:])
+    if sys.argv[1:2] == ['coordinate']:
+        return coordinate_main(sys.argv[2:])
+    if sys.argv[1:2] == ['worker']:
+        return worker_main(sys.argv[2:])
+
     import argparse
     parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-V",
+        "--version",
+        action="version",
+        version=f"superbfdl {__version__}")
     group = parser.add_mutually_exclusive_group()
     group.add_argument("-b", "--board", help="Motherboard Model")
     group.add_argument("-f", "--file", help="File containing a list of Boards")
@@ -75,17 +635,212 @@ def main(*argv):
         "--path",
         default="/tmp",
         help="Directory where to save the downloaded bios/ipmi")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=MAX_WORKERS,
+        help="Maximum number of concurrent jobs when using --file")
+    parser.add_argument(
+        "--per-host",
+        type=int,
+        default=MAX_PER_HOST,
+        help="Maximum number of concurrent requests per host, the limit "
+        "grows up to it while the server keeps up")
+    parser.add_argument(
+        "--extract-jobs",
+        type=int,
+        help="Number of extraction processes when using --file (default: "
+        "one per core, 0 extracts in the download jobs)")
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=ratelimit.RATE,
+        help="Initial requests per second per host, raised while the "
+        "server keeps up and lowered when it pushes back (0 for no limit)")
+    parser.add_argument(
+        "--max-rate",
+        type=float,
+        default=ratelimit.MAX_RATE,
+        help="Hard cap on the requests per second per host (default: none)")
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=session.TIMEOUT[1],
+        help="Seconds to wait for the server before giving up")
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=session.RETRIES,
+        help="Number of retries for failed requests")
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        help="Number of keep-alive connections per host "
+        "(defaults to --jobs)")
+    parser.add_argument(
+        "--cache-dir",
+        default=cache.CACHE_DIR,
+        help="Directory where the caches are stored")
+    parser.add_argument(
+        "--catalog",
+        help="Catalog database filled by every run (default: "
+        "catalog.sqlite in --cache-dir), see 'superbfdl query -h'")
+    parser.add_argument(
+        "--cache-size",
+        type=float,
+        default=cache.DOWNLOAD_CACHE_SIZE / 1024 ** 3,
+        help="Maximum size in GiB of the downloaded files cache")
+    parser.add_argument(
+        "--verify-cache",
+        action="store_true",
+        help="Hash the cached downloads before using them, not only the "
+        "ones whose size or mtime changed")
+    parser.add_argument(
+        "--segments",
+        type=int,
+        default=util.SEGMENTS,
+        help="Number of parallel byte ranges used to download big files")
+    parser.add_argument(
+        "--extract-memory",
+        type=float,
+        default=util.NESTED_MEMORY_LIMIT / 1024 ** 2,
+        help="MiB of nested zip files opened in memory per archive, the "
+        "bigger ones go through a temporary file")
+    parser.add_argument(
+        "--id-ttl",
+        type=float,
+        default=cache.PRODUCT_ID_TTL / 86400,
+        help="Days before a cached ProductID is looked up again")
+    parser.add_argument(
+        "--refresh-ids",
+        action="store_true",
+        help="Ignore the cached ProductIDs and query them again")
+    parser.add_argument(
+        "--metadata-ttl",
+        type=float,
+        default=cache.METADATA_TTL / 3600,
+        help="Hours during which the cached bios/ipmi information is used "
+        "without asking the server (0 always revalidates)")
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        help="Only download the firmwares whose revision changed since "
+        "the last run (see the manifest.json of each board)")
+    parser.add_argument(
+        "--journal",
+        help="Record the progress of every job in this file (default: "
+        "journal.jsonl in --path)")
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip the jobs the journal shows as done, and retry the "
+        "failed or interrupted ones")
+    parser.add_argument(
+        "--parser",
+        dest="html_parser",
+        choices=html_parser.BACKENDS,
+        default=html_parser.get_backend(),
+        help="HTML parser backend")
+    parser.add_argument(
+        "--metrics",
+        help="Write per-stage durations and counters to this file at the "
+        "end of the run")
+    parser.add_argument(
+        "--metrics-format",
+        choices=metrics.FORMATS,
+        help="Format of the --metrics file: JSON lines or Prometheus "
+        "textfile (default: from the file extension, .prom or jsonl)")
+    parser.add_argument(
+        "--profile",
+        help="Run under cProfile and save the stats to this file")
+    parser.add_argument(
+        "--server",
+        help="Get the firmwares from a mirror daemon (superbfdl daemon) "
+        "at this url instead of the vendor site")
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="Use the asyncio engine (needs aiohttp), --jobs is then the "
+        "number of requests in flight")
     args = parser.parse_args()
+    if (args.journal or args.resume) and (args.server or args.use_async):
+        # the mirror and the asyncio engine do not record their jobs
+        parser.error("--journal and --resume do not work with --server "
+                     "or --async")
+    session.configure(pool_size=args.pool_size or max(args.jobs,
+                                                      session.POOL_SIZE),
+                      timeout=(session.TIMEOUT[0], args.timeout),
+                      retries=args.retries)
+    ratelimit.configure(rate=args.rate, max_rate=args.max_rate,
+                        max_concurrency=args.per_host)
+    util.configure_download(segments=args.segments)
+    util.configure_extract(memory_limit=int(args.extract_memory * 1024 ** 2))
+    html_parser.set_backend(args.html_parser)
+    cache.configure(cache_dir=args.cache_dir,
+                    product_id_ttl=args.id_ttl * 86400,
+                    metadata_ttl=args.metadata_ttl * 3600,
+                    download_cache_size=int(args.cache_size * 1024 ** 3),
+                    verify_downloads=args.verify_cache)
+    catalog.configure(args.catalog)
     if not args.path:
         args.path = "."
     output_dir = Path(args.path)
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    if args.board:
-        board = args.board
-        dispatch_job(board, output_dir)
+    registry = metrics.registry()
+    registry.profiling = bool(args.profile)
+    try:
+        registry.profiled(run_command)(args, output_dir)
+    finally:
+        if args.metrics:
+            registry.write(args.metrics, fmt=args.metrics_format)
+            print(f"[*] Metrics written to {args.metrics}")
+        if args.profile:
+            print(registry.write_profile(args.profile))
+            print(f"[*] Profile written to {args.profile}")
+
+
+def run_command(args, output_dir):
+    if args.server and (args.board or args.file):
+        from superbfdl.daemon import fetch_from
+        boards = [args.board] if args.board else read_board_list(args.file)
+        fetch_from(args.server, boards, output_dir)
+    elif args.use_async and (args.board or args.file):
+        from superbfdl.aio import dispatch_async
+        boards = [args.board] if args.board else read_board_list(args.file)
+        dispatch_async(boards, output_dir, refresh_ids=args.refresh_ids,
+                       sync=args.sync, concurrency=args.jobs,
+                       per_host=args.per_host,
+                       timeout=(session.TIMEOUT[0], args.timeout),
+                       retries=args.retries)
+    elif args.board or args.file:
+        boards = [args.board] if args.board else read_board_list(args.file)
+        journal.configure(args.journal or
+                          os.path.join(output_dir, journal.JOURNAL))
+        skip = journal.completed() if args.resume else set()
+        if skip:
+            print(f"[*] Resuming, {len(skip)} jobs are already done")
+        journal.start(resume=args.resume)
+        if args.board and args.profile:
+            # the profiler does not follow forked processes, use one thread
+            dispatch_fleet(boards, output_dir, max_workers=1,
+                           per_host=args.per_host,
+                           refresh_ids=args.refresh_ids, sync=args.sync,
+                           extract_workers=0, skip=skip)
+        elif args.board:
+            dispatch_job(args.board, output_dir,
+                         refresh_ids=args.refresh_ids, sync=args.sync,
+                         skip=skip)
+        else:
+            dispatch_fleet(boards, output_dir, max_workers=args.jobs,
+                           per_host=args.per_host,
+                           refresh_ids=args.refresh_ids, sync=args.sync,
+                           extract_workers=args.extract_jobs, skip=skip)
+        journal.report()
 
 
 if __name__ == '__main__':
-    main(*sys.argv)
+    sys.exit(main(*sys.argv))
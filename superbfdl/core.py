@@ -4,10 +4,10 @@
 import logging
 import re
 
-import requests
-from bs4 import BeautifulSoup
+import superbfdl.cache as cache
+import superbfdl.parser as parser
+import superbfdl.session as session
 
-logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 
 SUPERMICRO_URL = "https://www.supermicro.com"
@@ -18,39 +18,103 @@ FW_ENDPOINT = {
 }
 
 
-def query_product_id(board_model):
+def parse_product_id(html):
+    """
+    Returns the value of the hidden ProductID input of a motherboard
+    page.
+    """
+    product_id = parser.find_product_id(html)
+    if not product_id:
+        raise ValueError("No ProductID found in the page")
+    return product_id
+
+
+def parse_results_page(html):
+    """
+    Parses the table of a results.aspx/firmware.aspx page into a dict
+    of rows, plus the 'download_url' and 'software_id' of the zip file.
+    """
+    regex = re.compile(r"[Ss]oftware[Ii]tem[Ii][Dd]=(?P<pid>\d*)")
+
+    results = {}
+
+    results['download_url'] = ''
+    results['software_id'] = ''
+
+    for key_text, value_text, a_link in parser.find_rows(html):
+        key_name = key_text.replace(':', '').strip()
+        results[key_name] = value_text.strip()
+        if a_link:
+            file_name, href = a_link
+            # href: /about/policies/disclaimer.cfm?SoftwareItemID=12558
+            match = regex.search(href or '')
+            if match and file_name.endswith('zip'):
+                software_id = match['pid']
+                results['software_id'] = software_id
+                results['download_url'] = (f"{SUPERMICRO_URL}/Bios/softfiles/"
+                                           f"{software_id}/{file_name}")
+    return results
+
+
+def query_product_id(board_model, refresh=False):
     """
     Parses the motherboard html page and retrieve
-    the ProductID
+    the ProductID.
+    The ProductID is cached on disk, use refresh=True to ignore
+    the cached value.
     """
+    product_ids = cache.product_id_cache()
+    if not refresh:
+        product_id = product_ids.get(board_model)
+        if product_id:
+            print(f'[*] Using cached ProductID for board {board_model}')
+            return product_id
+
     print(f'[*] Querying for ProductID matching board {board_model}')
 
     url = f"{SUPERMICRO_URL}/en/products/motherboard/{board_model}"
+    page = session.get(url)
+    # throttled or failing site: raise, the board is not unknown
+    if page.status_code in session.RETRY_STATUS:
+        session.check_status(page)
     try:
-        page = requests.get(url)
         if page.status_code != 200:
             raise ValueError(f"Get wrong response from {url}")
-        soup = BeautifulSoup(page.text, 'html.parser')
-        product_id = soup.find('input', {'name': 'ProductID'}).get('value')
+        product_id = parse_product_id(page.text)
 
     except Exception as e:
         log.debug(e)
         log.error(f"Could not find Product ID for {board_model} ")
         return
+    product_ids.put(board_model, product_id)
     return product_id
 
 
-def get_board_info(board_model, product_id, fw_type):
+def fetch_results(board_model, product_id, fw_type, refresh=False):
     """
-    Submit a post request to the bios resource website and retrieve
-    the information about the latest bios.
-    The information returned includes the download link to be used
-    to get the bios file.
+    Submit a post request to the bios resource website and return the
+    rows of the results table as a dict, plus the 'download_url' and
+    'software_id' of the firmware zip file.
+
+    Results are cached per (ProductID, fw_type). Within the freshness
+    window the cached rows are returned without any request, after it
+    the page is revalidated with ETag/Last-Modified when the server
+    provided them. Use refresh=True to bypass the cache.
     """
     if fw_type not in ['bios', 'ipmi']:
         raise ValueError('fw_type should be "bios" or "ipmi", {} given'.format(
             type(fw_type)))
 
+    metadata = cache.metadata_cache()
+    key = cache.metadata_key(product_id, fw_type)
+    entry = None
+    if not refresh:
+        results = metadata.get(key)
+        if results is not None:
+            print(f"[*] Using cached {fw_type} information for {board_model}")
+            return results
+        entry = metadata.entry(key)
+
     url = f"{SUPERMICRO_URL}/{FW_ENDPOINT[fw_type]}"
 
     payload = {
@@ -59,32 +123,28 @@ def get_board_info(board_model, product_id, fw_type):
         "Resource": "BIOS"
     }
 
-    page = requests.post(url, data=payload)
-
-    soup = BeautifulSoup(page.text, 'html.parser')
+    page = session.post(url, data=payload,
+                        headers=cache.conditional_headers(entry))
 
-    regex = re.compile(r"[Ss]oftware[Ii]tem[Ii][DD]=(?P<pid>\d*)")
+    if page.status_code == 304 and entry:
+        print(f"[*] {fw_type} information for {board_model} did not change")
+        metadata.put(key, entry['value'], etag=entry.get('etag'),
+                     last_modified=entry.get('last_modified'))
+        return entry['value']
 
-    results = {}
+    session.check_status(page)
+    results = parse_results_page(page.text)
+    print(results)
 
-    results['download_url'] = ''
+    metadata.put(key, results, **cache.validators(page))
+    return results
 
-    for row in soup.find_all('tr', {"class": "textA"}):
-        columns = row.findAll('td')
-        key_name = columns[0].text.replace(':', '').strip()
-        results[key_name] = columns[1].text.strip()
-        a_link = columns[1].find('a')
-        if a_link:
-            file_name = a_link.text
-            href = a_link.attrs['href']
-            # href: /about/policies/disclaimer.cfm?SoftwareItemID=12558
-            match = regex.search(href)
-            if match and file_name.endswith('zip'):
-                software_id = match['pid']
-                results['download_url'] = (f"{SUPERMICRO_URL}/Bios/softfiles/"
-                                           f"{software_id}/{file_name}")
-    print(results)
 
+def parse_results(board_model, product_id, fw_type, results):
+    """
+    Turn the rows returned by fetch_results into the board information
+    (revision, download url, ...).
+    """
     data = {}
     data[fw_type] = {}
     for key, value in results.items():
@@ -107,7 +167,15 @@ def get_board_info(board_model, product_id, fw_type):
         if 'Firmware Release Note' in key:
             data['ipmi_release_note'] = value
 
+        # Size (KB): 75,401
+        if 'Size' in key:
+            try:
+                data['size_kb'] = int(value.replace(',', ''))
+            except ValueError:
+                pass
+
     data['download_url'] = results['download_url']
+    data['software_id'] = results.get('software_id', '')
     data['product_id'] = product_id
     data['board_model'] = board_model
 
@@ -126,3 +194,15 @@ def get_board_info(board_model, product_id, fw_type):
 
     print(data)
     return data
+
+
+def get_board_info(board_model, product_id, fw_type, refresh=False):
+    """
+    Submit a post request to the bios resource website and retrieve
+    the information about the latest bios.
+    The information returned includes the download link to be used
+    to get the bios file.
+    """
+    results = fetch_results(board_model, product_id, fw_type,
+                            refresh=refresh)
+    return parse_results(board_model, product_id, fw_type, results)
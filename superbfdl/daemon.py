@@ -0,0 +1,363 @@
+"""
+Mirror daemon.
+
+The daemon keeps a local mirror of the firmwares of a watched board
+list, so that the clients get them from disk instead of waiting for the
+vendor site:
+
+    superbfdl daemon -f boards.txt -p /srv/firmware --interval 3600 \\
+        --window 01:00-05:00 --listen 127.0.0.1:8765
+
+Every `interval` seconds (and only inside the optional off-peak
+window), the board list is read again and run through
+cli.dispatch_fleet in sync mode: the metadata is revalidated, and only
+the new revisions are downloaded and extracted into the mirror.
+
+The mirror is served over local HTTP:
+
+    GET /firmware/<board>          the manifest of the board (JSON), a
+                                   board not mirrored yet is fetched
+                                   first and added to the watch list
+                                   (202 while the fetch runs)
+    GET /file/<board>/<fw_type>    the firmware file
+    GET /status                    last poll, watched boards
+
+and the client side is `superbfdl --server http://127.0.0.1:8765 -b
+X11DPU -p /tmp`, which hardlinks the files from the mirror when it is on
+the same host, and downloads them from the daemon otherwise.
+"""
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+import superbfdl.integrity as integrity
+import superbfdl.manifest as manifest
+import superbfdl.matcher as matcher
+import superbfdl.session as session
+import superbfdl.util as util
+
+INTERVAL = 3600
+LISTEN = "127.0.0.1:8765"
+# board models accepted from the clients
+BOARD_REGEX = r"[A-Za-z0-9][\w.+\-]*"
+# boards fetched on demand at the same time
+FETCH_WORKERS = 2
+# seconds a client request waits for an on-demand fetch, before a 202
+FETCH_WAIT = 30
+# seconds a board with no firmware is answered 404 without a new fetch
+FAILED_TTL = 600
+
+# ensure() result while the fetch of the board runs
+PENDING = object()
+
+
+def parse_window(window):
+    """
+    'HH:MM-HH:MM' -> ((h, m), (h, m)), None when window is empty.
+    """
+    if not window:
+        return None
+    match = re.match(r"^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})$", window)
+    if not match:
+        raise ValueError(f"window should be HH:MM-HH:MM, {window} given")
+    h1, m1, h2, m2 = (int(v) for v in match.groups())
+    return (h1, m1), (h2, m2)
+
+
+def in_window(window, now=None):
+    if window is None:
+        return True
+    now = now or datetime.now()
+    start, end = window
+    current = (now.hour, now.minute)
+    if start <= end:
+        return start <= current < end
+    # the window crosses midnight
+    return current >= start or current < end
+
+
+class Mirror(object):
+    """
+    The watched boards and the mirror directory. The polls and the
+    on-demand fetches go through cli.dispatch_fleet in sync mode.
+    """
+    def __init__(self, board_file, path, interval=INTERVAL, window=None,
+                 fetch_wait=FETCH_WAIT, failed_ttl=FAILED_TTL,
+                 **fleet_args):
+        self.board_file = board_file
+        self.path = os.path.abspath(path)
+        self.interval = interval
+        self.window = window
+        self.fetch_wait = fetch_wait
+        self.failed_ttl = failed_ttl
+        self.fleet_args = fleet_args
+        self.extra_boards = []
+        self.last_poll = None
+        self.last_results = {}
+        self._lock = threading.Lock()
+        # board: future of its on-demand fetch, while it runs
+        self._fetching = {}
+        # board: time its last on-demand fetch found nothing
+        self._failed = {}
+        self._fetcher = ThreadPoolExecutor(max_workers=FETCH_WORKERS,
+                                           thread_name_prefix='fetch')
+        self._stop = threading.Event()
+
+    def boards(self):
+        from superbfdl.cli import read_board_list
+        boards = read_board_list(self.board_file) if self.board_file else []
+        with self._lock:
+            return boards + [b for b in self.extra_boards if b not in boards]
+
+    def sync(self, boards):
+        from superbfdl.cli import dispatch_fleet
+        return dispatch_fleet(boards, self.path, sync=True,
+                              **self.fleet_args)
+
+    def poll(self):
+        boards = self.boards()
+        print(f"[*] Polling {len(boards)} boards")
+        results = self.sync(boards)
+        with self._lock:
+            self.last_poll = time.time()
+            self.last_results = results
+        return results
+
+    def run(self):
+        """
+        Poll every interval seconds, inside the window, until stop().
+        """
+        while not self._stop.is_set():
+            if in_window(self.window):
+                try:
+                    self.poll()
+                except Exception as e:  # noqa
+                    print(f"[!] Poll failed: {e}")
+            self._stop.wait(self.interval)
+
+    def stop(self):
+        self._stop.set()
+        self._fetcher.shutdown(wait=False)
+
+    def board_path(self, board):
+        return os.path.join(self.path, board)
+
+    def describe(self, board):
+        """
+        Returns the manifest of a mirrored board, with the absolute path
+        of its files, or None.
+        """
+        entries = manifest.read_manifest(self.board_path(board))
+        if not entries:
+            return None
+        for fw_type, entry in entries.items():
+            entry['path'] = os.path.join(self.board_path(board), fw_type,
+                                         entry['file'])
+        return {'board': board, 'firmware': entries,
+                'last_poll': self.last_poll}
+
+    def ensure(self, board, wait=None):
+        """
+        Returns the description of board, fetching it first when it is
+        not mirrored yet (it is then watched too), None when it has no
+        firmware, or PENDING when the fetch runs for more than wait
+        seconds. The fetch runs on the fetch threads, not in the caller,
+        concurrent requests for the same board share it, and a board
+        found without firmware is not fetched again for failed_ttl
+        seconds.
+        """
+        info = self.describe(board)
+        if info:
+            return info
+        with self._lock:
+            failed = self._failed.get(board)
+            if failed is not None and time.time() - failed < self.failed_ttl:
+                return None
+            future = self._fetching.get(board)
+            if future is None:
+                future = self._fetcher.submit(self._fetch, board)
+                self._fetching[board] = future
+                if board not in self.extra_boards:
+                    self.extra_boards.append(board)
+        try:
+            return future.result(self.fetch_wait if wait is None else wait)
+        except FutureTimeout:
+            return PENDING
+
+    def _fetch(self, board):
+        info = None
+        try:
+            self.sync([board])
+            info = self.describe(board)
+        except Exception as e:  # noqa
+            print(f"[!] Fetching {board} failed: {e}")
+        with self._lock:
+            del self._fetching[board]
+            now = time.time()
+            self._failed = {b: t for b, t in self._failed.items()
+                            if now - t < self.failed_ttl}
+            if info:
+                self._failed.pop(board, None)
+            else:
+                self._failed[board] = now
+                if board in self.extra_boards:
+                    self.extra_boards.remove(board)
+        return info
+
+    def status(self):
+        boards = self.boards()
+        with self._lock:
+            failed = [board for board, result in self.last_results.items()
+                      if not result or not all(result.values())]
+            return {'last_poll': self.last_poll,
+                    'boards': len(boards),
+                    'failed': failed,
+                    'interval': self.interval}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    mirror = None
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _send_json(self, data, status=200, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = unquote(self.path.split('?')[0])
+        match = re.match(rf"^/firmware/({BOARD_REGEX})$", path)
+        if match:
+            info = self.mirror.ensure(match[1])
+            if info is PENDING:
+                return self._send_json(
+                    {'pending': f"{match[1]} is being fetched"}, 202,
+                    headers={'Retry-After': '1'})
+            if not info:
+                return self._send_json(
+                    {'error': f"no firmware found for {match[1]}"}, 404)
+            return self._send_json(info)
+
+        match = re.match(rf"^/file/({BOARD_REGEX})/(bios|ipmi)$", path)
+        if match:
+            info = self.mirror.describe(match[1])
+            entry = info and info['firmware'].get(match[2])
+            if not entry or not os.path.isfile(entry['path']):
+                return self._send_json({'error': "not mirrored"}, 404)
+            return self._send_file(entry['path'])
+
+        if path == '/status':
+            return self._send_json(self.mirror.status())
+        self._send_json({'error': "not found"}, 404)
+
+    def _send_file(self, file_path):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(os.path.getsize(file_path)))
+        self.end_headers()
+        with open(file_path, 'rb') as bfile:
+            shutil.copyfileobj(bfile, self.wfile, util.CHUNK_SIZE)
+
+
+def serve(mirror, listen=LISTEN):
+    """
+    Start the poller and serve the mirror until interrupted.
+    """
+    host, _, port = listen.rpartition(':')
+    handler = type('MirrorHandler', (Handler, ), {'mirror': mirror})
+    server = ThreadingHTTPServer((host or '127.0.0.1', int(port)), handler)
+    server.daemon_threads = True
+    poller = threading.Thread(target=mirror.run, daemon=True)
+    poller.start()
+    print(f"[*] Serving the mirror {mirror.path} on "
+          f"http://{host or '127.0.0.1'}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        mirror.stop()
+        server.server_close()
+
+
+def fetch_from(server, boards, output_dir):
+    """
+    Client side: get the firmwares of boards from a mirror daemon into
+    output_dir/{board}/{fw_type}. Returns a dict of board: {fw: ok}.
+    The requests go through the session, with its timeout and retries.
+    """
+    server = server.rstrip('/')
+    results = {}
+    for board in boards:
+        resp = session.get(f"{server}/firmware/{board}")
+        while resp.status_code == 202:
+            # fetched on demand by the daemon, ask again
+            print(f"[*] {board}: {_message(resp, 'pending')}")
+            time.sleep(int(resp.headers.get('Retry-After', 1)))
+            resp = session.get(f"{server}/firmware/{board}")
+        if resp.status_code != 200:
+            print(f"[!] {board}: {_message(resp, 'error')}")
+            results[board] = None
+            continue
+        results[board] = {}
+        for fw_type, entry in resp.json()['firmware'].items():
+            dest = util.mkdir(os.path.join(output_dir, board, fw_type))
+            results[board][fw_type] = bool(
+                _fetch_file(server, board, fw_type, entry, dest))
+    return results
+
+
+def _message(resp, key):
+    """
+    The `key` message of a JSON reply of the daemon, or the status when
+    the reply is not JSON (a proxy error page for example).
+    """
+    try:
+        return resp.json()[key]
+    except (ValueError, KeyError, TypeError):
+        return f"HTTP {resp.status_code}"
+
+
+def _fetch_file(server, board, fw_type, entry, dest):
+    if os.path.isfile(entry['path']):
+        # same host: hardlink from the mirror
+        target, method = matcher.place(entry['path'], dest)
+    else:
+        target = os.path.join(dest, entry['file'])
+        part_path = target + ".part"
+        digest = integrity.new_digest()
+        with session.stream(f"{server}/file/{board}/{fw_type}") as resp:
+            if resp.status_code != 200:
+                print(f"[!] Got HTTP {resp.status_code} for {board} "
+                      f"{fw_type}")
+                return None
+            with open(part_path, 'wb') as bfile:
+                for chunk in resp.iter_content(util.CHUNK_SIZE):
+                    bfile.write(chunk)
+                    digest.update(chunk)
+        if digest.hexdigest() != entry['sha256']:
+            os.unlink(part_path)
+            print(f"[!] {board} {fw_type}: the file does not match the "
+                  f"mirror sha256")
+            return None
+        os.replace(part_path, target)
+        method = 'download'
+    print(f"[*] {board} {fw_type} {entry['revision']} is located at "
+          f"{target} ({method})")
+    return target
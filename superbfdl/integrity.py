@@ -0,0 +1,111 @@
+"""
+Integrity checks of the downloaded archives.
+
+A bad download should fail before it costs a transfer or an extraction:
+
+    - the size announced by the results page ("Size (KB)") is checked
+      against the Content-Length of the response, before reading the body
+    - an HTML body (error or login page) is refused from its Content-Type
+    - the sha256 is computed while the data is streamed to disk, the
+      file is not read a second time
+    - the zip central directory is checked once the file is complete,
+      before it is stored in the download cache and extracted
+
+Failures raise IntegrityError, the download cache then drops the file
+and downloads it again.
+"""
+import hashlib
+import os
+from zipfile import BadZipFile, ZipFile
+
+# times a download failing the checks is started over
+RETRIES = 1
+# the page rounds the size, and may count in KB or in KiB
+SIZE_SLACK = 1024
+
+
+class IntegrityError(Exception):
+    pass
+
+
+def expected_bytes(size_kb):
+    """
+    Returns the (min, max) size in bytes of a file shown as size_kb.
+    """
+    return size_kb * 1000 - SIZE_SLACK, size_kb * 1024 + SIZE_SLACK
+
+
+def check_size(name, size_kb, content_length):
+    """
+    Raise IntegrityError when content_length can not be a file of
+    size_kb. Unknown sizes (None or 0) are not checked.
+    """
+    if not size_kb or not content_length:
+        return
+    low, high = expected_bytes(size_kb)
+    if not low <= content_length <= high:
+        raise IntegrityError(f"{name} is {content_length} bytes, the "
+                             f"download page announces {size_kb} KB")
+
+
+def check_content_type(name, content_type):
+    if content_type and content_type.split(';')[0].strip() == 'text/html':
+        raise IntegrityError(f"{name} is an HTML page, not an archive")
+
+
+def total_length(headers, status):
+    """
+    Returns the full size of the remote file from a 200 or 206 response
+    headers, 0 when unknown.
+    """
+    if status == 206:
+        total = headers.get('Content-Range', '').rpartition('/')[2]
+        return int(total) if total.isdigit() else 0
+    return int(headers.get('Content-Length') or 0)
+
+
+def check_response(name, headers, status, size_kb=None):
+    """
+    Checks done on the response headers, before reading the body.
+    Returns the full size of the remote file (0 when unknown).
+    """
+    check_content_type(name, headers.get('Content-Type'))
+    total = total_length(headers, status)
+    check_size(name, size_kb, total)
+    return total
+
+
+def hash_prefix(file_name, digest, chunk_size=1024 * 1024):
+    """
+    Feed digest with the bytes already in file_name (resumed download).
+    """
+    if os.path.exists(file_name):
+        with open(file_name, 'rb') as bfile:
+            for chunk in iter(lambda: bfile.read(chunk_size), b''):
+                digest.update(chunk)
+    return digest
+
+
+def new_digest():
+    return hashlib.sha256()
+
+
+def verify_zip(file_name):
+    """
+    Check the central directory of a zip file: it can be read, is not
+    empty and every member lies inside the file. The members are not
+    decompressed.
+    """
+    name = os.path.basename(file_name)
+    try:
+        with ZipFile(file_name) as archive:
+            infos = archive.infolist()
+    except (BadZipFile, OSError, ValueError) as e:
+        raise IntegrityError(f"{name} is not a valid zip file: {e}")
+    if not infos:
+        raise IntegrityError(f"{name} is an empty zip file")
+    size = os.path.getsize(file_name)
+    for info in infos:
+        if info.header_offset + info.compress_size > size:
+            raise IntegrityError(f"{name} is truncated, {info.filename} "
+                                 f"ends after the end of the file")
@@ -0,0 +1,148 @@
+"""
+Job journal of the --board/--file runs.
+
+Every stage transition of a (board, fw_type) job is appended to a JSON
+lines file ({output_dir}/journal.jsonl by default):
+
+    resolved     the firmware information was found
+    current      the firmware is already up to date (--sync)
+    downloaded   the archive is in the download cache
+    extracted    the firmware file is in the board directory
+    placed       the firmware is recorded in the manifest and the catalog
+    failed       the job stopped, with the cause of the failure
+
+Each record is written with a single O_APPEND write, so the threads of
+the fleet, the dispatch_job processes and the extraction processes can
+append to the same journal, and a crash loses at most the records being
+written. A run starts with a 'start' record. With --resume the jobs
+whose last record is 'placed' or 'current' are skipped, the failed and
+interrupted ones run again.
+"""
+import json
+import os
+import time
+from collections import OrderedDict
+
+JOURNAL = "journal.jsonl"
+
+# stages after which there is nothing left to do
+DONE = ('placed', 'current')
+
+_settings = {
+    'path': None,
+}
+
+
+def configure(path=None):
+    """
+    Record the jobs in the journal at path, None disables the journal.
+    """
+    _settings['path'] = path
+
+
+def journal_path():
+    return _settings['path']
+
+
+def _append(entry):
+    path = _settings['path']
+    if not path:
+        return
+    entry['time'] = time.time()
+    line = (json.dumps(entry, sort_keys=True) + "\n").encode()
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def start(resume=False):
+    """
+    Mark the start of a run. A run that does not resume starts from
+    scratch, the records before it are ignored by completed().
+    """
+    _append({'stage': 'start', 'resume': resume})
+
+
+def record(board, fw_type, stage, **extra):
+    """
+    Append the transition of the job (board, fw_type) to stage.
+    """
+    _append(dict(extra, board=board, fw_type=fw_type, stage=stage))
+
+
+def failed(board, fw_type, cause, error=None):
+    """
+    Record the failure of a job. cause groups the failures in the
+    report (an exception is grouped by its type), error is the detail.
+    """
+    if isinstance(cause, BaseException):
+        error = error or str(cause)
+        cause = type(cause).__name__
+    record(board, fw_type, 'failed', cause=cause, error=error)
+
+
+def read(path=None):
+    """
+    Returns the records of the current run, and of the runs it resumes.
+    A truncated last line (crash while writing) is ignored.
+    """
+    path = path or _settings['path']
+    records = []
+    if not path:
+        return records
+    try:
+        with open(path) as jfile:
+            for line in jfile:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get('stage') == 'start' and not entry.get('resume'):
+                    records = []
+                records.append(entry)
+    except FileNotFoundError:
+        pass
+    return records
+
+
+def last_states(records=None):
+    """
+    Returns an ordered dict mapping (board, fw_type) to its last record.
+    A lookup failure is recorded with fw_type None.
+    """
+    states = OrderedDict()
+    for entry in read() if records is None else records:
+        if entry.get('stage') == 'start':
+            continue
+        if entry['fw_type']:
+            # the lookup of the board succeeded this time
+            states.pop((entry['board'], None), None)
+        states[(entry['board'], entry['fw_type'])] = entry
+    return states
+
+
+def completed(records=None):
+    """
+    Returns the set of (board, fw_type) with nothing left to do.
+    """
+    return {job for job, entry in last_states(records).items()
+            if entry['stage'] in DONE}
+
+
+def report(records=None):
+    """
+    Print the jobs still failed at the end of the run, grouped by cause.
+    """
+    causes = OrderedDict()
+    for (board, fw_type), entry in last_states(records).items():
+        if entry['stage'] != 'failed':
+            continue
+        job = f"{board} {fw_type}" if fw_type else board
+        causes.setdefault(entry.get('cause') or 'unknown', []).append(job)
+    if not causes:
+        return
+    print(f"[*] Failures by cause (see {_settings['path']}):")
+    for cause, jobs in sorted(causes.items(), key=lambda c: -len(c[1])):
+        print(f"    {cause} ({len(jobs)}): {', '.join(jobs)}")
@@ -0,0 +1,83 @@
+"""
+Per-board manifests used by the sync mode.
+
+Every extracted firmware is recorded in {output_dir}/{board}/manifest.json
+with its revision, SoftwareItemID, source url, file name, sha256, size and
+mtime, and its revision is written to {output_dir}/{board}/{fw_type}/
+version.txt. A later --sync run compares the manifest with the revision
+the server resolves and skips the download and extraction of the
+firmwares that are already current.
+"""
+import json
+import os
+
+import superbfdl.cache as cache
+import superbfdl.util as util
+
+MANIFEST = "manifest.json"
+
+
+def manifest_path(board_path):
+    return os.path.join(board_path, MANIFEST)
+
+
+def read_manifest(board_path):
+    """
+    Returns the manifest of a board directory, {} when there is none.
+    """
+    try:
+        with open(manifest_path(board_path)) as mfile:
+            return json.load(mfile)
+    except (OSError, ValueError):
+        return {}
+
+
+def record(board_path, fw_type, board_info, fw_file):
+    """
+    Add the firmware just extracted to the board manifest and write its
+    version.txt. The bios and ipmi jobs of a board may run at the same
+    time, the manifest is updated under a file lock.
+    """
+    stat = os.stat(fw_file)
+    entry = {
+        'revision': board_info[fw_type].get('release', ''),
+        'software_id': board_info.get('software_id', ''),
+        'url': board_info['download_url'],
+        'file': os.path.basename(fw_file),
+        'sha256': cache.file_sha256(fw_file),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+    }
+    util.write_version(os.path.dirname(fw_file), entry['revision'] + "\n")
+
+    path = manifest_path(board_path)
+    with util.file_lock(os.path.join(board_path, ".manifest.lock")):
+        manifest = read_manifest(board_path)
+        manifest[fw_type] = entry
+        tmp_name = path + ".tmp"
+        with open(tmp_name, 'w') as mfile:
+            json.dump(manifest, mfile, indent=2, sort_keys=True)
+        os.replace(tmp_name, path)
+    return entry
+
+
+def is_current(board_path, fw_type, board_info):
+    """
+    True when the manifest already records the revision resolved in
+    board_info, and the extracted file is still in place and unchanged
+    (same size and mtime, the file is not hashed again).
+    """
+    entry = read_manifest(board_path).get(fw_type)
+    if not entry:
+        return False
+    if entry.get('revision') != board_info[fw_type].get('release', '') or \
+            entry.get('software_id') != board_info.get('software_id', '') or \
+            entry.get('url') != board_info['download_url']:
+        return False
+    fw_file = os.path.join(board_path, fw_type, entry['file'])
+    try:
+        stat = os.stat(fw_file)
+    except OSError:
+        return False
+    return stat.st_size == entry['size'] and \
+        stat.st_mtime_ns == entry['mtime_ns']
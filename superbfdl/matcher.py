@@ -0,0 +1,160 @@
+"""
+Firmware file matcher.
+
+The bios/ipmi file name patterns are compiled once. The files of an
+extracted tree (or of a zip archive) are indexed and the candidates are
+ranked, so the file picked no longer depends on the order os.walk or
+the archive yield them:
+
+    1. the name contains the board model, or at least its generation
+       (X11DPU9.A04 for X11DPU-Z+, SMT_X11AST2500_173_06.bin for X11DPU)
+    2. the newest revision (X11DPU9.A04 before X11DPU9.A03)
+    3. the least nested file
+    4. the name, as a tie breaker
+
+place() puts the chosen file at its destination without copying the
+data when possible: rename (move=True), hardlink, reflink (FICLONE on
+btrfs/XFS), and only then a plain copy.
+"""
+import fcntl
+import os
+import re
+import shutil
+import tempfile
+from collections import namedtuple
+
+FW_TYPES = ('bios', 'ipmi')
+
+FW_NAME_PATTERN = {
+    'ipmi': r"^[\w\-. ]+\.(bin|BIN)$",
+    'bios': r"^[\w\-. ]+\.([A-Da-d]\d{2}|\d{3}|\d{3}_\w{3}|\w{3}_\w{3})$"
+}
+
+PATTERNS = {fw_type: re.compile(pattern)
+            for fw_type, pattern in FW_NAME_PATTERN.items()}
+
+# linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+Candidate = namedtuple('Candidate', ['path', 'name', 'depth'])
+
+
+def pattern(fw_type):
+    """
+    Returns the compiled file name pattern of fw_type.
+    """
+    if fw_type not in FW_TYPES:
+        raise ValueError('fw_type should be "bios" or "ipmi", {} given'.format(
+            type(fw_type)))
+    return PATTERNS[fw_type]
+
+
+def revision_key(name):
+    """
+    Sort key for the revision encoded in a firmware file name: the
+    numbers at the end of the name, then the numbers of the extension.
+    X11DPU9.A04 -> (4, ), SMT_X11AST2500_173_06.bin -> (173, 6)
+    """
+    stem, ext = os.path.splitext(name)
+    trailing = []
+    for token in reversed(re.split(r"[_.\- ]", stem)):
+        if not token.isdigit():
+            break
+        trailing.insert(0, int(token))
+    return tuple(trailing) + tuple(int(d) for d in re.findall(r"\d+", ext))
+
+
+def board_score(name, board_model):
+    """
+    2 when the name contains the board model (without its variant
+    suffix), 1 when it contains its generation (X11), 0 otherwise.
+    """
+    if not board_model:
+        return 0
+    name = name.upper()
+    base = board_model.upper().split('-')[0]
+    if base in name:
+        return 2
+    generation = re.match(r"^[A-Z]+\d+", base)
+    if generation and generation[0] in name:
+        return 1
+    return 0
+
+
+def rank(candidates, board_model=None):
+    """
+    Returns the candidates sorted from the best to the worst match.
+    """
+    # the sorts are stable: sort by the tie breakers first, then by
+    # board score and revision, newest first. A versioned name comes
+    # before an unversioned one, and (1, 10) before (1, 2).
+    ranked = sorted(candidates, key=lambda c: (c.depth, c.name, c.path))
+    return sorted(ranked, key=lambda c: (
+        board_score(c.name, board_model),
+        bool(revision_key(c.name)),
+        revision_key(c.name),
+    ), reverse=True)
+
+
+def index_tree(root, fw_type):
+    """
+    Returns the candidates for fw_type found under root.
+    """
+    regex = pattern(fw_type)
+    candidates = []
+    for dir_path, _dirs, files in os.walk(root):
+        depth = os.path.relpath(dir_path, root).count(os.sep)
+        for name in files:
+            if regex.match(name):
+                candidates.append(Candidate(os.path.join(dir_path, name),
+                                            name, depth))
+    return candidates
+
+
+def best_match(root, fw_type, board_model=None):
+    """
+    Returns the best candidate for fw_type under root, or None.
+    """
+    candidates = rank(index_tree(root, fw_type), board_model)
+    return candidates[0] if candidates else None
+
+
+def _reflink(src, dst):
+    with open(src, 'rb') as sfile, open(dst, 'wb') as dfile:
+        fcntl.ioctl(dfile.fileno(), FICLONE, sfile.fileno())
+
+
+def place(src, dest_dir, move=False):
+    """
+    Put the file src in dest_dir, keeping its name. The destination is
+    replaced atomically. Returns (path, method), method being 'rename',
+    'hardlink', 'reflink' or 'copy'.
+    """
+    target = os.path.join(dest_dir, os.path.basename(src))
+    if move:
+        try:
+            os.replace(src, target)
+            return target, 'rename'
+        except OSError:
+            pass
+
+    # link/clone to a private name, then rename over the target
+    fd, tmp_name = tempfile.mkstemp(dir=dest_dir, prefix=".place-")
+    os.close(fd)
+    os.unlink(tmp_name)
+    try:
+        try:
+            os.link(src, tmp_name)
+            method = 'hardlink'
+        except OSError:
+            try:
+                _reflink(src, tmp_name)
+                method = 'reflink'
+            except OSError:
+                shutil.copy2(src, tmp_name)
+                method = 'copy'
+        os.replace(tmp_name, target)
+    finally:
+        if os.path.exists(tmp_name):
+            os.unlink(tmp_name)
+    return target, method
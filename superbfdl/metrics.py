@@ -0,0 +1,220 @@
+"""
+Instrumentation: per-board stage durations and counters.
+
+Every stage (lookup, metadata, download, extract) records one event with
+its board, fw_type, duration and outcome. The counters track bytes
+transferred, cache hits and misses, HTTP retries and HTTP status codes.
+At the end of a run everything can be exported as JSON lines or as a
+Prometheus textfile (for the node_exporter textfile collector).
+
+The --profile mode runs the hot path under cProfile (cProfile and
+pstats are only imported then). Up to python 3.11 a profiler only sees
+the thread it is enabled in, so every worker thread gets its own and
+the results are merged at the end. From 3.12 a profiler sees every
+thread and only one can be enabled at a time, so the first profiled
+call enables it for the process and the others run under it.
+"""
+import io
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+FORMATS = ('jsonl', 'prom')
+
+# cProfile is built on sys.monitoring from 3.12, see above
+PROCESS_WIDE_PROFILER = sys.version_info >= (3, 12)
+
+
+class Metrics(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.events = []
+        self.counters = defaultdict(int)
+        self.profiles = []
+        self.profiling = False
+        # the profiler running in the process (3.12+), or in the thread
+        self._profile = None
+        self._local = threading.local()
+
+    @contextmanager
+    def stage(self, stage, board=None, fw_type=None):
+        """
+        Record the duration and outcome of the block as a stage event.
+        """
+        event = {'stage': stage, 'board': board, 'fw_type': fw_type,
+                 'start': time.time(), 'ok': False}
+        start = time.monotonic()
+        try:
+            yield event
+            event['ok'] = True
+        finally:
+            event['duration'] = time.monotonic() - start
+            with self._lock:
+                self.events.append(event)
+
+    def incr(self, name, value=1, **labels):
+        # label values are strings, like in the exports: a status is 200
+        # or 'error', and the counters stay sortable
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self._lock:
+            self.counters[key] += value
+
+    def snapshot(self):
+        """
+        Returns the recorded data as plain python objects, so that it
+        can be sent back from a child process and merged.
+        """
+        with self._lock:
+            return {'events': list(self.events),
+                    'counters': list(self.counters.items())}
+
+    def merge(self, snapshot):
+        with self._lock:
+            self.events.extend(snapshot['events'])
+            for key, value in snapshot['counters']:
+                name, labels = key
+                self.counters[(name, tuple(map(tuple, labels)))] += value
+
+    def reset(self):
+        with self._lock:
+            self.events = []
+            self.counters = defaultdict(int)
+            self.profiles = []
+
+    def profiled(self, fn):
+        """
+        Wrap fn so that it runs under a profiler when profiling is
+        enabled: a new one, unless a running profiler already sees the
+        call (the one of the process from 3.12, of the thread before).
+        """
+        def wrapper(*args, **kwargs):
+            if not self.profiling:
+                return fn(*args, **kwargs)
+            import cProfile
+            scope = self if PROCESS_WIDE_PROFILER else self._local
+            with self._lock:
+                if getattr(scope, '_profile', None) is not None:
+                    profile = None
+                else:
+                    profile = scope._profile = cProfile.Profile()
+            if profile is None:
+                return fn(*args, **kwargs)
+            try:
+                return profile.runcall(fn, *args, **kwargs)
+            finally:
+                with self._lock:
+                    scope._profile = None
+                    self.profiles.append(profile)
+        return wrapper
+
+    def write_profile(self, file_name, top=25):
+        """
+        Merge the collected profiles, dump them to file_name (pstats
+        format) and return the top functions by cumulative time.
+        """
+        with self._lock:
+            profiles = list(self.profiles)
+        if not profiles:
+            return ""
+        import pstats
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(file_name)
+        out = io.StringIO()
+        stats.stream = out
+        stats.sort_stats('cumulative').print_stats(top)
+        return out.getvalue()
+
+    def write_jsonl(self, file_name):
+        with self._lock:
+            events = list(self.events)
+            counters = list(self.counters.items())
+        with open(file_name, 'w') as mfile:
+            for event in events:
+                mfile.write(json.dumps(dict(event, type='stage')) + "\n")
+            for (name, labels), value in counters:
+                record = {'type': 'counter', 'name': name, 'value': value,
+                          'labels': dict(labels)}
+                mfile.write(json.dumps(record) + "\n")
+
+    def write_prometheus(self, file_name):
+        """
+        Write a Prometheus textfile. The file is written next to its
+        final name and renamed, as the textfile collector expects.
+        """
+        with self._lock:
+            events = list(self.events)
+            counters = list(self.counters.items())
+
+        seconds = defaultdict(float)
+        runs = defaultdict(int)
+        for event in events:
+            key = (event['stage'], 'ok' if event['ok'] else 'error')
+            seconds[key] += event['duration']
+            runs[key] += 1
+
+        lines = [
+            "# HELP superbfdl_stage_seconds_total Time spent in each stage.",
+            "# TYPE superbfdl_stage_seconds_total counter",
+        ]
+        for (stage, result), value in sorted(seconds.items()):
+            lines.append(f'superbfdl_stage_seconds_total{{stage="{stage}",'
+                         f'result="{result}"}} {value:.6f}')
+        lines += [
+            "# HELP superbfdl_stage_runs_total Number of runs of each stage.",
+            "# TYPE superbfdl_stage_runs_total counter",
+        ]
+        for (stage, result), value in sorted(runs.items()):
+            lines.append(f'superbfdl_stage_runs_total{{stage="{stage}",'
+                         f'result="{result}"}} {value}')
+
+        by_name = defaultdict(list)
+        for (name, labels), value in counters:
+            by_name[name].append((labels, value))
+        for name, values in sorted(by_name.items()):
+            lines.append(f"# TYPE superbfdl_{name}_total counter")
+            for labels, value in sorted(values):
+                label_str = ",".join(f'{k}="{v}"' for k, v in labels)
+                if label_str:
+                    label_str = f"{{{label_str}}}"
+                lines.append(f"superbfdl_{name}_total{label_str} {value}")
+
+        tmp_name = file_name + ".tmp"
+        with open(tmp_name, 'w') as mfile:
+            mfile.write("\n".join(lines) + "\n")
+        os.replace(tmp_name, file_name)
+
+    def write(self, file_name, fmt=None):
+        """
+        Export to file_name, the format defaults to the file extension
+        ('.prom' for Prometheus, anything else JSON lines).
+        """
+        if fmt is None:
+            fmt = 'prom' if file_name.endswith('.prom') else 'jsonl'
+        if fmt not in FORMATS:
+            raise ValueError(f'format should be one of {FORMATS}, '
+                             f'{fmt} given')
+        if fmt == 'prom':
+            self.write_prometheus(file_name)
+        else:
+            self.write_jsonl(file_name)
+
+
+_registry = Metrics()
+
+
+def registry():
+    return _registry
+
+
+def stage(stage, board=None, fw_type=None):
+    return _registry.stage(stage, board=board, fw_type=fw_type)
+
+
+def incr(name, value=1, **labels):
+    _registry.incr(name, value, **labels)
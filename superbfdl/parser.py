@@ -0,0 +1,151 @@
+"""
+HTML parsing layer for the Supermicro pages.
+
+Only two things are ever read from the vendor pages: the hidden
+ProductID input of the motherboard page, and the `tr.textA` rows of the
+results.aspx/firmware.aspx tables. Two backends extract them:
+
+- 'fast': targeted regular expressions that only scan for the tags we
+  need, without building a document tree.
+- 'bs4': the original BeautifulSoup implementation.
+
+The default backend, 'auto', uses 'fast' and falls back to 'bs4' when
+the fast scan finds nothing on a page that has what we look for (the
+'textA' class or the 'ProductID' name), in case the markup is not what
+we expect. A page without them, like the results page of a board with
+no download, has nothing bs4 could find and is not parsed twice.
+"""
+import html
+import re
+
+BACKENDS = ('auto', 'fast', 'bs4')
+
+_settings = {
+    'backend': 'auto',
+}
+
+# comments and scripts are skipped, like an html parser would do
+SKIP = r"<!--.*?-->|<script\b.*?</script\s*>"
+SKIP_REGEX = re.compile(SKIP, re.I | re.S)
+INPUT_REGEX = re.compile(SKIP + r"|<input\b[^>]*>", re.I | re.S)
+ATTR_REGEX = re.compile(
+    r"""([^\s=/>"']+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+)))?""")
+ROW_REGEX = re.compile(r"<tr\b([^>]*)>(.*?)</tr\s*>", re.I | re.S)
+CELL_REGEX = re.compile(r"<td\b[^>]*>(.*?)(?=<td\b|</td\s*>|$)", re.I | re.S)
+LINK_REGEX = re.compile(r"<a\b([^>]*)>(.*?)</a\s*>", re.I | re.S)
+TAG_REGEX = re.compile(r"<!--.*?-->|<[^>]*>", re.S)
+
+
+def set_backend(backend):
+    if backend not in BACKENDS:
+        raise ValueError(f'backend should be one of {BACKENDS}, '
+                         f'{backend} given')
+    _settings['backend'] = backend
+
+
+def get_backend():
+    return _settings['backend']
+
+
+def _attrs(tag):
+    """
+    Returns the attributes of a start tag as a dict, names lowercased.
+    """
+    # skip the tag name
+    body = tag[1:-1].split(None, 1)
+    attrs = {}
+    if len(body) < 2:
+        return attrs
+    for match in ATTR_REGEX.finditer(body[1]):
+        name = match.group(1).lower()
+        value = next((v for v in match.groups()[1:] if v is not None), '')
+        attrs.setdefault(name, html.unescape(value))
+    return attrs
+
+
+def _text(fragment):
+    return html.unescape(TAG_REGEX.sub('', fragment))
+
+
+def _fast_product_id(page):
+    for match in INPUT_REGEX.finditer(page):
+        if match.group(0)[:6].lower() != '<input':
+            continue
+        attrs = _attrs(match.group(0))
+        if attrs.get('name') == 'ProductID':
+            return attrs.get('value')
+    return None
+
+
+def _fast_rows(page):
+    rows = []
+    for match in ROW_REGEX.finditer(SKIP_REGEX.sub('', page)):
+        classes = _attrs(f"<tr {match.group(1)}>").get('class', '').split()
+        if 'textA' not in classes:
+            continue
+        cells = CELL_REGEX.findall(match.group(2))
+        if len(cells) < 2:
+            continue
+        link = None
+        a_match = LINK_REGEX.search(cells[1])
+        if a_match:
+            href = _attrs(f"<a {a_match.group(1)}>").get('href')
+            link = (_text(a_match.group(2)), href)
+        rows.append((_text(cells[0]), _text(cells[1]), link))
+    return rows
+
+
+def _bs4_product_id(page):
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(page, 'html.parser')
+    field = soup.find('input', {'name': 'ProductID'})
+    if field is None:
+        return None
+    return field.get('value')
+
+
+def _bs4_rows(page):
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(page, 'html.parser')
+    rows = []
+    for row in soup.find_all('tr', {"class": "textA"}):
+        columns = row.find_all('td')
+        if len(columns) < 2:
+            continue
+        link = None
+        a_link = columns[1].find('a')
+        if a_link:
+            link = (a_link.text, a_link.attrs.get('href'))
+        rows.append((columns[0].text, columns[1].text, link))
+    return rows
+
+
+def find_product_id(page, backend=None):
+    """
+    Returns the value of the hidden ProductID input, or None.
+    """
+    backend = backend or _settings['backend']
+    if backend == 'bs4':
+        return _bs4_product_id(page)
+    product_id = _fast_product_id(page)
+    if product_id is None and backend == 'auto' and 'ProductID' in page:
+        product_id = _bs4_product_id(page)
+    return product_id
+
+
+def find_rows(page, backend=None):
+    """
+    Returns the `tr.textA` rows of a results table as a list of
+    (key text, value text, link) tuples, where link is the
+    (text, href) of the first <a> of the value cell, or None.
+    Texts are returned as found, not stripped.
+    """
+    backend = backend or _settings['backend']
+    if backend == 'bs4':
+        return _bs4_rows(page)
+    rows = _fast_rows(page)
+    if not rows and backend == 'auto' and 'textA' in page:
+        rows = _bs4_rows(page)
+    return rows
@@ -0,0 +1,95 @@
+"""
+Extraction stage of the fleet mode, decoupled from the network workers.
+
+The scheduler threads only resolve and download. Each archive they
+fetch is handed to a pool of processes that finds, extracts and hashes
+the firmware file, so the network slots are free for the next download
+while zips decompress, and the extraction uses every core instead of
+sharing the GIL with the downloads.
+
+At most max_pending archives wait for (or are in) extraction: above
+that, a network worker blocks in submit until a slot frees up, which
+keeps the downloads from running ahead of the extraction.
+
+The worker processes are spawned, not forked, since the parent has
+threads (and their locks) running. They only import what extraction
+needs and start from the cache directory, extraction settings and
+journal of the parent.
+"""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import superbfdl.cache as cache
+import superbfdl.journal as journal
+import superbfdl.metrics as metrics
+import superbfdl.util as util
+
+# extraction processes, one per core
+EXTRACT_WORKERS = os.cpu_count() or 1
+
+
+def _init_worker(cache_dir, extract_settings, journal_path):
+    cache.configure(cache_dir=cache_dir)
+    util.configure_extract(**extract_settings)
+    journal.configure(journal_path)
+
+
+def _run(fn, args):
+    """
+    Runs fn in a worker process, and returns its metrics with the
+    result so the parent can merge them.
+    """
+    metrics.registry().reset()
+    result = fn(*args)
+    return result, metrics.registry().snapshot()
+
+
+class ExtractPool(object):
+    def __init__(self, max_workers=EXTRACT_WORKERS, max_pending=None,
+                 scheduler=None):
+        self.max_workers = max_workers
+        self.max_pending = max_pending or 2 * max_workers
+        # the extract stage is also accounted in the fleet summary
+        self.scheduler = scheduler
+        self.executor = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(cache.cache_dir(), util.extract_settings(),
+                      journal.journal_path()))
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+
+    def submit(self, fn, *args):
+        """
+        Run fn(*args) in a worker process, blocking while max_pending
+        jobs are queued. fn must be a module level function.
+        Returns a future of the result of fn.
+        """
+        self._slots.acquire()
+        try:
+            future = self.executor.submit(_run, fn, args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        self._slots.release()
+
+    def result(self, future):
+        """
+        Returns the result of a future from submit, and merges the
+        metrics recorded in the worker.
+        """
+        result, snapshot = future.result()
+        metrics.registry().merge(snapshot)
+        if self.scheduler is not None:
+            for event in snapshot['events']:
+                self.scheduler.account(event['stage'], event['duration'])
+        return result
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,223 @@
+"""
+Per-host rate limiting and adaptive concurrency.
+
+Every request to a host first takes a token from the host bucket
+(`rate` requests per second, bursts of `burst`), then one of the
+concurrency slots of the host. The number of slots and the rate adapt
+to the responses (AIMD):
+
+    - 429 and 5xx responses, connection errors and a latency growing
+      well above the best latency seen halve the slots and the rate
+      (at most once per cooldown, a burst of errors counts once)
+    - every other response adds 1/slots slots (+1 per round trip of all
+      the slots), up to max_concurrency, and, when it had to wait for a
+      token, RATE_STEP requests per second, up to max_rate (0 for no
+      ceiling: `rate` is only the starting point)
+
+so the throughput grows up to what the site tolerates and backs off as
+soon as it pushes back. The limiters are shared by every request made
+by the session (core, smc, util) and by the asyncio engine, and they
+are the only per-host cap on concurrency: --per-host sets the maximum
+(max_concurrency). A streamed download holds its slot until its body
+is read (see session.stream).
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+# initial requests per second per host, 0 means unlimited
+RATE = 20
+BURST = 20
+# ceiling of the rate, 0 lets it grow while the host keeps up
+MAX_RATE = 0
+# concurrent requests per host: initial, minimum and maximum
+CONCURRENCY = 8
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = 64
+# rate added back after every successful response
+RATE_STEP = 0.5
+MIN_RATE = 0.5
+# a latency this many times the best one is treated as congestion
+LATENCY_FACTOR = 4
+# seconds between two decreases
+COOLDOWN = 1.0
+# longest Retry-After honored, in seconds
+MAX_RETRY_AFTER = 60
+THROTTLE_STATUS = (429, 500, 502, 503, 504)
+
+_settings = {
+    'rate': RATE,
+    'burst': BURST,
+    'max_rate': MAX_RATE,
+    'concurrency': CONCURRENCY,
+    'max_concurrency': MAX_CONCURRENCY,
+}
+
+_lock = threading.Lock()
+_limiters = {}
+_limiters_pid = None
+
+
+class HostLimiter(object):
+    def __init__(self, host, rate=RATE, burst=BURST, max_rate=MAX_RATE,
+                 concurrency=CONCURRENCY, max_concurrency=MAX_CONCURRENCY):
+        self.host = host
+        self.max_rate = max_rate and max(rate, max_rate)
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max(MIN_CONCURRENCY, max_concurrency)
+        self.limit = float(min(concurrency, self.max_concurrency))
+        self.active = 0
+        self.best_latency = None
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._decreased = 0.0
+        # a request waited for a token since the last increase: the rate,
+        # not the host, is what limits the throughput
+        self._starved = False
+        self._cond = threading.Condition()
+
+    def reserve(self):
+        """
+        Take a token, returns the number of seconds to wait before
+        using it (0 when one was available).
+        """
+        if not self.rate:
+            return 0.0
+        with self._cond:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            self._starved = True
+            return -self._tokens / self.rate
+
+    def try_enter(self):
+        with self._cond:
+            if self.active < int(self.limit):
+                self.active += 1
+                return True
+            return False
+
+    def enter(self):
+        with self._cond:
+            self._cond.wait_for(lambda: self.active < int(self.limit))
+            self.active += 1
+
+    def leave(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self):
+        """
+        Wait for a token and a concurrency slot.
+        """
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+        self.enter()
+        try:
+            yield
+        finally:
+            self.leave()
+
+    def feedback(self, status, latency=None):
+        """
+        Adapt the limits to a response, status is None for a connection
+        error.
+        """
+        if status is None or status in THROTTLE_STATUS:
+            self._decrease(f"HTTP {status}" if status else "errors")
+            return
+        if latency is not None:
+            if self.best_latency is None or latency < self.best_latency:
+                self.best_latency = latency
+            if latency > LATENCY_FACTOR * max(self.best_latency, 0.05):
+                self._decrease(f"latency {latency:.1f}s")
+                return
+        with self._cond:
+            self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            if self.rate and self._starved:
+                self._starved = False
+                self.rate += RATE_STEP
+                if self.max_rate:
+                    self.rate = min(self.max_rate, self.rate)
+            self._cond.notify_all()
+
+    def _decrease(self, reason):
+        with self._cond:
+            now = time.monotonic()
+            if now - self._decreased < COOLDOWN:
+                return
+            self._decreased = now
+            self.limit = max(MIN_CONCURRENCY, self.limit / 2)
+            if self.rate:
+                self.rate = max(MIN_RATE, self.rate / 2)
+            limit, rate = int(self.limit), self.rate
+        print(f"[!] {self.host} pushes back ({reason}), slowing down to "
+              f"{limit} concurrent requests, {rate or 'unlimited'} req/s")
+
+
+def configure(rate=None, burst=None, max_rate=None, concurrency=None,
+              max_concurrency=None):
+    """
+    Change the limiter settings. When they change, the limiters are
+    built again on the next request, otherwise what they learned is
+    kept.
+    """
+    with _lock:
+        settings = dict(_settings)
+        if rate is not None:
+            settings['rate'] = rate
+        if burst is not None:
+            settings['burst'] = burst
+        if max_rate is not None:
+            settings['max_rate'] = max_rate
+        if concurrency is not None:
+            settings['concurrency'] = concurrency
+        if max_concurrency is not None:
+            settings['max_concurrency'] = max_concurrency
+        if settings != _settings:
+            _settings.update(settings)
+            _limiters.clear()
+
+
+def limiter(url):
+    """
+    Returns the limiter of the host of url. Like the session, the
+    limiters are not shared with forked child processes.
+    """
+    global _limiters_pid
+    host = urlparse(url).netloc
+    with _lock:
+        if _limiters_pid != os.getpid():
+            _limiters.clear()
+            _limiters_pid = os.getpid()
+        if host not in _limiters:
+            _limiters[host] = HostLimiter(host, **_settings)
+        return _limiters[host]
+
+
+def retry_after(headers):
+    """
+    Returns the delay asked by a Retry-After header in seconds, or None.
+    """
+    value = headers.get('Retry-After')
+    if not value:
+        return None
+    from email.utils import parsedate_to_datetime
+    if value.strip().isdigit():
+        delay = int(value)
+    else:
+        try:
+            delay = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(delay, 0), MAX_RETRY_AFTER)
@@ -0,0 +1,91 @@
+"""
+Shared scheduler used by the fleet mode.
+
+All boards from a board list are run through one thread pool. The
+scheduler caps the total number of running jobs and keeps track of the
+time spent in each stage (lookup, metadata, download, extract). The
+concurrent requests per host are left to the adaptive limiters of
+ratelimit, a fixed cap here would keep them from growing.
+"""
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import superbfdl.metrics as metrics
+import superbfdl.ratelimit as ratelimit
+
+MAX_WORKERS = 8
+MAX_PER_HOST = ratelimit.MAX_CONCURRENCY
+
+
+class Scheduler(object):
+    def __init__(self, max_workers=MAX_WORKERS, per_host=MAX_PER_HOST):
+        self.max_workers = max_workers
+        # only reported, see ratelimit.configure(max_concurrency=)
+        self.per_host = per_host
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._stages = OrderedDict()
+        self._started = time.monotonic()
+
+    def submit(self, fn, *args, **kwargs):
+        fn = metrics.registry().profiled(fn)
+        return self.executor.submit(fn, *args, **kwargs)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+    @contextmanager
+    def stage(self, name, board=None, fw_type=None):
+        """
+        Account the time spent inside the block to the stage `name`.
+        The stage is also recorded in the metrics registry.
+        """
+        start = time.monotonic()
+        try:
+            with metrics.stage(name, board=board, fw_type=fw_type):
+                yield
+        finally:
+            self.account(name, time.monotonic() - start)
+
+    def account(self, name, elapsed):
+        """
+        Add `elapsed` seconds to the stage `name`, for the stages that
+        ran outside of the scheduler (see pipeline.ExtractPool).
+        """
+        with self._lock:
+            total, count, longest = self._stages.get(name, (0.0, 0, 0.0))
+            self._stages[name] = (total + elapsed, count + 1,
+                                  max(longest, elapsed))
+
+    def summary(self):
+        """
+        Returns a printable summary of the time spent in each stage.
+        """
+        wall = time.monotonic() - self._started
+        lines = [f"[*] Wall time: {wall:.2f}s "
+                 f"(jobs={self.max_workers}, per-host={self.per_host})"]
+        lines.append(f"    {'stage':<10} {'count':>6} {'total':>10} "
+                     f"{'mean':>8} {'max':>8}")
+        with self._lock:
+            stages = list(self._stages.items())
+        for name, (total, count, longest) in stages:
+            lines.append(f"    {name:<10} {count:>6} {total:>9.2f}s "
+                         f"{total / count:>7.2f}s {longest:>7.2f}s")
+        return "\n".join(lines)
+
+    def report(self, results):
+        """
+        Print the boards with failures and the stage summary. results
+        maps each board to a dict of fw_type: success (None when the
+        board could not be resolved).
+        """
+        failed = [board for board, result in results.items()
+                  if not result or not all(result.values())]
+        print(f"[*] Processed {len(results)} boards, "
+              f"{len(failed)} with failures")
+        for board in failed:
+            print(f"    {board}: {results[board]}")
+        print(self.summary())
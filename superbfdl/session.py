@@ -0,0 +1,237 @@
+"""
+Shared HTTP session used by core, smc and util.
+
+Every request to www.supermicro.com goes through a single
+requests.Session, so connections are kept alive and reused instead of
+doing a new TCP+TLS handshake on every call. The session also applies a
+default timeout and retries failed requests with an exponential backoff.
+
+Every request goes through the limiter of its host (see ratelimit), and
+the throttled responses (429, 5xx) are retried here rather than by
+urllib3 so that the limiter sees them and Retry-After is honored. A
+download streamed with stream() keeps its concurrency slot until its
+body is read, so the limiter counts the transfers in progress.
+
+requests (and urllib3) are only imported when the first session is
+built, so that the CLI starts without paying for them. HTTPStatusError,
+a requests.HTTPError, is built then too.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager, ExitStack
+
+import superbfdl.metrics as metrics
+import superbfdl.ratelimit as ratelimit
+
+POOL_SIZE = 10
+# (connect, read) timeout in seconds
+TIMEOUT = (10, 60)
+RETRIES = 3
+BACKOFF = 0.5
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+_settings = {
+    'pool_size': POOL_SIZE,
+    'timeout': TIMEOUT,
+    'retries': RETRIES,
+    'backoff': BACKOFF,
+}
+
+_lock = threading.Lock()
+_session = None
+_session_pid = None
+_retry_class = None
+_error_class = None
+
+
+def configure(pool_size=None, timeout=None, retries=None, backoff=None):
+    """
+    Change the session settings. The current session is discarded and
+    a new one is built on the next request.
+    """
+    global _session
+    with _lock:
+        if pool_size is not None:
+            _settings['pool_size'] = pool_size
+        if timeout is not None:
+            _settings['timeout'] = timeout
+        if retries is not None:
+            _settings['retries'] = retries
+        if backoff is not None:
+            _settings['backoff'] = backoff
+        if _session is not None:
+            _session.close()
+        _session = None
+
+
+def http_status_error_class():
+    """
+    Returns HTTPStatusError, the requests.HTTPError raised on an
+    unexpected HTTP status. The class is built on first use, requests
+    is not imported before.
+    """
+    global _error_class
+    with _lock:
+        if _error_class is None:
+            import requests
+
+            class HTTPStatusError(requests.HTTPError):
+                """
+                Unexpected HTTP status, carrying the response.
+                """
+
+            HTTPStatusError.__module__ = __name__
+            HTTPStatusError.__qualname__ = 'HTTPStatusError'
+            _error_class = HTTPStatusError
+    return _error_class
+
+
+def __getattr__(name):
+    # session.HTTPStatusError, see http_status_error_class
+    if name == 'HTTPStatusError':
+        return http_status_error_class()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def check_status(resp, expected=(200, )):
+    """
+    Raise HTTPStatusError when the status of resp is not expected, so
+    that a throttled or failed request is not mistaken for an empty
+    answer.
+    """
+    if resp.status_code not in expected:
+        raise http_status_error_class()(
+            f"Got HTTP {resp.status_code} from {resp.url}", response=resp)
+    return resp
+
+
+def counting_retry_class():
+    """
+    Returns CountingRetry, a urllib3 Retry (of connection errors) that
+    records every retry in the metrics. The class is built on first
+    use, urllib3 is not imported before.
+    """
+    global _retry_class
+    if _retry_class is None:
+        from urllib3.util.retry import Retry
+
+        class CountingRetry(Retry):
+            def increment(self, method=None, url=None, response=None,
+                          error=None, *args, **kwargs):
+                metrics.incr('http_retries', status=getattr(
+                    response, 'status', 'error'))
+                return super().increment(method, url, response, error,
+                                         *args, **kwargs)
+
+        _retry_class = CountingRetry
+    return _retry_class
+
+
+def _build_session():
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    retry_class = counting_retry_class()
+    retry = retry_class(total=_settings['retries'],
+                        backoff_factor=_settings['backoff'],
+                        allowed_methods=frozenset(['GET', 'HEAD', 'POST']))
+    adapter = HTTPAdapter(pool_connections=_settings['pool_size'],
+                          pool_maxsize=_settings['pool_size'],
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session():
+    """
+    Returns the shared session. A forked child process (dispatch_job)
+    must not reuse the sockets of its parent, so the session is rebuilt
+    when the pid changes.
+    """
+    global _session, _session_pid
+    with _lock:
+        if _session is None or _session_pid != os.getpid():
+            _session = _build_session()
+            _session_pid = os.getpid()
+        return _session
+
+
+def _send(method, url, hold=False, **kwargs):
+    """
+    Send a request through the limiter of the host. The RETRY_STATUS
+    responses are retried with an exponential backoff (or after the
+    Retry-After delay), the last one is returned with a function that
+    frees its host slot: with hold, the slot is kept until it is called.
+    """
+    from requests import RequestException
+
+    kwargs.setdefault('timeout', _settings['timeout'])
+    limiter = ratelimit.limiter(url)
+    retries = _settings['retries']
+    for attempt in range(retries + 1):
+        with ExitStack() as held:
+            held.enter_context(limiter.slot())
+            start = time.monotonic()
+            try:
+                resp = get_session().request(method, url, **kwargs)
+            except RequestException:
+                metrics.incr('http_responses', method=method, status='error')
+                limiter.feedback(None)
+                raise
+            limiter.feedback(resp.status_code, time.monotonic() - start)
+            metrics.incr('http_responses', method=method,
+                         status=resp.status_code)
+            if resp.status_code not in RETRY_STATUS or attempt == retries:
+                release = held.pop_all().close if hold else _no_release
+                return resp, release
+        # wait for the retry without holding a slot
+        metrics.incr('http_retries', status=resp.status_code)
+        delay = ratelimit.retry_after(resp.headers)
+        if delay is None:
+            delay = _settings['backoff'] * (2 ** attempt)
+        resp.close()
+        time.sleep(delay)
+
+
+def _no_release():
+    pass
+
+
+def request(method, url, **kwargs):
+    """
+    Send a request through the limiter of the host, see _send. The host
+    slot is freed once the headers are received, use stream() for the
+    responses whose body is big.
+    """
+    return _send(method, url, **kwargs)[0]
+
+
+@contextmanager
+def stream(url, method='GET', **kwargs):
+    """
+    Streamed request, the body is read inside the block. The host slot
+    is held until the block exits, so a long download counts as one of
+    the requests in flight for the whole transfer.
+    """
+    resp, release = _send(method, url, hold=True, stream=True, **kwargs)
+    try:
+        with resp:
+            yield resp
+    finally:
+        release()
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, data=None, **kwargs):
+    return request('POST', url, data=data, **kwargs)
+
+
+def head(url, **kwargs):
+    kwargs.setdefault('allow_redirects', True)
+    return request('HEAD', url, **kwargs)
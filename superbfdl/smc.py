@@ -2,12 +2,14 @@
 # -*- coding: utf-8 -*-
 
 import logging
-import re
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
-import requests
-from bs4 import BeautifulSoup
+import superbfdl.cache as cache
+import superbfdl.core as core
+import superbfdl.parser as parser
+import superbfdl.session as session
 
-logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 
 SUPERMICRO_URL = "https://www.supermicro.com"
@@ -15,6 +17,32 @@ SUPERMICRO_URL = "https://www.supermicro.com"
 IPMI_URL_RESOURCE = f"{SUPERMICRO_URL}/support/bios/firmware.aspx"
 BIOS_URL_RESOURCE = f"{SUPERMICRO_URL}/support/resources/results.aspx"
 
+RESOURCE_FW_TYPE = {
+    IPMI_URL_RESOURCE: 'ipmi',
+    BIOS_URL_RESOURCE: 'bios',
+}
+
+# concurrent requests of resolve_boards
+MAX_WORKERS = 8
+
+
+class BoardFirmware(namedtuple('BoardFirmware', [
+        'board_model', 'product_id', 'bios_revision', 'bios_url',
+        'ipmi_revision', 'ipmi_url', 'bios_software_id', 'ipmi_software_id',
+        'error'])):
+    """
+    Immutable result of resolve_boards for one board. error is None
+    when everything was resolved, otherwise it describes what failed
+    and the fields that could not be resolved are None. The bios and
+    ipmi are often in the same bundle, but not always, each has its
+    SoftwareItemID.
+    """
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.error is None
+
 
 class SMC(object):
     def __init__(self, board_model):
@@ -24,17 +52,21 @@ class SMC(object):
         self.bios_revision = None
         self.ipmi_url = None
         self.bios_url = None
+        # SoftwareItemID of the last resolved bundle, bios or ipmi
         self.software_id = None
+        self.bios_software_id = None
+        self.ipmi_software_id = None
 
     def __repr__(self) -> str:
         return (f"Board: {self.board_model} ({self.product_id}), "
                 f"BIOS: {self.bios_revision}, "
                 f"IPMI: {self.ipmi_revision}")
 
-    def get_board_product_id(self):
+    def get_board_product_id(self, refresh=False):
         """
         Parses the motherboard html page and retrieve
-        the ProductID.
+        the ProductID. The ProductID is cached on disk, use refresh=True
+        to ignore the cached value.
 
         The url https://www.supermicro.com/en/products/motherboard/<BOARD>
         ha the following hidden form elements:
@@ -52,17 +84,29 @@ class SMC(object):
         BIOS: action="/support/resources/results.aspx"
         IPMI: action="/support/bios/firmware.aspx"
         """
+        product_ids = cache.product_id_cache()
+        if not refresh:
+            product_id = product_ids.get(self.board_model)
+            if product_id:
+                self.product_id = product_id
+                return product_id
+
         url = f"{SUPERMICRO_URL}/en/products/motherboard/{self.board_model}"
+        page = session.get(url)
+        # throttled or failing site: raise, the board is not unknown
+        if page.status_code in session.RETRY_STATUS:
+            session.check_status(page)
         try:
-            page = requests.get(url)
             if page.status_code != 200:
                 raise ValueError(f"Get wrong response from {url}")
-            soup = BeautifulSoup(page.text, 'html.parser')
-            product_id = soup.find('input', {'name': 'ProductID'}).get('value')
+            product_id = parser.find_product_id(page.text)
+            if not product_id:
+                raise ValueError(f"No ProductID found in {url}")
         except Exception as e:
             log.debug(e)
             log.error(f"Could not find Product ID for {self.board_model} ")
             return
+        product_ids.put(self.board_model, product_id)
         self.product_id = product_id
         return product_id
 
@@ -95,6 +139,8 @@ class SMC(object):
         """
         data = {}
         data['bundle'] = False
+        data['software_id'] = resources.get('software_id') or None
+        self.software_id = data['software_id']
         ipmi_release_note = ""
 
         for key, value in resources.items():
@@ -137,58 +183,46 @@ class SMC(object):
 
         return data
 
-    def build_download_url(self, resource_url):
+    def build_download_url(self, resource_url, refresh=False):
         """
-        Build the download url
+        Build the download url.
+
+        The parsed resources are cached per (ProductID, fw_type) and
+        revalidated with ETag/Last-Modified once they are stale. Use
+        refresh=True to bypass the cache.
         """
+        metadata = cache.metadata_cache()
+        key = cache.metadata_key(self.product_id,
+                                 RESOURCE_FW_TYPE[resource_url])
+        entry = None
+        if not refresh:
+            resources = metadata.get(key)
+            if resources is not None:
+                return self.sanitize_data(resources)
+            entry = metadata.entry(key)
+
         payload = {
             "ProductID": self.product_id,
             "ProductName": self.board_model,
             "Resource": "BIOS"
         }
 
-        page = requests.post(resource_url, data=payload)
-        soup = BeautifulSoup(page.text, 'html.parser')
-        regex = re.compile(r"[Ss]oftware[Ii]tem[Ii][Dd]=(?P<pid>\d*)")
-
-        resources = {}
-
-        for row in soup.find_all('tr', {"class": "textA"}):
-            columns = row.findAll('td')
-            # Bundled Software File Name: X11DPU3_4_AST173_06.zip
-            # <a href=/about/policies/disclaimer.cfm?SoftwareItemID=12612>.</a>
-            # Size (KB): 75,401
-            # BIOS Revision: 3.4
-            # BIOS Release Note: X11DPU_BIOS_3_4_release_notes.pdf
-            # IPMI Firmware Release Note: X11DPU_BMCFW_1_73_06_release...pdf
-            # File Description: ...
-            key_name = columns[0].text.replace(':', '').strip()
-            resources[key_name] = columns[1].text.strip()
-            a_link = columns[1].find('a')
-
-            if a_link:
-                # receice 'X11DPU3_4_AST173_06.zip'
-                file_name = a_link.text
-                # receive '/about/policies/disclaimer.cfm?SoftwareItemID=12612'
-                href = a_link.attrs['href']
-                # extract the numeric part of SoftwareItemID=12612, i.e. 12612
-                match = regex.search(href)
-                # we don't want the pdf files, just the zip
-                if match and file_name.endswith('zip'):
-                    software_id = match['pid']
-
-                    self.software_id = software_id
-                    # # builds a direct link to download the firmware
-                    # # https://supermicro.com/Bios/softfiles/12612/
-                    # # X11DPU3_4_AST173_06.zip
-                    resources['download_url'] = (
-                        f"{SUPERMICRO_URL}/Bios/softfiles/"
-                        f"{software_id}/{file_name}")
-        # print(resources)
+        page = session.post(resource_url, data=payload,
+                            headers=cache.conditional_headers(entry))
+        if page.status_code == 304 and entry:
+            resources = entry['value']
+            metadata.put(key, resources, etag=entry.get('etag'),
+                         last_modified=entry.get('last_modified'))
+            return self.sanitize_data(resources)
+
+        session.check_status(page)
+        resources = core.parse_results_page(page.text)
+        metadata.put(key, resources, **cache.validators(page))
         return self.sanitize_data(resources)
 
     def get_bios_info(self):
         resources = self.build_download_url(BIOS_URL_RESOURCE)
+        self.bios_software_id = resources['software_id']
         try:
             self.bios_url = resources['bios'].get('url')
             self.bios_revision = resources['bios'].get('revision')
@@ -197,6 +231,7 @@ class SMC(object):
 
     def get_ipmi_info(self):
         resources = self.build_download_url(IPMI_URL_RESOURCE)
+        self.ipmi_software_id = resources['software_id']
         try:
             self.ipmi_url = resources['ipmi'].get('url')
             self.ipmi_revision = resources['ipmi'].get('revision')
@@ -207,8 +242,126 @@ class SMC(object):
         self.get_bios_info()
         self.get_ipmi_info()
 
+    def record(self, error=None):
+        """
+        Returns the resolved data as an immutable BoardFirmware.
+        """
+        return BoardFirmware(self.board_model, self.product_id or None,
+                             self.bios_revision, self.bios_url,
+                             self.ipmi_revision, self.ipmi_url,
+                             self.bios_software_id, self.ipmi_software_id,
+                             error)
+
+    @classmethod
+    def resolve_many(cls, board_models, max_workers=MAX_WORKERS,
+                     refresh=False):
+        """
+        Same as resolve_boards.
+        """
+        return resolve_boards(board_models, max_workers=max_workers,
+                              refresh=refresh)
+
+
+def _resolve_firmware(board_model, product_id, resource_url, refresh=False):
+    """
+    Returns the (revision, url, software_id) of a ProductID. It runs on
+    its own SMC, the boards sharing the ProductID only get the result.
+    """
+    fw_type = RESOURCE_FW_TYPE[resource_url]
+    smc = SMC(board_model)
+    smc.product_id = product_id
+    resources = smc.build_download_url(resource_url, refresh=refresh)
+    info = resources.get(fw_type) or {}
+    return info.get('revision'), info.get('url'), resources['software_id']
+
+
+def resolve_boards(board_models, max_workers=MAX_WORKERS, refresh=False):
+    """
+    Resolve the ProductID, BIOS and IPMI information of many boards at
+    once, and yield a BoardFirmware for every board as soon as it is
+    complete (not in the input order).
+
+    The ProductID lookups and the BIOS and IPMI requests of all boards
+    run concurrently on max_workers threads. Duplicated board models
+    are resolved and yielded once, and boards sharing a ProductID share
+    the BIOS/IPMI requests. A board that fails is yielded with its
+    error instead of stopping the batch.
+
+        for board in SMC.resolve_many(['X11DPU', 'H11DSi']):
+            print(board.board_model, board.bios_revision)
+    """
+    boards = list(dict.fromkeys(board_models))
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    # future -> ('lookup', smc) or ('metadata', (product_id, fw_type))
+    pending = {}
+    # (product_id, fw_type) -> future, shared by the boards of a ProductID
+    metadata = {}
+    # board -> (smc, metadata keys), boards waiting for their metadata
+    waiting = {}
+
+    def _record(smc, keys):
+        errors = []
+        for key in keys:
+            future = metadata[key]
+            fw_type = key[1]
+            try:
+                revision, url, software_id = future.result()
+            except Exception as e:  # noqa
+                errors.append(f"{fw_type}: {e}")
+                continue
+            if fw_type == 'bios':
+                smc.bios_revision, smc.bios_url = revision, url
+                smc.bios_software_id = software_id
+            else:
+                smc.ipmi_revision, smc.ipmi_url = revision, url
+                smc.ipmi_software_id = software_id
+        return smc.record('; '.join(errors) or None)
+
+    try:
+        for board in boards:
+            smc = SMC(board)
+            future = executor.submit(smc.get_board_product_id,
+                                     refresh=refresh)
+            pending[future] = ('lookup', smc)
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                kind, item = pending.pop(future)
+                if kind == 'lookup':
+                    smc = item
+                    try:
+                        product_id = future.result()
+                    except Exception as e:  # noqa
+                        yield smc.record(f"lookup: {e}")
+                        continue
+                    if not product_id:
+                        yield smc.record("lookup: ProductID not found")
+                        continue
+                    keys = []
+                    for resource_url, fw_type in RESOURCE_FW_TYPE.items():
+                        key = (product_id, fw_type)
+                        if key not in metadata:
+                            metadata[key] = executor.submit(
+                                _resolve_firmware, smc.board_model,
+                                product_id, resource_url, refresh=refresh)
+                            pending[metadata[key]] = ('metadata', key)
+                        keys.append(key)
+                    waiting[smc.board_model] = (smc, keys)
+                # yield the boards whose metadata is complete
+                for smc, keys in list(waiting.values()):
+                    if all(metadata[key].done() for key in keys):
+                        del waiting[smc.board_model]
+                        yield _record(smc, keys)
+    finally:
+        # the caller may stop iterating early
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     # smc = SMC('X11DPU')
     smc = SMC('H11DSi-NT')
     smc.get_board_product_id()
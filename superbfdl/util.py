@@ -1,30 +1,244 @@
-import requests
+import fcntl
+import io
 import os
 import shutil
-import re
-from zipfile import ZipFile
+import struct
+from zipfile import BadZipFile, ZipFile, ZIP_STORED
 import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import superbfdl.integrity as integrity
+import superbfdl.matcher as matcher
+import superbfdl.metrics as metrics
+import superbfdl.session as session
+from superbfdl.matcher import FW_NAME_PATTERN  # noqa: F401
 
 __author__ = "Nilson Lopes"
 
-FW_NAME_PATTERN = {
-    'ipmi': r"^[\w\-. ]+\.(bin|BIN)$",
-    'bios': r"^[\w\-. ]+\.([A-Da-d]\d{2}|\d{3}|\d{3}_\w{3}|\w{3}_\w{3})$"
+# write buffer size
+CHUNK_SIZE = 1024 * 1024
+# number of parallel byte ranges used for big files
+SEGMENTS = 4
+# files smaller than this are downloaded in one stream
+SEGMENT_MIN_SIZE = 16 * 1024 * 1024
+
+# nested zip files are opened in memory up to this many bytes in total,
+# above that they are spilled to a temporary file
+NESTED_MEMORY_LIMIT = 64 * 1024 * 1024
+
+_download_settings = {
+    'segments': SEGMENTS,
+    'chunk_size': CHUNK_SIZE,
+    'segment_min_size': SEGMENT_MIN_SIZE,
 }
 
+_extract_settings = {
+    'memory_limit': NESTED_MEMORY_LIMIT,
+}
+
+
+def configure_download(segments=None, chunk_size=None,
+                       segment_min_size=None):
+    """
+    Change the defaults used by download_file.
+    """
+    if segments is not None:
+        _download_settings['segments'] = max(1, segments)
+    if chunk_size is not None:
+        _download_settings['chunk_size'] = chunk_size
+    if segment_min_size is not None:
+        _download_settings['segment_min_size'] = segment_min_size
+
+
+def configure_extract(memory_limit=None):
+    """
+    Change the defaults used to open nested zip files.
+    """
+    if memory_limit is not None:
+        _extract_settings['memory_limit'] = max(0, memory_limit)
+
+
+def extract_settings():
+    """
+    Returns the settings of configure_extract, to be passed on to the
+    extraction processes.
+    """
+    return dict(_extract_settings)
+
+
+def _stream_to(resp, bfile, chunk_size, digest=None):
+    received = 0
+    try:
+        for chunk in resp.iter_content(chunk_size=chunk_size):
+            bfile.write(chunk)
+            if digest is not None:
+                digest.update(chunk)
+            received += len(chunk)
+    finally:
+        metrics.incr('bytes_downloaded', received)
+
+
+def _download_stream(url, part_path, chunk_size, size_kb=None):
+    """
+    Download url into part_path, resuming from the bytes already there.
+    Returns the sha256 digest of the whole file, None on failure.
+    """
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+    with session.stream(url, headers=headers) as resp:
+        if resp.status_code != 416:
+            return _write_stream(resp, url, part_path, offset, chunk_size,
+                                 size_kb)
+    # the partial file does not match the remote one anymore, start over
+    # (once the host slot of this request is free)
+    os.unlink(part_path)
+    return _download_stream(url, part_path, chunk_size, size_kb)
+
+
+def _write_stream(resp, url, part_path, offset, chunk_size, size_kb=None):
+    if resp.status_code not in (200, 206):
+        print(f"[!] Got HTTP {resp.status_code} from {url}")
+        return None
+    total = integrity.check_response(os.path.basename(url), resp.headers,
+                                     resp.status_code, size_kb)
+    digest = integrity.new_digest()
+    if resp.status_code == 206:
+        if offset:
+            print(f"[*] Resuming {os.path.basename(part_path)} "
+                  f"at byte {offset}")
+        integrity.hash_prefix(part_path, digest, chunk_size)
+        mode = "ab"
+    else:
+        # the server ignored the Range header, start over
+        mode = "wb"
+    with open(part_path, mode) as bfile:
+        _stream_to(resp, bfile, chunk_size, digest)
+    if total and os.path.getsize(part_path) != total:
+        # keep the partial file, the next call resumes it
+        print(f"[!] Download of {os.path.basename(url)} stopped at "
+              f"{os.path.getsize(part_path)} of {total} bytes")
+        return None
+    return digest
+
+
+def _download_range(url, seg_path, start, end, chunk_size):
+    """
+    Download the bytes start-end (inclusive) of url into seg_path,
+    resuming from the bytes already there.
+    """
+    have = os.path.getsize(seg_path) if os.path.exists(seg_path) else 0
+    if start + have > end:
+        return True
+    headers = {'Range': f'bytes={start + have}-{end}'}
+    with session.stream(url, headers=headers) as resp:
+        if resp.status_code != 206:
+            print(f"[!] Got HTTP {resp.status_code} for range {start}-{end}")
+            return False
+        with open(seg_path, "ab") as bfile:
+            _stream_to(resp, bfile, chunk_size)
+    return os.path.getsize(seg_path) == end - start + 1
+
+
+def _download_segments(url, part_path, size, segments, chunk_size):
+    """
+    Download url as `segments` parallel byte ranges, each one kept in its
+    own resumable file, then join them into part_path.
+    Returns the sha256 digest of the file, None on failure.
+    """
+    step = -(-size // segments)
+    ranges = [(i, start, min(start + step, size) - 1)
+              for i, start in enumerate(range(0, size, step))]
+    seg_paths = [f"{part_path}{i}" for i, _start, _end in ranges]
+
+    with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+        done = executor.map(
+            lambda r: _download_range(url, seg_paths[r[0]], r[1], r[2],
+                                      chunk_size), ranges)
+        if not all(done):
+            return None
+
+    # the segments are read once more to be joined, hash them meanwhile
+    digest = integrity.new_digest()
+    with open(part_path, "wb") as bfile:
+        for seg_path in seg_paths:
+            with open(seg_path, "rb") as sfile:
+                for chunk in iter(lambda: sfile.read(chunk_size), b''):
+                    bfile.write(chunk)
+                    digest.update(chunk)
+    for seg_path in seg_paths:
+        os.unlink(seg_path)
+    return digest
+
+
+def _probe(url, size_kb=None):
+    """
+    Returns the size of the remote file and whether the server accepts
+    byte ranges.
+    """
+    resp = session.head(url)
+    if resp.status_code != 200:
+        return 0, False
+    size = integrity.check_response(os.path.basename(url), resp.headers,
+                                    resp.status_code, size_kb)
+    ranges = resp.headers.get('Accept-Ranges', '').lower() == 'bytes'
+    return size, ranges
+
+
+def download_verified(url, dl_path, size_kb=None, segments=None,
+                      chunk_size=None):
+    """
+    Download url into dl_path, returns (file name, sha256) or
+    (None, None).
+
+    Data is written to '{file_name}.part' which is renamed once the
+    download is complete, so an interrupted download resumes from where
+    it stopped (HTTP Range) on the next call. Files bigger than
+    segment_min_size are split in `segments` parallel byte ranges when
+    the server supports it.
+
+    The size announced by the download page (size_kb) is checked
+    against the Content-Length before the transfer, and the sha256 is
+    computed while the data is written. Raises
+    integrity.IntegrityError when the checks fail.
+    """
+    from requests import RequestException
+
+    segments = segments or _download_settings['segments']
+    chunk_size = chunk_size or _download_settings['chunk_size']
 
-def download_file(url, dl_path):
     file_name = url.split("/")[-1].strip()
     print("[*] Downloading {0} to {1}".format(file_name, dl_path))
-    resp = requests.get(url, stream=True)
-    if resp.status_code == 200:
-        file_path = os.path.join(dl_path, file_name)
-        with open(file_path, "wb") as bfile:
-            for chunk in resp.iter_content(chunk_size=1024):
-                bfile.write(chunk)
-        return file_name
+    file_path = os.path.join(dl_path, file_name)
+    part_path = file_path + ".part"
 
-    return None
+    try:
+        size, ranges = (0, False)
+        if segments > 1:
+            size, ranges = _probe(url, size_kb)
+        if ranges and size >= _download_settings['segment_min_size']:
+            digest = _download_segments(url, part_path, size, segments,
+                                        chunk_size)
+        else:
+            digest = _download_stream(url, part_path, chunk_size, size_kb)
+    except RequestException as e:
+        print(f"[!] Download of {file_name} interrupted: {e}")
+        return None, None
+
+    if digest is None:
+        return None, None
+    os.replace(part_path, file_path)
+    return file_name, digest.hexdigest()
+
+
+def download_file(url, dl_path, segments=None, chunk_size=None):
+    """
+    Download url into dl_path and return the file name, see
+    download_verified.
+    """
+    return download_verified(url, dl_path, segments=segments,
+                             chunk_size=chunk_size)[0]
 
 
 def write_version(output_dir, version):
@@ -48,48 +262,273 @@ def mkdir(path):
         print(err.strerror)
 
 
-def locate_and_move(dir_from, dir_to, fw_type):
+@contextmanager
+def file_lock(path):
+    """
+    Exclusive lock held on the file `path` (created if needed). The lock
+    is shared by threads and processes, each call opens its own file
+    description so flock() serializes them all.
+    """
+    with open(path, "a") as lfile:
+        fcntl.flock(lfile.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lfile.fileno(), fcntl.LOCK_UN)
+
+
+def locate_and_move(dir_from, dir_to, fw_type, board_model=None,
+                    move=False):
     """
     Uses a regular expression to match bios or
     firmware files according to a pattern.
-    The locate file in then moved to a given directory.
+    The best match (see matcher.rank) is then placed in a given
+    directory, hardlinked or reflinked when possible, and moved instead
+    of copied with move=True.
     """
-    if fw_type not in ['bios', 'ipmi']:
-        raise ValueError('fw_type should be "bios" or "ipmi", {} given'.format(
-            type(fw_type)))
-
-    pattern = FW_NAME_PATTERN.get(fw_type)
-    for root, _dirs, files in os.walk(dir_from):
-        for file in files:
-            res = re.match(pattern, file)
-            if res:
-                filename = os.path.join(root, file)
-                shutil.copy(filename, dir_to)
-                return os.path.join(dir_to, file)
+    candidate = matcher.best_match(dir_from, fw_type, board_model)
+    if candidate:
+        target, _method = matcher.place(candidate.path, dir_to, move=move)
+        return target
 
 
-def extract_zip(zipfile="", path_from_local=""):
+def extract_zip(zipfile="", path_from_local="", extract_to=None):
     """
-    Extract a zip file recursively
+    Extract a zip file recursively.
+    By default the archive is extracted next to it, use extract_to
+    to choose another directory. The content of a nested zip file is
+    extracted to a directory of the same name without the .zip
+    extension, the nested zip file itself is not written.
     """
     filepath = path_from_local + zipfile
-    extract_path = filepath.strip(".zip") + "/"
-    parent_archive = ZipFile(filepath)
-    parent_archive.extractall(extract_path)
-    namelist = parent_archive.namelist()
-    parent_archive.close()
-    for name in namelist:
+    if extract_to:
+        extract_path = os.path.join(extract_to, "")
+    else:
+        base, ext = os.path.splitext(filepath)
+        extract_path = (base if ext.lower() == ".zip" else filepath) + "/"
+    with ZipFile(filepath) as archive:
+        for parent, info, name in _iter_members(archive, nested_dirs=True):
+            target = os.path.join(extract_path, name)
+            # the names come from the archive, keep them inside
+            if not os.path.abspath(target).startswith(
+                    os.path.abspath(extract_path) + os.sep):
+                sys.stderr.write(f'Skipping {name}, outside of '
+                                 f'{extract_path}\n')
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with parent.open(info) as src, open(target, "wb") as dst:
+                shutil.copyfileobj(src, dst, CHUNK_SIZE)
+    return extract_path
+
+
+class _MemberWindow(io.RawIOBase):
+    """
+    Read-only view of the bytes of a stored (not compressed) member,
+    read straight from the file of its archive. A nested zip file
+    stored that way is opened without copying it.
+    """
+    def __init__(self, fileobj, start, size):
+        super().__init__()
+        self._file = fileobj
+        self._start = start
+        self._size = size
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._pos = max(0, offset)
+        return self._pos
+
+    def readinto(self, buffer):
+        count = max(0, min(len(buffer), self._size - self._pos))
+        if not count:
+            return 0
+        # the file is shared with the parent archive, always seek first
+        self._file.seek(self._start + self._pos)
+        data = self._file.read(count)
+        buffer[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+
+class _MemoryBudget(object):
+    """
+    Bytes of nested zip files that may be held in memory at the same
+    time, shared by all the nesting levels of one archive.
+    """
+    def __init__(self, limit):
+        self.available = limit
+
+    def take(self, size):
+        if size > self.available:
+            return False
+        self.available -= size
+        return True
+
+    def give(self, size):
+        self.available += size
+
+
+def _member_window(archive, info):
+    """
+    Returns a _MemberWindow on a stored member of archive, or None when
+    the member is compressed or encrypted.
+    """
+    if info.compress_type != ZIP_STORED or info.flag_bits & 0x1:
+        return None
+    fileobj = archive.fp
+    fileobj.seek(info.header_offset)
+    header = fileobj.read(30)
+    if len(header) != 30 or header[:4] != b"PK\x03\x04":
+        return None
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    start = info.header_offset + 30 + name_length + extra_length
+    return _MemberWindow(fileobj, start, info.file_size)
+
+
+@contextmanager
+def _open_nested(archive, info, budget):
+    """
+    Open the nested zip file `info` of archive, without writing it to
+    disk when possible:
+
+    - a stored member is read in place, from the file of its parent
+    - a compressed one is decompressed in memory while the budget
+      allows it
+    - above that it is spilled to an anonymous temporary file
+    """
+    window = _member_window(archive, info)
+    if window is not None:
+        metrics.incr('nested_zips', mode='stream')
+        with ZipFile(window) as nested:
+            yield nested
+    elif budget.take(info.file_size):
+        metrics.incr('nested_zips', mode='memory')
         try:
+            with ZipFile(io.BytesIO(archive.read(info))) as nested:
+                yield nested
+        finally:
+            budget.give(info.file_size)
+    else:
+        metrics.incr('nested_zips', mode='spill')
+        with tempfile.TemporaryFile() as spill:
+            with archive.open(info) as src:
+                shutil.copyfileobj(src, spill, CHUNK_SIZE)
+            with ZipFile(spill) as nested:
+                yield nested
+
+
+def _iter_members(archive, prefix="", only=None, budget=None,
+                  nested_dirs=False):
+    """
+    Yield (archive, info, path) for every file of a zip archive, looking
+    into the nested zip files (see _open_nested). With only, the nested
+    zip files that do not contain the path `only` are skipped. The path
+    of a file in a nested zip goes through the name of the zip, or its
+    name without the .zip extension with nested_dirs.
+    """
+    if budget is None:
+        budget = _MemoryBudget(_extract_settings['memory_limit'])
+    for info in archive.infolist():
+        if info.is_dir():
+            continue
+        name = prefix + info.filename
+        if info.filename.lower().endswith(".zip"):
             # dont extract sum utility
-            if name.lower().startswith('sum'):
+            if os.path.basename(info.filename).lower().startswith('sum'):
                 continue
-            if name[-4:] == ".zip":
-                extract_zip(zipfile=name, path_from_local=extract_path)
+            if nested_dirs:
+                name = name[:-len(".zip")]
+            if only and not only.startswith(name + "/"):
+                continue
+            try:
+                with _open_nested(archive, info, budget) as nested:
+                    yield from _iter_members(nested, prefix=name + "/",
+                                             only=only, budget=budget,
+                                             nested_dirs=nested_dirs)
+            except (BadZipFile, OSError) as e:
+                sys.stderr.write(f'Error while extracting {name}: {e}\n')
+                continue
+        else:
+            yield archive, info, name
 
-        except Exception as e:  # noqa
-            sys.stderr.write(f'Error while extracting {name}\n')
-            pass
-    return extract_path
+
+def candidates(zip_path, fw_type):
+    """
+    Scan the central directory of a zip file, and of the zip files
+    nested in it, and return the members matching the bios or firmware
+    pattern (matcher.Candidate).
+    """
+    pattern = matcher.pattern(fw_type)
+    with ZipFile(zip_path) as archive:
+        return [
+            matcher.Candidate(name, os.path.basename(info.filename),
+                              name.count("/"))
+            for _parent, info, name in _iter_members(archive)
+            if pattern.match(os.path.basename(info.filename))
+        ]
+
+
+def best_member(zip_path, fw_type, board_model=None):
+    """
+    Returns the member of a zip file matching fw_type that ranks best
+    (see candidates and matcher.rank), or None.
+    """
+    found = candidates(zip_path, fw_type)
+    if not found:
+        return None
+    return matcher.rank(found, board_model)[0]
+
+
+def extract_matching(zip_path, dest, fw_type, board_model=None):
+    """
+    Extract only the best match for fw_type (see best_member) straight
+    into dest.
+    Returns the path of the extracted file, or None.
+    """
+    best = best_member(zip_path, fw_type, board_model)
+    if not best:
+        return None
+    return extract_member(zip_path, best, dest)
+
+
+def extract_member(zip_path, member, dest):
+    """
+    Extract the member (a matcher.Candidate, its path goes through the
+    nested zip files) of a zip file into dest.
+    Returns the path of the extracted file, or None.
+    """
+    with ZipFile(zip_path) as archive:
+        for parent, info, name in _iter_members(archive, only=member.path):
+            if name != member.path:
+                continue
+            file_name = member.name
+            target = os.path.join(dest, file_name)
+            # a private temporary name, so jobs extracting the same file
+            # at the same time never write over each other
+            fd, tmp_name = tempfile.mkstemp(dir=dest, prefix=".extract-")
+            try:
+                with parent.open(info) as src, os.fdopen(fd, "wb") as dst:
+                    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+                os.chmod(tmp_name, 0o644)
+                os.replace(tmp_name, target)
+            finally:
+                if os.path.exists(tmp_name):
+                    os.unlink(tmp_name)
+            return target
+    return None
 
 
 def download_extract(file):
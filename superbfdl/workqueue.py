@@ -0,0 +1,359 @@
+"""
+Work queue shared by several hosts.
+
+A coordinator splits a board list into tasks, one per board or one per
+(board, fw_type), in a queue directory every host can reach (NFS):
+
+    superbfdl coordinate -f boards.txt --queue /nfs/superbfdl/queue --wait
+
+and workers on any host claim the tasks and run the usual lookup,
+metadata, download and extraction stages:
+
+    superbfdl worker --queue /nfs/superbfdl/queue -p /nfs/firmware -j 4
+
+A task moves between the pending/, claimed/ and done/ subdirectories,
+and every move is a rename, which is atomic on a local filesystem and
+on NFS. There is no broker and no lock: when two workers claim the same
+task only one rename succeeds. The state is in the file names:
+
+    pending/{task}.{attempt}.json
+    claimed/{task}.{attempt}.{worker}.{expires}.json
+    done/{task}.json
+
+A worker holds a lease on the tasks it claimed and renews it (a rename
+to the new expiry) while it works. The lease of a worker that died
+expires, and the task is put back in pending/ by the next worker or
+coordinator that looks, up to max_attempts times. The leases compare
+the clocks of the hosts, keep them in sync (NTP) and the lease well
+above the skew.
+"""
+import json
+import os
+import re
+import socket
+import threading
+import time
+
+# seconds a claimed task stays with its worker without a renewal
+LEASE = 300
+# runs of a task (failures and expired leases) before it is given up
+MAX_ATTEMPTS = 3
+# seconds between two looks at the queue when nothing can be claimed
+POLL = 5
+
+STATES = ('pending', 'claimed', 'done')
+
+
+def _safe(name):
+    """
+    Task and worker names go in file names, with '.' as the separator.
+    """
+    return re.sub(r"[^\w+\-]", "_", name)
+
+
+def worker_name():
+    return _safe(f"{socket.gethostname()}-{os.getpid()}")
+
+
+class Lease(object):
+    """
+    A task claimed by a worker, name is its current file in claimed/.
+    """
+    def __init__(self, queue, task_id, attempt, worker, name, task):
+        self.queue = queue
+        self.task_id = task_id
+        self.attempt = attempt
+        self.worker = worker
+        self.name = name
+        self.task = task
+        self.lost = False
+
+    def renew(self):
+        """
+        Push the expiry of the lease. Returns False when the lease
+        expired and the task was put back in the queue.
+        """
+        name = self.queue.claimed_name(self.task_id, self.attempt,
+                                       self.worker)
+        try:
+            os.rename(self.queue.path_of('claimed', self.name),
+                      self.queue.path_of('claimed', name))
+        except FileNotFoundError:
+            self.lost = True
+            return False
+        self.name = name
+        return True
+
+
+class WorkQueue(object):
+    def __init__(self, path, lease=LEASE, max_attempts=MAX_ATTEMPTS):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        for state in STATES:
+            os.makedirs(os.path.join(path, state), exist_ok=True)
+
+    def path_of(self, state, name):
+        return os.path.join(self.path, state, name)
+
+    def claimed_name(self, task_id, attempt, worker):
+        expires = int(time.time() + self.lease)
+        return f"{task_id}.{attempt}.{worker}.{expires}.json"
+
+    def _names(self, state):
+        try:
+            return sorted(n for n in os.listdir(os.path.join(self.path,
+                                                             state))
+                          if n.endswith(".json"))
+        except FileNotFoundError:
+            return []
+
+    def _write(self, state, name, data):
+        # written aside and renamed, a reader never sees a partial file
+        tmp_name = self.path_of(state, f".{name}.{worker_name()}.tmp")
+        with open(tmp_name, 'w') as tfile:
+            json.dump(data, tfile, sort_keys=True)
+        os.replace(tmp_name, self.path_of(state, name))
+
+    def _read(self, state, name):
+        with open(self.path_of(state, name)) as tfile:
+            return json.load(tfile)
+
+    def reset(self):
+        """
+        Remove the results of the previous tasks.
+        """
+        for name in self._names('done'):
+            os.unlink(self.path_of('done', name))
+
+    def put(self, task_id, task):
+        """
+        Add a task (a JSON serializable dict) to the queue.
+        """
+        task_id = _safe(task_id)
+        self._write('pending', f"{task_id}.1.json", task)
+        return task_id
+
+    def submit_boards(self, boards, fw_types, split='board'):
+        """
+        Add one task per board (split='board') or per (board, fw_type)
+        (split='artifact'). Returns the task ids.
+        """
+        ids = []
+        for index, board in enumerate(boards):
+            if split == 'artifact':
+                for fw_type in fw_types:
+                    ids.append(self.put(f"{index:06d}-{board}-{fw_type}",
+                                        {'board': board,
+                                         'fw_types': [fw_type]}))
+            else:
+                ids.append(self.put(f"{index:06d}-{board}",
+                                    {'board': board,
+                                     'fw_types': list(fw_types)}))
+        return ids
+
+    def claim(self, worker):
+        """
+        Claim the first pending task. Returns a Lease, or None when no
+        task is pending.
+        """
+        for name in self._names('pending'):
+            task_id, attempt, _ext = name.split('.')
+            claimed = self.claimed_name(task_id, attempt, worker)
+            try:
+                os.rename(self.path_of('pending', name),
+                          self.path_of('claimed', claimed))
+            except FileNotFoundError:
+                # claimed by another worker meanwhile
+                continue
+            return Lease(self, task_id, int(attempt), worker, claimed,
+                         self._read('claimed', claimed))
+        return None
+
+    def complete(self, lease, result):
+        """
+        Record the result of a task, and release its lease.
+        """
+        result = dict(lease.task, result=result, worker=lease.worker,
+                      attempts=lease.attempt, finished=time.time())
+        self._write('done', f"{lease.task_id}.json", result)
+        try:
+            os.unlink(self.path_of('claimed', lease.name))
+        except FileNotFoundError:
+            # the lease expired, the task may run once more elsewhere
+            lease.lost = True
+
+    def retry(self, lease, error):
+        """
+        Put back a failed task in the queue, or record it as done with
+        error once it ran max_attempts times.
+        """
+        if lease.attempt >= self.max_attempts:
+            return self.complete(lease, {'error': error})
+        try:
+            os.rename(self.path_of('claimed', lease.name),
+                      self.path_of('pending', f"{lease.task_id}."
+                                   f"{lease.attempt + 1}.json"))
+        except FileNotFoundError:
+            lease.lost = True
+
+    def requeue_expired(self):
+        """
+        Put back the claimed tasks whose lease expired. Returns the
+        number of tasks requeued (or given up).
+        """
+        count = 0
+        now = time.time()
+        for name in self._names('claimed'):
+            task_id, attempt, worker, expires, _ext = name.split('.')
+            if int(expires) > now:
+                continue
+            attempt = int(attempt)
+            if attempt >= self.max_attempts:
+                lease = Lease(self, task_id, attempt, worker, name, None)
+                try:
+                    lease.task = self._read('claimed', name)
+                except FileNotFoundError:
+                    continue
+                self.complete(lease, {'error': 'lease expired'})
+                if lease.lost:
+                    continue
+            else:
+                try:
+                    os.rename(self.path_of('claimed', name),
+                              self.path_of('pending', f"{task_id}."
+                                           f"{attempt + 1}.json"))
+                except FileNotFoundError:
+                    continue
+            print(f"[!] Lease of {task_id} by {worker} expired")
+            count += 1
+        return count
+
+    def counts(self):
+        return {state: len(self._names(state)) for state in STATES}
+
+    def results(self):
+        """
+        Returns the done tasks, by task id.
+        """
+        results = {}
+        for name in self._names('done'):
+            try:
+                results[name[:-len(".json")]] = self._read('done', name)
+            except (FileNotFoundError, ValueError):
+                continue
+        return results
+
+    def empty(self):
+        """
+        True when no task is pending or claimed.
+        """
+        counts = self.counts()
+        return not counts['pending'] and not counts['claimed']
+
+
+class Worker(object):
+    """
+    Claim tasks from a queue and run them with `run(task)`, on `jobs`
+    threads, renewing the leases while they run. run returns the
+    (JSON serializable) result of the task and raises on failure.
+    """
+    def __init__(self, queue, run, jobs=1, poll=POLL, name=None):
+        self.queue = queue
+        self.run_task = run
+        self.jobs = jobs
+        self.poll = poll
+        self.name = name or worker_name()
+        self._lock = threading.Lock()
+        self._leases = []
+        self._stop = threading.Event()
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.queue.lease / 3):
+            with self._lock:
+                leases = list(self._leases)
+            for lease in leases:
+                try:
+                    if not lease.lost and not lease.renew():
+                        print(f"[!] Lost the lease of {lease.task_id}")
+                except OSError as e:
+                    # tried again on the next beat
+                    print(f"[!] Could not renew the lease of "
+                          f"{lease.task_id}: {e}")
+
+    def _finish(self, finish, lease, outcome):
+        """
+        Record the outcome of a task with queue.complete or queue.retry.
+        When the queue cannot be written, the task is left to its lease,
+        which expires and puts it back in the queue.
+        """
+        try:
+            finish(lease, outcome)
+        except OSError as e:
+            print(f"[!] Could not record the outcome of {lease.task_id}: "
+                  f"{e}")
+
+    def _loop(self, forever):
+        while not self._stop.is_set():
+            try:
+                lease = self.queue.claim(self.name)
+                if lease is None:
+                    self.queue.requeue_expired()
+                    if not forever and self.queue.empty():
+                        return
+            except OSError as e:
+                # the queue directory is unreachable, try again later
+                print(f"[!] Could not read the queue {self.queue.path}: {e}")
+                lease = None
+            if lease is None:
+                self._stop.wait(self.poll)
+                continue
+            print(f"[*] {self.name} runs {lease.task_id} "
+                  f"(attempt {lease.attempt})")
+            with self._lock:
+                self._leases.append(lease)
+            try:
+                result = self.run_task(lease.task)
+            except Exception as e:  # noqa
+                print(f"[!] {lease.task_id} failed: {e}")
+                self._finish(self.queue.retry, lease,
+                             f"{type(e).__name__}: {e}")
+            else:
+                self._finish(self.queue.complete, lease, result)
+            finally:
+                with self._lock:
+                    self._leases.remove(lease)
+
+    def run(self, forever=False):
+        """
+        Run tasks until the queue is empty, or until stop() with
+        forever.
+        """
+        heartbeat = threading.Thread(target=self._heartbeat, daemon=True)
+        heartbeat.start()
+        loops = [threading.Thread(target=self._loop, args=(forever, ))
+                 for _ in range(self.jobs)]
+        for loop in loops:
+            loop.start()
+        try:
+            for loop in loops:
+                loop.join()
+        finally:
+            self._stop.set()
+
+    def stop(self):
+        self._stop.set()
+
+
+def wait(queue, poll=POLL):
+    """
+    Coordinator side: requeue the expired leases until every task is
+    done, then return the results.
+    """
+    while not queue.empty():
+        queue.requeue_expired()
+        counts = queue.counts()
+        print(f"[*] {counts['pending']} pending, {counts['claimed']} "
+              f"running, {counts['done']} done")
+        time.sleep(poll)
+    return queue.results()
@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+BENCHMARKS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                          'benchmarks')
+# the stand-in site of the benchmarks
+sys.path.insert(0, BENCHMARKS)
+
+
+@pytest.fixture
+def standin():
+    """
+    Returns (standin, url) of a stand-in of the vendor site, see
+    benchmarks/server.py.
+    """
+    import server
+    httpd, site, url = server.start(payload_size=64 * 1024)
+    yield site, url
+    httpd.shutdown()
+    httpd.server_close()
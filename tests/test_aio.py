@@ -0,0 +1,50 @@
+import asyncio
+import hashlib
+import os
+
+import pytest
+
+import superbfdl.ratelimit as ratelimit
+
+aio = pytest.importorskip('superbfdl.aio')
+pytest.importorskip('aiohttp')
+
+
+@pytest.fixture(autouse=True)
+def limiters():
+    yield
+    ratelimit.configure(rate=ratelimit.RATE,
+                        max_concurrency=ratelimit.MAX_CONCURRENCY)
+
+
+def _download(url, dest, **kwargs):
+    async def run():
+        async with aio.AsyncEngine(**kwargs) as engine:
+            return await asyncio.wait_for(engine.download_file(url, dest),
+                                          timeout=10)
+    return asyncio.run(run())
+
+
+def test_stale_part_restarts_with_one_slot(tmp_path, standin):
+    site, url = standin
+    ratelimit.configure(rate=0)
+    data = site.bundle("12612")
+    with open(tmp_path / "X11DPU.zip.part", 'wb') as part:
+        part.write(b"x" * (len(data) + 10))
+    name, sha256 = _download(f"{url}/Bios/softfiles/12612/X11DPU.zip",
+                             str(tmp_path), per_host=1)
+    assert name == "X11DPU.zip"
+    assert sha256 == hashlib.sha256(data).hexdigest()
+    assert not os.path.exists(tmp_path / "X11DPU.zip.part")
+
+
+def test_part_is_resumed(tmp_path, standin):
+    site, url = standin
+    ratelimit.configure(rate=0)
+    data = site.bundle("12612")
+    with open(tmp_path / "X11DPU.zip.part", 'wb') as part:
+        part.write(data[:1000])
+    _name, sha256 = _download(f"{url}/Bios/softfiles/12612/X11DPU.zip",
+                              str(tmp_path), per_host=1)
+    assert sha256 == hashlib.sha256(data).hexdigest()
+    assert site.requests['download'] == 1
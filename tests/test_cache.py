@@ -0,0 +1,132 @@
+import os
+import time
+from zipfile import ZipFile
+
+import superbfdl.cache as cache
+import superbfdl.util as util
+
+URL = "https://www.supermicro.com/Bios/softfiles/12612/X11DPU3_4.zip"
+
+
+def _store(tmp_path, url=URL, files=("X11DPU9.A04", "X11DPUZ9.A04")):
+    downloads = cache.DownloadCache(str(tmp_path / "downloads"))
+    key = downloads.key(url)
+    zip_path = os.path.join(downloads.entry_dir(key), os.path.basename(key))
+    with ZipFile(zip_path, 'w') as archive:
+        for name in files:
+            archive.writestr(f"BIOS/{name}", b"firmware " + name.encode())
+    downloads.store(key, url)
+    return downloads, key
+
+
+def test_candidates_are_listed_once(tmp_path, monkeypatch):
+    downloads, _key = _store(tmp_path)
+    scans = []
+    candidates = util.candidates
+    monkeypatch.setattr(util, 'candidates',
+                        lambda *args: scans.append(args) or candidates(*args))
+    for board in ("X11DPU", "X11DPU-Z+"):
+        dest = tmp_path / board
+        dest.mkdir()
+        assert downloads.extract(URL, 'bios', str(dest), board)
+    assert len(scans) == 1
+    assert os.listdir(tmp_path / "X11DPU") == ["X11DPU9.A04"]
+    assert len(os.listdir(tmp_path / "X11DPU-Z+")) == 1
+
+
+def test_pinned_archive_is_not_evicted(tmp_path):
+    downloads, key = _store(tmp_path)
+    other = URL.replace("12612", "12613")
+    _store(tmp_path, other)
+    downloads.max_size = 0
+    pin = downloads.pin(URL)
+    downloads.evict(keep=downloads.key(other))
+    assert downloads.lookup(key)
+    downloads.unpin(pin)
+    downloads.evict(keep=downloads.key(other))
+    assert not downloads.lookup(key)
+
+
+def test_stale_pin_is_ignored(tmp_path):
+    downloads, key = _store(tmp_path)
+    downloads.max_size = 0
+    pin = downloads.pin(URL)
+    stale = time.time() - cache.PIN_TTL - 1
+    os.utime(pin, (stale, stale))
+    downloads.evict()
+    assert not downloads.lookup(key)
+    assert not os.path.exists(pin)
+
+
+def test_put_many_writes_once(tmp_path, monkeypatch):
+    ids = cache.JSONCache(str(tmp_path / "product_ids.json"))
+    ids.put("X11DPU", "85553")
+    writes = []
+    write = ids._write
+    monkeypatch.setattr(ids, '_write',
+                        lambda entries: writes.append(1) or write(entries))
+    ids.put_many({"H11DSi": "90001", "X11SPM": "90002"})
+    assert len(writes) == 1
+    fresh = cache.JSONCache(ids.path)
+    assert [fresh.get(board) for board in ("X11DPU", "H11DSi", "X11SPM")] \
+        == ["85553", "90001", "90002"]
+
+
+def test_lookup_hashes_only_changed_files(tmp_path, monkeypatch):
+    downloads, key = _store(tmp_path)
+    hashes = []
+    sha256 = cache.file_sha256
+    monkeypatch.setattr(cache, 'file_sha256',
+                        lambda path: hashes.append(path) or sha256(path))
+    assert downloads.lookup(key)
+    assert hashes == []
+    assert downloads.lookup(key, verify=True)
+    assert len(hashes) == 1
+    # same content, new mtime: hashed once, then trusted again
+    os.utime(downloads.lookup(key), (0, 0))
+    assert downloads.lookup(key) and downloads.lookup(key)
+    assert len(hashes) == 2
+
+
+def test_corrupted_file_is_dropped_with_its_entry(tmp_path):
+    downloads, key = _store(tmp_path)
+    dest = tmp_path / "X11DPU"
+    dest.mkdir()
+    assert downloads.extract(URL, 'bios', str(dest), "X11DPU")
+    with open(os.path.join(downloads.path, key), 'r+b') as zfile:
+        zfile.write(b"garbage")
+    assert downloads.lookup(key) is None
+    assert downloads.index.entry(key) is None
+    assert not os.path.exists(os.path.join(downloads.path, key))
+    assert not os.path.exists(downloads.extracted_dir(key))
+
+
+def test_update_keeps_concurrent_changes(tmp_path):
+    index = cache.JSONCache(str(tmp_path / "index.json"))
+    index.put("12612/X11DPU.zip", {'size': 10})
+    # another process adds the size of an extracted file
+    cache.JSONCache(index.path).update(
+        "12612/X11DPU.zip", lambda info: dict(info, size=info['size'] + 5))
+    index.update("12612/X11DPU.zip", lambda info: dict(info, used=True))
+    assert index.get("12612/X11DPU.zip") == {'size': 15, 'used': True}
+    assert index.update("missing", lambda info: info) is None
+    assert index.entry("missing") is None
+
+
+def test_invalidate(tmp_path):
+    cache.configure(cache_dir=str(tmp_path))
+    try:
+        ids = cache.product_id_cache()
+        ids.put_many({"X11DPU": "85553", "H11DSi": "90001"})
+        metadata = cache.metadata_cache()
+        for product_id in ("85553", "90001"):
+            for fw_type in ('bios', 'ipmi'):
+                metadata.put(cache.metadata_key(product_id, fw_type), {})
+        assert cache.invalidate('ids', ["X11DPU"]) == 1
+        assert ids.get("X11DPU") is None and ids.get("H11DSi") == "90001"
+        assert cache.invalidate('metadata', ["85553"]) == 2
+        assert metadata.get(cache.metadata_key("90001", 'bios')) == {}
+        assert cache.invalidate('metadata') == 2
+        assert cache.invalidate('ids') == 1
+    finally:
+        cache.configure(cache_dir=cache.CACHE_DIR)
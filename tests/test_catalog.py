@@ -0,0 +1,55 @@
+import pytest
+
+import superbfdl.catalog as catalog
+
+
+@pytest.fixture(autouse=True)
+def database(tmp_path):
+    catalog.configure(str(tmp_path / "catalog.sqlite"))
+    yield
+    catalog.configure(None)
+
+
+def _info(board, revision, software_id="12612", product_id="85553"):
+    return {'board_model': board, 'product_id': product_id,
+            'bios': {'release': revision}, 'software_id': software_id,
+            'download_url': f"https://www.supermicro.com/Bios/softfiles/"
+                            f"{software_id}/bundle.zip",
+            'size_kb': 75401}
+
+
+def test_file_is_kept_until_the_revision_changes(tmp_path):
+    firmware = str(tmp_path / "X11DPU9.A04")
+    catalog.record(_info("X11DPU", "3.4"), 'bios', file=firmware,
+                   sha256="ab" * 32)
+    # resolved again, nothing extracted this time
+    catalog.record(_info("X11DPU", "3.4"), 'bios')
+    row, = catalog.where("X11DPU")
+    assert (row['file'], row['sha256']) == (firmware, "ab" * 32)
+    # a new revision forgets the file of the old one
+    catalog.record(_info("X11DPU", "3.5", software_id="12700"), 'bios')
+    row, = catalog.where("X11DPU")
+    assert row['revision'] == "3.5" and row['software_id'] == "12700"
+    assert row['file'] is None and row['sha256'] is None
+
+
+def test_newer_compares_versions():
+    for board, revision in (("X11DPU", "3.4"), ("X11SPM", "3.10"),
+                            ("H11DSi", "2.9"), ("X10DRW", "3.4.1")):
+        catalog.record(_info(board, revision), 'bios')
+    # 3.10 is newer than 3.4, unlike in a string comparison
+    assert [row['board_model'] for row in catalog.newer('bios', "3.4")] \
+        == ["X10DRW", "X11SPM"]
+    assert catalog.newer('ipmi', "0") == []
+
+
+def test_boards_of_a_bundle():
+    catalog.record(_info("X11DPU", "3.4"), 'bios')
+    catalog.record(_info("X11DPU-Z+", "3.4"), 'bios')
+    catalog.record(_info("H11DSi", "2.9", software_id="13000"), 'bios')
+    assert [row['board_model'] for row in catalog.boards_of("12612")] == \
+        ["X11DPU", "X11DPU-Z+"]
+    assert catalog.boards_of("99999") == []
+    assert catalog.shared() == [
+        ("12612", "https://www.supermicro.com/Bios/softfiles/12612/"
+         "bundle.zip", ["X11DPU", "X11DPU-Z+"])]
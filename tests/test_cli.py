@@ -0,0 +1,53 @@
+import os
+import sys
+
+import pytest
+
+import superbfdl.cache as cache
+import superbfdl.catalog as catalog
+import superbfdl.cli as cli
+import superbfdl.core as core
+
+
+@pytest.mark.parametrize('mode', (['--server', 'http://127.0.0.1:8765'],
+                                  ['--async']))
+@pytest.mark.parametrize('journal', (['--resume'], ['--journal', 'j.jsonl']))
+def test_journal_needs_the_job_engine(monkeypatch, capsys, tmp_path,
+                                      mode, journal):
+    monkeypatch.setattr(sys, 'argv', ['superbfdl', '-b', 'X11DPU', '-p',
+                                      str(tmp_path)] + mode + journal)
+    with pytest.raises(SystemExit):
+        cli.main()
+    assert "--journal and --resume" in capsys.readouterr().err
+
+
+@pytest.mark.parametrize('extract_workers', (0, 2))
+def test_fleet_shares_a_bundle(standin, tmp_path, monkeypatch, capsys,
+                               extract_workers):
+    site, url = standin
+    monkeypatch.setattr(core, 'SUPERMICRO_URL', url)
+    cache.configure(cache_dir=str(tmp_path / "cache"))
+    catalog.configure(str(tmp_path / "catalog.sqlite"))
+    boards = ["X12STH", "X12STH-F", "X12STH-LN4F"]
+    try:
+        results = cli.dispatch_fleet(boards, str(tmp_path / "out"),
+                                     max_workers=4,
+                                     extract_workers=extract_workers)
+    finally:
+        cache.configure(cache_dir=cache.CACHE_DIR)
+        catalog.configure(None)
+
+    assert results == {board: {'bios': True, 'ipmi': True}
+                       for board in boards}
+    sid = site.software_id("X12STH")
+    for board in boards:
+        assert sorted(os.listdir(tmp_path / "out" / board / "bios")) == \
+            [f"X11DPU9.{sid[-3:]}", "version.txt"]
+        assert f"SMT_X11AST2500_{sid}.bin" in \
+            os.listdir(tmp_path / "out" / board / "ipmi")
+    # one transfer (and its HEAD probe) for the three boards
+    assert site.requests['download'] == 2
+    out = capsys.readouterr().out
+    assert "[*] Processed 3 boards, 0 with failures" in out
+    for stage, count in (('lookup', 3), ('metadata', 6), ('extract', 6)):
+        assert f"    {stage:<10} {count:>6} " in out
@@ -0,0 +1,31 @@
+import pytest
+
+import superbfdl.cache as cache
+import superbfdl.core as core
+
+
+@pytest.fixture
+def site(standin, tmp_path, monkeypatch):
+    site, url = standin
+    monkeypatch.setattr(core, 'SUPERMICRO_URL', url)
+    # every cached entry is stale at once, and revalidated
+    cache.configure(cache_dir=str(tmp_path), metadata_ttl=0)
+    yield site
+    cache.configure(cache_dir=cache.CACHE_DIR,
+                    metadata_ttl=cache.METADATA_TTL)
+
+
+def test_stale_results_are_revalidated(site, monkeypatch):
+    import server
+    product_id = server.product_id('X11DPU')
+    first = core.fetch_results('X11DPU', product_id, 'bios')
+    assert first['software_id'] == site.software_id('X11DPU')
+
+    sent = []
+    post = core.session.post
+    monkeypatch.setattr(core.session, 'post', lambda url, **kwargs:
+                        sent.append(kwargs['headers']) or post(url, **kwargs))
+    assert core.fetch_results('X11DPU', product_id, 'bios') == first
+    assert sent[0]['If-None-Match'] == f'"{first["software_id"]}"'
+    assert site.requests['results'] == 2
+    assert site.requests['not_modified'] == 1
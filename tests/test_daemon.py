@@ -0,0 +1,85 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import superbfdl.daemon as daemon
+
+
+class FakeMirror(daemon.Mirror):
+    """
+    A mirror whose syncs find nothing, and block until released.
+    """
+    def __init__(self, path, **kwargs):
+        super().__init__(None, path, **kwargs)
+        self.syncs = 0
+        self.release = threading.Event()
+
+    def sync(self, boards):
+        self.syncs += 1
+        self.release.wait(5)
+        return {board: None for board in boards}
+
+
+def test_concurrent_failures_share_one_fetch(tmp_path):
+    mirror = FakeMirror(str(tmp_path))
+    results = []
+    threads = [threading.Thread(
+        target=lambda: results.append(mirror.ensure("NOBOARD")))
+        for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    mirror.release.set()
+    for thread in threads:
+        thread.join()
+    mirror.stop()
+    assert results == [None] * 4
+    assert mirror.syncs == 1
+    assert mirror.extra_boards == []
+    assert mirror._fetching == {}
+
+
+def test_failed_board_is_not_fetched_again(tmp_path):
+    mirror = FakeMirror(str(tmp_path))
+    mirror.release.set()
+    assert mirror.ensure("NOBOARD") is None
+    assert mirror.ensure("NOBOARD") is None
+    assert mirror.syncs == 1
+    mirror.failed_ttl = 0
+    assert mirror.ensure("NOBOARD") is None
+    assert mirror.syncs == 2
+    mirror.stop()
+
+
+def test_slow_fetch_is_pending(tmp_path):
+    mirror = FakeMirror(str(tmp_path))
+    assert mirror.ensure("SLOW", wait=0.05) is daemon.PENDING
+    assert mirror.boards() == ["SLOW"]
+    mirror.release.set()
+    assert mirror.ensure("SLOW") is None
+    mirror.stop()
+
+
+class ProxyErrorHandler(BaseHTTPRequestHandler):
+    def log_message(self, fmt, *args):
+        pass
+
+    def do_GET(self):
+        body = b"<html><body>Not Found</body></html>"
+        self.send_response(404)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def test_fetch_from_survives_html_errors(tmp_path, capsys):
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), ProxyErrorHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    try:
+        url = f"http://127.0.0.1:{httpd.server_address[1]}"
+        assert daemon.fetch_from(url, ["X11DPU"], str(tmp_path)) == \
+            {"X11DPU": None}
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+    assert "[!] X11DPU: HTTP 404" in capsys.readouterr().out
@@ -0,0 +1,89 @@
+import hashlib
+import os
+
+import pytest
+
+import superbfdl.cache as cache
+import superbfdl.integrity as integrity
+import superbfdl.util as util
+
+
+@pytest.fixture
+def bundle(standin):
+    """
+    Returns (url, data) of a firmware bundle of the stand-in.
+    """
+    site, url = standin
+    data = site.bundle("12612")
+    return f"{url}/Bios/softfiles/12612/X11DPU.zip", data
+
+
+def _serve(monkeypatch, send_file):
+    import server
+    monkeypatch.setattr(server.Handler, '_send_file', send_file)
+
+
+def test_size_tolerance():
+    # "Size (KB)" is rounded, in KB or in KiB
+    for size in (100 * 1000 - 1024, 100 * 1000, 100 * 1024 + 1024):
+        integrity.check_size("X11DPU.zip", 100, size)
+    for size in (100 * 1000 - 1025, 100 * 1024 + 1025):
+        with pytest.raises(integrity.IntegrityError):
+            integrity.check_size("X11DPU.zip", 100, size)
+    # unknown sizes are not checked
+    integrity.check_size("X11DPU.zip", None, 5)
+    integrity.check_size("X11DPU.zip", 100, 0)
+
+
+def test_html_page_is_refused(bundle, tmp_path, monkeypatch):
+    url, _data = bundle
+    _serve(monkeypatch, lambda self, body: self._send(
+        "<html>Please log in</html>", content_type='text/html; charset=utf-8'))
+    with pytest.raises(integrity.IntegrityError, match="HTML page"):
+        util.download_verified(url, str(tmp_path), segments=1)
+    assert not os.path.exists(tmp_path / "X11DPU.zip")
+
+
+def test_short_body_is_kept_for_resume(bundle, tmp_path, monkeypatch):
+    url, data = bundle
+
+    def short(self, body):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body[:len(body) // 2])
+        self.close_connection = True
+
+    with monkeypatch.context() as patch:
+        _serve(patch, short)
+        assert util.download_verified(url, str(tmp_path), segments=1,
+                                      chunk_size=1024) == (None, None)
+    assert not os.path.exists(tmp_path / "X11DPU.zip")
+    assert 0 < os.path.getsize(tmp_path / "X11DPU.zip.part") < len(data)
+    name, sha256 = util.download_verified(url, str(tmp_path), segments=1)
+    assert sha256 == hashlib.sha256(data).hexdigest()
+    assert (tmp_path / name).read_bytes() == data
+
+
+def test_bad_zip_is_discarded_and_downloaded_again(bundle, tmp_path,
+                                                   monkeypatch):
+    import server
+    url, data = bundle
+    sent = []
+    send_file = server.Handler._send_file
+
+    def corrupt_once(self, body):
+        sent.append(1)
+        if len(sent) == 1:
+            # right size and type, but not a zip file
+            body = b"\0" * len(body)
+        send_file(self, body)
+
+    _serve(monkeypatch, corrupt_once)
+    downloads = cache.DownloadCache(str(tmp_path / "downloads"))
+    file_path = downloads.fetch(url, size_kb=len(data) // 1024)
+    assert len(sent) == 2
+    with open(file_path, 'rb') as zfile:
+        assert zfile.read() == data
+    assert downloads.index.entry(downloads.key(url))
@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+import superbfdl.manifest as manifest
+
+URL = "https://www.supermicro.com/Bios/softfiles/12612/X11DPU3_4.zip"
+
+
+def _info(revision="3.4", software_id="12612", url=URL):
+    return {'board_model': "X11DPU", 'bios': {'release': revision},
+            'software_id': software_id, 'download_url': url}
+
+
+@pytest.fixture
+def board_path(tmp_path):
+    """
+    A board directory whose bios 3.4 was extracted and recorded.
+    """
+    fw_dir = tmp_path / "X11DPU" / "bios"
+    fw_dir.mkdir(parents=True)
+    (fw_dir / "X11DPU9.A04").write_bytes(b"firmware")
+    manifest.record(str(tmp_path / "X11DPU"), 'bios', _info(),
+                    str(fw_dir / "X11DPU9.A04"))
+    return str(tmp_path / "X11DPU")
+
+
+def test_current_firmware_is_skipped(board_path):
+    assert manifest.is_current(board_path, 'bios', _info())
+    assert not manifest.is_current(board_path, 'ipmi',
+                                   dict(_info(), ipmi={'release': "3.4"}))
+
+
+@pytest.mark.parametrize('info', (
+    _info(revision="3.5"),
+    _info(software_id="12700"),
+    _info(url=URL.replace("X11DPU3_4", "X11DPU3_4a")),
+), ids=('revision', 'software_id', 'url'))
+def test_new_release_is_fetched(board_path, info):
+    assert not manifest.is_current(board_path, 'bios', info)
+
+
+def test_changed_file_is_fetched(board_path):
+    fw_file = os.path.join(board_path, 'bios', "X11DPU9.A04")
+    stat = os.stat(fw_file)
+    # same size, touched
+    os.utime(fw_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert not manifest.is_current(board_path, 'bios', _info())
+
+
+def test_resized_or_missing_file_is_fetched(board_path):
+    fw_file = os.path.join(board_path, 'bios', "X11DPU9.A04")
+    stat = os.stat(fw_file)
+    with open(fw_file, 'ab') as bfile:
+        bfile.write(b"!")
+    # the size alone tells it changed
+    os.utime(fw_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert not manifest.is_current(board_path, 'bios', _info())
+    os.unlink(fw_file)
+    assert not manifest.is_current(board_path, 'bios', _info())
@@ -0,0 +1,46 @@
+from superbfdl import matcher
+
+
+def candidates(*names, depth=0):
+    return [matcher.Candidate(f"dir/{name}", name, depth) for name in names]
+
+
+def ranked_names(cands, board_model=None):
+    return [c.name for c in matcher.rank(cands, board_model)]
+
+
+def test_revision_key():
+    assert matcher.revision_key("X11DPU9.A04") == (4, )
+    assert matcher.revision_key("SMT_X11AST2500_173_06.bin") == (173, 6)
+    assert matcher.revision_key("X11DPU.bin") == ()
+
+
+def test_newest_revision_first():
+    names = ranked_names(candidates("X11DPU.bin", "X11DPU_1.bin",
+                                    "X11DPU_1_10.bin", "X11DPU_1_2.bin"))
+    assert names == ["X11DPU_1_10.bin", "X11DPU_1_2.bin", "X11DPU_1.bin",
+                     "X11DPU.bin"]
+
+
+def test_numeric_revision_order():
+    assert ranked_names(candidates("X11DPU_1_2.bin", "X11DPU_1_10.bin"))[0] \
+        == "X11DPU_1_10.bin"
+
+
+def test_versioned_before_unversioned():
+    assert ranked_names(candidates("X11DPU.bin", "X11DPU_3.bin"))[0] == \
+        "X11DPU_3.bin"
+
+
+def test_board_score_before_revision():
+    names = ranked_names(candidates("H12SSL9.A99", "X11DPU9.A04"),
+                         board_model="X11DPU-Z+")
+    assert names[0] == "X11DPU9.A04"
+
+
+def test_ties_broken_by_depth_then_name():
+    shallow = candidates("B_2.bin", "A_2.bin")
+    deep = candidates("A_2.bin", depth=3)
+    ranked = matcher.rank(deep + shallow)
+    assert [(c.name, c.depth) for c in ranked] == [
+        ("A_2.bin", 0), ("B_2.bin", 0), ("A_2.bin", 3)]
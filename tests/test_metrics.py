@@ -0,0 +1,63 @@
+import threading
+
+import pytest
+
+import superbfdl.metrics as metrics
+
+
+@pytest.fixture
+def registry():
+    registry = metrics.Metrics()
+    registry.profiling = True
+    return registry
+
+
+def _in_thread(fn):
+    thread = threading.Thread(target=fn)
+    thread.start()
+    thread.join()
+
+
+def test_nested_calls_share_a_profiler(registry):
+    inner = registry.profiled(lambda: 1)
+    assert registry.profiled(lambda: inner() + 1)() == 2
+    assert len(registry.profiles) == 1
+
+
+def test_thread_profilers(registry, monkeypatch, tmp_path):
+    monkeypatch.setattr(metrics, 'PROCESS_WIDE_PROFILER', False)
+    inner = registry.profiled(lambda: None)
+    registry.profiled(lambda: _in_thread(inner))()
+    assert len(registry.profiles) == 2
+    assert "function calls" in registry.write_profile(
+        str(tmp_path / "profile.out"))
+
+
+def test_process_wide_profiler(registry, monkeypatch):
+    monkeypatch.setattr(metrics, 'PROCESS_WIDE_PROFILER', True)
+    inner = registry.profiled(lambda: None)
+    registry.profiled(lambda: _in_thread(inner))()
+    assert len(registry.profiles) == 1
+    # the next run gets a profiler again
+    _in_thread(inner)
+    assert len(registry.profiles) == 2
+
+
+def test_prometheus_with_mixed_statuses(tmp_path):
+    registry = metrics.Metrics()
+    registry.incr('http_responses', method='GET', status=200)
+    registry.incr('http_responses', method='GET', status='error')
+    registry.incr('http_responses', method='GET', status=200)
+    child = metrics.Metrics()
+    child.incr('http_responses', method='GET', status=503)
+    registry.merge(child.snapshot())
+    out = tmp_path / "out.prom"
+    registry.write(str(out))
+    lines = out.read_text().splitlines()
+    assert 'superbfdl_http_responses_total{method="GET",status="200"} 2' \
+        in lines
+    assert 'superbfdl_http_responses_total{method="GET",status="503"} 1' \
+        in lines
+    assert 'superbfdl_http_responses_total{method="GET",status="error"} 1' \
+        in lines
+    registry.write(str(tmp_path / "out.jsonl"))
@@ -0,0 +1,56 @@
+import glob
+import os
+
+import pytest
+
+from superbfdl import parser
+
+pytest.importorskip('bs4')
+
+# the recorded pages of the benchmarks, see benchmarks/parsers.py
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                        'benchmarks', 'fixtures')
+
+
+def _fixtures(*prefixes):
+    return sorted(os.path.basename(name) for prefix in prefixes
+                  for name in glob.glob(os.path.join(FIXTURES, prefix + '*')))
+
+
+def _read(name):
+    with open(os.path.join(FIXTURES, name)) as hfile:
+        return hfile.read()
+
+
+@pytest.mark.parametrize('name', _fixtures('motherboard_', 'results_',
+                                           'firmware_'))
+def test_backends_agree(name):
+    page = _read(name)
+    for fn in (parser.find_product_id, parser.find_rows):
+        assert fn(page, backend='fast') == fn(page, backend='bs4')
+
+
+@pytest.mark.parametrize('name', _fixtures('results_X11DPU', 'firmware_'))
+def test_rows_found(name):
+    rows = parser.find_rows(_read(name), backend='fast')
+    assert rows and any(link for _key, _value, link in rows)
+
+
+def test_empty_page_is_parsed_once(monkeypatch):
+    def bs4(page):
+        raise AssertionError("bs4 should not run")
+
+    monkeypatch.setattr(parser, '_bs4_rows', bs4)
+    monkeypatch.setattr(parser, '_bs4_product_id', bs4)
+    page = _read('results_empty.html')
+    assert parser.find_rows(page, backend='auto') == []
+    assert parser.find_product_id(page, backend='auto') is None
+
+
+def test_unexpected_markup_falls_back():
+    # the fast scan only sees closed rows
+    page = ("<table><tr class='textA'><td>BIOS Revision</td><td>3.4</td>"
+            "</table>")
+    assert parser.find_rows(page, backend='fast') == []
+    assert parser.find_rows(page, backend='auto') == \
+        parser.find_rows(page, backend='bs4') != []
@@ -0,0 +1,90 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from superbfdl import ratelimit, session
+
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, fmt, *args):
+        pass
+
+    def do_GET(self):
+        body = b"x" * 1024
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture(autouse=True)
+def limiters():
+    ratelimit.configure(rate=0, max_concurrency=ratelimit.MAX_CONCURRENCY)
+    yield
+    ratelimit.configure(rate=ratelimit.RATE)
+
+
+def test_limit_grows_up_to_max_concurrency():
+    limiter = ratelimit.HostLimiter('host', rate=0, concurrency=4,
+                                    max_concurrency=16)
+    for _ in range(500):
+        limiter.feedback(200, 0.01)
+    assert limiter.limit == 16
+
+
+def test_max_concurrency_caps_the_initial_limit():
+    limiter = ratelimit.HostLimiter('host', concurrency=8, max_concurrency=2)
+    assert limiter.limit == 2
+
+
+def test_configure_keeps_learned_limiters():
+    first = ratelimit.limiter('http://example.com/a')
+    ratelimit.configure(rate=0)
+    assert ratelimit.limiter('http://example.com/b') is first
+    ratelimit.configure(max_concurrency=3)
+    assert ratelimit.limiter('http://example.com/b') is not first
+
+
+def test_request_frees_the_slot_after_headers(server):
+    resp = session.get(server)
+    assert ratelimit.limiter(server).active == 0
+    resp.close()
+
+
+def test_stream_holds_the_slot_for_the_body(server):
+    limiter = ratelimit.limiter(server)
+    with session.stream(server) as resp:
+        assert limiter.active == 1
+        assert len(resp.content) == 1024
+    assert limiter.active == 0
+
+
+def test_rate_grows_past_the_initial_rate_while_starved():
+    limiter = ratelimit.HostLimiter('host', rate=2, burst=1)
+    for _ in range(10):
+        limiter.reserve()
+        limiter.feedback(200, 0.01)
+    assert limiter.rate > 2
+    # no request waited for a token since: the rate is not the limit
+    rate = limiter.rate
+    limiter.feedback(200, 0.01)
+    assert limiter.rate == rate
+
+
+def test_max_rate_caps_the_rate():
+    limiter = ratelimit.HostLimiter('host', rate=2, burst=1, max_rate=3)
+    for _ in range(10):
+        limiter.reserve()
+        limiter.feedback(200, 0.01)
+    assert limiter.rate == 3
@@ -0,0 +1,41 @@
+import subprocess
+import sys
+
+import pytest
+import requests
+
+import superbfdl
+import superbfdl.session as session
+
+
+class Response(object):
+    status_code = 503
+    url = "https://www.supermicro.com/support/resources/results.aspx"
+
+
+def test_http_status_error_is_a_requests_error():
+    assert issubclass(session.HTTPStatusError, requests.HTTPError)
+    assert session.HTTPStatusError is session.http_status_error_class()
+    assert repr(session.HTTPStatusError) == \
+        "<class 'superbfdl.session.HTTPStatusError'>"
+
+
+def test_check_status():
+    resp = Response()
+    with pytest.raises(requests.HTTPError) as error:
+        session.check_status(resp)
+    assert isinstance(error.value, session.HTTPStatusError)
+    assert isinstance(error.value, IOError)
+    assert error.value.response is resp
+    assert session.check_status(resp, expected=(503, )) is resp
+
+
+def test_version_does_not_import_the_cli():
+    code = ("import sys, superbfdl; sys.argv = ['superbfdl', '--version']; "
+            "superbfdl.main(); "
+            "print(' '.join(m for m in ('superbfdl.cli', 'requests', "
+            "'sqlite3') if m in sys.modules))")
+    out = subprocess.run([sys.executable, '-c', code], check=True,
+                         stdout=subprocess.PIPE, universal_newlines=True)
+    assert out.stdout.splitlines() == [f"superbfdl {superbfdl.__version__}",
+                                       ""]
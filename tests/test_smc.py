@@ -0,0 +1,70 @@
+import superbfdl.cache as cache
+import superbfdl.core as core
+import superbfdl.smc as smc
+
+PRODUCT_IDS = {'X11DPU': '85553', 'X11DPU-Z+': '85553', 'H11DSi': '90001'}
+SOFTWARE_IDS = {'bios': '12612', 'ipmi': '12700'}
+
+
+def _product_id(self, refresh=False):
+    self.product_id = PRODUCT_IDS[self.board_model]
+    return self.product_id
+
+
+def _download_url(self, resource_url, refresh=False):
+    fw_type = smc.RESOURCE_FW_TYPE[resource_url]
+    software_id = SOFTWARE_IDS[fw_type]
+    url = f"{smc.SUPERMICRO_URL}/Bios/softfiles/{software_id}/{fw_type}.zip"
+    return {'software_id': software_id,
+            fw_type: {'revision': f"{self.product_id}.1", 'url': url}}
+
+
+def test_resolve_boards(monkeypatch):
+    requests = []
+    monkeypatch.setattr(smc.SMC, 'get_board_product_id', _product_id)
+    monkeypatch.setattr(
+        smc.SMC, 'build_download_url',
+        lambda self, *args, **kwargs: requests.append(self.product_id) or
+        _download_url(self, *args, **kwargs))
+    boards = {board.board_model: board
+              for board in smc.resolve_boards(list(PRODUCT_IDS))}
+    assert sorted(boards) == sorted(PRODUCT_IDS)
+    # the boards of a ProductID share its bios and ipmi requests
+    assert sorted(requests) == ['85553'] * 2 + ['90001'] * 2
+    for board in boards.values():
+        assert board.ok
+        assert board.bios_software_id == '12612'
+        assert board.ipmi_software_id == '12700'
+        assert board.bios_url.endswith('/12612/bios.zip')
+        assert board.ipmi_url.endswith('/12700/ipmi.zip')
+
+
+def test_get_firmwares_keeps_both_ids(monkeypatch):
+    monkeypatch.setattr(smc.SMC, 'build_download_url', _download_url)
+    board = smc.SMC('X11DPU')
+    board.product_id = '85553'
+    board.get_firmwares()
+    assert board.bios_software_id == '12612'
+    assert board.ipmi_software_id == '12700'
+
+
+def test_build_download_url_parses_the_results_page(standin, monkeypatch,
+                                                    tmp_path):
+    import server
+    site, url = standin
+    resource_url = f"{url}/support/resources/results.aspx"
+    monkeypatch.setattr(core, 'SUPERMICRO_URL', url)
+    monkeypatch.setattr(smc, 'RESOURCE_FW_TYPE', {resource_url: 'bios'})
+    cache.configure(cache_dir=str(tmp_path))
+    try:
+        board = smc.SMC('X11DPU')
+        board.product_id = server.product_id('X11DPU')
+        resources = board.build_download_url(resource_url, refresh=True)
+    finally:
+        cache.configure(cache_dir=cache.CACHE_DIR)
+    software_id = site.software_id('X11DPU')
+    assert resources['software_id'] == software_id
+    assert resources['bios']['url'].startswith(
+        f"{url}/Bios/softfiles/{software_id}/")
+    # the last resolved ID, like before the bios and ipmi ones were split
+    assert board.software_id == software_id
@@ -0,0 +1,118 @@
+import hashlib
+import io
+import os
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
+
+import pytest
+
+import superbfdl.metrics as metrics
+import superbfdl.util as util
+
+
+@pytest.fixture
+def bundle(standin):
+    """
+    Returns (url, data) of a firmware bundle of the stand-in.
+    """
+    site, url = standin
+    data = site.bundle("12612")
+    return f"{url}/Bios/softfiles/12612/X11DPU.zip", data
+
+
+def test_part_is_resumed_with_a_range(bundle, tmp_path, capsys):
+    url, data = bundle
+    with open(tmp_path / "X11DPU.zip.part", 'wb') as part:
+        part.write(data[:1000])
+    name, sha256 = util.download_verified(url, str(tmp_path), segments=1)
+    assert name == "X11DPU.zip"
+    # the digest covers the bytes that were already there
+    assert sha256 == hashlib.sha256(data).hexdigest()
+    assert (tmp_path / name).read_bytes() == data
+    assert "Resuming X11DPU.zip.part at byte 1000" in capsys.readouterr().out
+
+
+def test_part_is_replaced_when_the_range_is_ignored(bundle, tmp_path,
+                                                    monkeypatch):
+    import server
+    url, data = bundle
+    monkeypatch.setattr(server.Handler, '_send_file', lambda self, body:
+                        self._send(body, content_type='application/zip'))
+    with open(tmp_path / "X11DPU.zip.part", 'wb') as part:
+        part.write(b"stale" * 200)
+    name, sha256 = util.download_verified(url, str(tmp_path), segments=1)
+    assert sha256 == hashlib.sha256(data).hexdigest()
+    assert (tmp_path / name).read_bytes() == data
+
+
+def test_segments_are_joined(bundle, tmp_path, monkeypatch):
+    url, data = bundle
+    monkeypatch.setitem(util._download_settings, 'segment_min_size', 0)
+    # the second segment was interrupted, it is resumed
+    step = -(-len(data) // 4)
+    with open(tmp_path / "X11DPU.zip.part1", 'wb') as segment:
+        segment.write(data[step:step + 100])
+    name, sha256 = util.download_verified(url, str(tmp_path), segments=4)
+    assert sha256 == hashlib.sha256(data).hexdigest()
+    assert (tmp_path / name).read_bytes() == data
+    assert os.listdir(tmp_path) == [name]
+
+
+def _nested_zip(tmp_path, compression):
+    """
+    Returns the path of a zip holding BIOS.zip, itself holding the
+    firmware X11DPU9.A04, and the size of BIOS.zip.
+    """
+    inner = io.BytesIO()
+    with ZipFile(inner, 'w') as archive:
+        archive.writestr("X11DPU9.A04", b"firmware" * 1000)
+    zip_path = str(tmp_path / "bundle.zip")
+    with ZipFile(zip_path, 'w', compression) as archive:
+        archive.writestr("README.txt", b"notes")
+        archive.writestr("BIOS.zip", inner.getvalue())
+    return zip_path, len(inner.getvalue())
+
+
+def _opened(mode):
+    return metrics.registry().counters[('nested_zips', (('mode', mode), ))]
+
+
+def test_stored_member_is_read_in_place(tmp_path):
+    zip_path, size = _nested_zip(tmp_path, ZIP_STORED)
+    with ZipFile(zip_path) as archive:
+        info = archive.getinfo("BIOS.zip")
+        window = util._member_window(archive, info)
+        assert window.read() == archive.read(info)
+        window.seek(-size, io.SEEK_END)
+        assert window.read(4) == b"PK\x03\x04"
+        streamed = _opened('stream')
+        with util._open_nested(archive, info,
+                               util._MemoryBudget(0)) as nested:
+            assert nested.read("X11DPU9.A04") == b"firmware" * 1000
+        assert _opened('stream') == streamed + 1
+
+
+def test_compressed_member_uses_the_memory_budget(tmp_path):
+    zip_path, size = _nested_zip(tmp_path, ZIP_DEFLATED)
+    with ZipFile(zip_path) as archive:
+        info = archive.getinfo("BIOS.zip")
+        assert util._member_window(archive, info) is None
+        budget = util._MemoryBudget(size)
+        in_memory, spilled = _opened('memory'), _opened('spill')
+        with util._open_nested(archive, info, budget) as nested:
+            assert budget.available == 0
+            # no room left, the next one is spilled to a temporary file
+            with util._open_nested(archive, info, budget) as spill:
+                assert spill.read("X11DPU9.A04") == \
+                    nested.read("X11DPU9.A04")
+        assert budget.available == size
+        assert _opened('memory') == in_memory + 1
+        assert _opened('spill') == spilled + 1
+
+
+def test_candidates_with_no_memory(tmp_path, monkeypatch):
+    zip_path, _size = _nested_zip(tmp_path, ZIP_DEFLATED)
+    monkeypatch.setitem(util._extract_settings, 'memory_limit', 0)
+    spilled = _opened('spill')
+    assert [c.name for c in util.candidates(zip_path, 'bios')] == \
+        ["X11DPU9.A04"]
+    assert _opened('spill') == spilled + 1
@@ -0,0 +1,129 @@
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
+import superbfdl.workqueue as workqueue
+
+# a `superbfdl worker` for the stand-in site given as first argument
+WORKER = """
+import sys
+import superbfdl
+import superbfdl.core as core
+core.SUPERMICRO_URL = sys.argv[1]
+sys.argv = ['superbfdl', 'worker'] + sys.argv[2:]
+sys.exit(superbfdl.main())
+"""
+
+
+def _wait_for(condition, timeout=30):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.05)
+
+
+def test_expired_lease_is_requeued(tmp_path):
+    queue = workqueue.WorkQueue(str(tmp_path), lease=0, max_attempts=2)
+    queue.put("X11DPU", {'board': "X11DPU"})
+    lease = queue.claim("dead")
+    assert queue.requeue_expired() == 1
+    assert queue.counts() == {'pending': 1, 'claimed': 0, 'done': 0}
+    assert not lease.renew() and lease.lost
+
+    lease = queue.claim("dead")
+    assert lease.attempt == 2
+    assert queue.requeue_expired() == 1
+    result = queue.results()["X11DPU"]
+    assert result['result'] == {'error': 'lease expired'}
+    assert queue.empty()
+
+
+def test_failed_task_is_retried(tmp_path):
+    queue = workqueue.WorkQueue(str(tmp_path))
+    queue.put("X11DPU", {'board': "X11DPU"})
+    runs = []
+
+    def run(task):
+        runs.append(task['board'])
+        if len(runs) == 1:
+            raise ValueError("throttled")
+        return {'bios': True}
+
+    workqueue.Worker(queue, run, poll=0.01).run()
+    result = queue.results()["X11DPU"]
+    assert runs == ["X11DPU", "X11DPU"]
+    assert result['attempts'] == 2 and result['result'] == {'bios': True}
+
+
+def test_unwritable_queue_does_not_stop_the_worker(tmp_path, monkeypatch):
+    queue = workqueue.WorkQueue(str(tmp_path), lease=0.5)
+    for board in ("X11DPU", "H11DSi"):
+        queue.put(board, {'board': board})
+    complete = queue.complete
+    failures = []
+
+    def flaky_complete(lease, result):
+        if not failures:
+            failures.append(lease.task_id)
+            raise OSError("Stale file handle")
+        return complete(lease, result)
+
+    monkeypatch.setattr(queue, 'complete', flaky_complete)
+    workqueue.Worker(queue, lambda task: True, poll=0.1).run()
+    # the task whose result was lost ran again once its lease expired
+    assert sorted(queue.results()) == ["H11DSi", "X11DPU"]
+    assert queue.results()[failures[0]]['attempts'] == 2
+
+
+def _worker(url, queue_dir, output_dir, cache_dir, log):
+    return subprocess.Popen(
+        [sys.executable, '-c', WORKER, url, '--queue', queue_dir,
+         '-p', output_dir, '--cache-dir', cache_dir, '--rate', '0',
+         '--lease', '2', '-j', '2'],
+        stdout=log, stderr=subprocess.STDOUT)
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason="SIGKILL")
+def test_worker_processes(tmp_path, standin):
+    site, url = standin
+    site.latency = 0.1
+    queue_dir = str(tmp_path / "queue")
+    output_dir = str(tmp_path / "firmware")
+    cache_dir = str(tmp_path / "cache")
+    boards = ["X11DPU", "X11DPU-Z+", "H11DSi", "X12DPG", "X11SPM", "B11DPT"]
+    queue = workqueue.WorkQueue(queue_dir, lease=2)
+    queue.submit_boards(boards, ['bios', 'ipmi'])
+
+    logs = [open(tmp_path / f"worker{i}.log", 'w') for i in range(3)]
+    # the first worker dies with its tasks claimed
+    doomed = _worker(url, queue_dir, output_dir, cache_dir, logs[0])
+    _wait_for(lambda: queue.counts()['claimed'])
+    doomed.send_signal(signal.SIGKILL)
+    doomed.wait()
+    lost = [name.split('.')[0] for name in queue._names('claimed')]
+    assert lost
+
+    workers = [_worker(url, queue_dir, output_dir, cache_dir, log)
+               for log in logs[1:]]
+    try:
+        for worker in workers:
+            assert worker.wait(timeout=60) == 0
+    finally:
+        for worker in workers:
+            worker.kill()
+        for log in logs:
+            log.close()
+
+    results = queue.results()
+    assert len(results) == len(boards) and queue.empty()
+    for task_id, result in results.items():
+        assert result['result'] == {'bios': True, 'ipmi': True}, task_id
+    for task_id in lost:
+        assert results[task_id]['attempts'] == 2
+    assert all(os.listdir(os.path.join(output_dir, board, 'bios'))
+               for board in boards)